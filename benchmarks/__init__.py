@@ -0,0 +1,13 @@
+"""
+Benchmarks for the client and server hot paths. The microbenchmarks in suite.py all run with
+    python -m benchmarks
+and the other modules measure one thing in more depth, each run on its own, e.g.
+    python -m benchmarks.draw_map
+"""
+# Required to import from shared modules
+import sys
+from pathlib import Path
+
+root = Path(__file__).resolve().parents[1]
+if str(root) not in sys.path:
+    sys.path.append(str(root))
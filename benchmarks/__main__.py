@@ -0,0 +1,99 @@
+"""
+Runs every microbenchmark in benchmarks/suite.py, writes the results to a JSON file and compares them against a
+baseline saved earlier on the same machine, flagging anything which got slower by more than the threshold.
+
+    python -m benchmarks [-k name] [--save-baseline] [--threshold 0.1] [--output benchmarks/results.json]
+
+Exits with status 1 if anything regressed.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import timeit
+from typing import *
+
+from benchmarks import suite
+
+here = os.path.dirname(os.path.realpath(__file__))
+
+
+def measure(fn: Callable[[], Any], repeat: int) -> dict:
+    """
+    Times fn over enough calls to take at least 0.2 seconds, repeat times over.
+    :return: the best and median seconds per call, and the calls per repeat
+    """
+    timer = timeit.Timer(fn)
+    loops, _ = timer.autorange()
+    times = [t / loops for t in timer.repeat(repeat, loops)]
+    return {'best': min(times), 'median': statistics.median(times), 'loops': loops}
+
+
+def run(names: List[str], repeat: int) -> Dict[str, dict]:
+    results = {}
+    for name in names:
+        try:
+            fn = suite.BENCHMARKS[name]()
+        except ImportError as e:
+            print(f"{name:<50} skipped: {e}")
+            continue
+        results[name] = measure(fn, repeat)
+    return results
+
+
+def format_time(seconds: float) -> str:
+    for unit, scale in (('s', 1), ('ms', 1e-3), ('us', 1e-6)):
+        if seconds >= scale:
+            return f"{seconds / scale:7.2f}{unit}"
+    return f"{seconds / 1e-9:7.2f}ns"
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description="Run the microbenchmarks.")
+    parser.add_argument('-k', dest='keyword', default='', help="only run benchmarks with this in their name")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', default=os.path.join(here, 'results.json'))
+    parser.add_argument('--baseline', default=os.path.join(here, 'baseline.json'))
+    parser.add_argument('--save-baseline', action='store_true', help="save these results as the new baseline")
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help="how much slower than the baseline counts as a regression, e.g. 0.1 for 10%%")
+    args = parser.parse_args()
+
+    baseline: Dict[str, dict] = {}
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+
+    names = [name for name in suite.BENCHMARKS if args.keyword in name]
+    results = run(names, args.repeat)
+
+    regressions = []
+    for name, result in results.items():
+        line = f"{name:<50} {format_time(result['best'])}"
+        if name in baseline:
+            change = result['best'] / baseline[name]['best'] - 1
+            line += f"  {change:+7.1%} vs baseline"
+            if change > args.threshold:
+                line += "  REGRESSION"
+                regressions.append(name)
+        print(line)
+
+    document = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results
+    }
+    with open(args.baseline if args.save_baseline else args.output, 'w') as f:
+        json.dump(document, f, indent=2)
+
+    if regressions:
+        print(f"{len(regressions)} benchmark(s) more than {args.threshold:.0%} slower than the baseline")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+"""
+Measures how much compressing a connection's packets saves, and what it costs, on made-up traffic like the server
+sends: a player arriving in a busy room, then a minute of the room's ticks, and what a client sends meanwhile.
+Each is compressed as one stream the way a connection is, then without the preset dictionary, and then a packet at
+a time with no stream at all, to show what each part is worth.
+
+    python -m benchmarks.compression [players=50] [ticks=1200]
+
+Encryption adds 64 bytes and the netstring framing a few more to every packet whether it's compressed or not,
+which the wire columns include. If rsa and pycryptodome are installed, the time to encrypt a packet is shown
+alongside for comparison.
+"""
+import random
+import sys
+import time
+import zlib
+from typing import *
+
+from networking import compression, packet
+
+FRAMING = 64 + 5    # the encrypted AES key, and a netstring's length, colon and comma
+
+
+def instance(i: int, y: int, x: int) -> dict:
+    typename = 'Player' if i % 2 else random.choice(('Item', 'Tree', 'Rock', 'Pickaxe'))
+    return {'id': 1000 + i, 'entity': {'id': 500 + i, 'typename': typename, 'name': f"{typename.lower()}{i}"},
+            'room': 1, 'y': y, 'x': x, 'amount': 1, 'respawn_time': 0 if typename == 'Player' else 30}
+
+
+def arrival(players: int) -> List[bytes]:
+    """
+    What establish_player_in_room sends a player arriving in a room, with everyone in view.
+    """
+    packets = [
+        packet.MoveRoomsPacket(1),
+        packet.OkPacket(),
+        packet.ServerModelPacket('Room', {'id': 1, 'name': 'Forest', 'file_name': 'forest'}),
+        packet.ServerModelPacket('Player', {'id': 7, 'user': 7, 'entity': 500, 'inventory': 7}),
+        packet.ServerModelPacket('Instance', instance(0, 10, 10)),
+        packet.WeatherChangePacket('Clear'),
+    ]
+    packets += [packet.ServerModelPacket('Instance', instance(i, i % 20, i // 20)) for i in range(players)]
+    packets.append(packet.ServerLogPacket("player0 has arrived."))
+    return [p.tobytes() for p in packets]
+
+
+def ticks(players: int, count: int) -> List[bytes]:
+    """
+    A room's ticks, in which a tenth of the players in view move each tick and someone says something now and then.
+    """
+    positions = {i: (i % 20, i // 20) for i in range(1, players, 2)}
+    packets = []
+    for tick in range(count):
+        for i in random.sample(list(positions), max(1, len(positions) // 10)):
+            y, x = positions[i]
+            positions[i] = y + random.choice((-1, 0, 1)), x + random.choice((-1, 0, 1))
+            packets.append(packet.ServerModelPacket('Instance', instance(i, *positions[i])))
+        if tick % 40 == 0:
+            packets.append(packet.ServerLogPacket(f"player{tick % players} says: anyone seen any copper?"))
+        if tick % 100 == 0:
+            packets.append(packet.PingPacket(tick // 100))
+    return [p.tobytes() for p in packets]
+
+
+def client(count: int) -> List[bytes]:
+    """
+    What a player sends: a move most ticks, a pong every 5 seconds and the odd chat message.
+    """
+    packets = []
+    for tick in range(count):
+        if tick % 3:
+            packets.append(random.choice((packet.MoveUpPacket, packet.MoveDownPacket, packet.MoveLeftPacket,
+                                          packet.MoveRightPacket))(tick))
+        if tick % 100 == 0:
+            packets.append(packet.PongPacket(tick // 100))
+        if tick % 200 == 0:
+            packets.append(packet.ChatPacket("anyone seen any copper?"))
+    return [p.tobytes() for p in packets]
+
+
+def stream(data: List[bytes], dictionary: bytes) -> Tuple[int, float]:
+    """
+    :return: the compressed size and the seconds taken, compressing each packet in turn on one stream
+    """
+    z = zlib.compressobj(compression.LEVEL, zlib.DEFLATED, -compression.WINDOW_BITS, compression.MEM_LEVEL,
+                         zlib.Z_DEFAULT_STRATEGY, dictionary)
+    size = 0
+    start = time.perf_counter()
+    for d in data:
+        size += len(z.compress(d) + z.flush(zlib.Z_SYNC_FLUSH)) - 4
+    return size, time.perf_counter() - start
+
+
+def separately(data: List[bytes]) -> Tuple[int, float]:
+    start = time.perf_counter()
+    size = sum(len(zlib.compress(d, compression.LEVEL)) for d in data)
+    return size, time.perf_counter() - start
+
+
+def decompress_seconds(data: List[bytes]) -> float:
+    compressor = compression.Compressor()
+    compressed = [compressor.compress(d) for d in data]
+    decompressor = compression.Decompressor()
+    start = time.perf_counter()
+    for c in compressed:
+        decompressor.decompress(c)
+    return time.perf_counter() - start
+
+
+def encrypt_seconds(data: List[bytes]) -> Optional[float]:
+    try:
+        import rsa
+        from networking import cryptography
+    except ImportError:
+        return None
+    public_key, _ = rsa.newkeys(512)
+    start = time.perf_counter()
+    for d in data:
+        cryptography.encrypt(d, public_key)
+    return time.perf_counter() - start
+
+
+def report(name: str, data: List[bytes]):
+    plain = sum(len(d) for d in data)
+    wire = plain + FRAMING * len(data)
+    print(f"{name}: {len(data)} packets, {plain / len(data):.0f} bytes each on average")
+    for method, (size, seconds) in (('stream + dictionary', stream(data, compression.DICTIONARY)),
+                                    ('stream', stream(data, b'')),
+                                    ('each packet alone', separately(data))):
+        compressed_wire = size + FRAMING * len(data)
+        print(f"  {method:<20} {size / plain:6.1%} of the packets, {compressed_wire / wire:6.1%} on the wire, "
+              f"{seconds / len(data) * 1e6:6.1f}us a packet")
+    print(f"  {'decompressing':<20} {decompress_seconds(data) / len(data) * 1e6:6.1f}us a packet")
+    encrypting = encrypt_seconds(data)
+    if encrypting is not None:
+        print(f"  {'encrypting':<20} {encrypting / len(data) * 1e6:6.1f}us a packet")
+
+
+def main():
+    players = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 1200
+    random.seed(0)
+
+    report(f"Arriving in a room with {players} instances in view", arrival(players))
+    report(f"{count} ticks of that room", ticks(players, count))
+    report(f"What a player sends in {count} ticks", client(count))
+
+
+if __name__ == '__main__':
+    main()
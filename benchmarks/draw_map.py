@@ -0,0 +1,60 @@
+"""
+Measures how many frames per second GameView.draw_map manages and how much CPU the client spends doing it,
+drawing to an in-memory screen instead of a terminal.
+
+    python -m benchmarks.draw_map [room=forest] [frames=2000]
+"""
+import sys
+import time
+from types import SimpleNamespace
+
+from benchmarks import fakecurses
+
+import maps
+from client.controllers.game import State
+from client.controllers.models import InstanceModel, EntityStore
+from client.views.gameview import GameView
+
+
+def make_view(file_name: str, weather: str) -> GameView:
+    room = maps.Room(0, file_name.title(), file_name)
+    cs = SimpleNamespace(stdscr=fakecurses.FakeScreen())
+    controller = SimpleNamespace(
+        cs=cs,
+        room=room,
+        player_instance=InstanceModel({'id': 1, 'y': room.height // 2, 'x': room.width // 2}),
+        visible_instances=EntityStore(),
+        weather=weather,
+        state=State.NORMAL,
+        chatbox=SimpleNamespace()
+    )
+    return GameView(controller)
+
+
+def run(file_name: str, frames: int, weather: str):
+    view = make_view(file_name, weather)
+
+    # The first frame pays for building the room's map layer
+    start = time.perf_counter()
+    view.draw_map()
+    first_frame = time.perf_counter() - start
+
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    for _ in range(frames):
+        view.draw_map()
+    wall, cpu = time.perf_counter() - wall_start, time.process_time() - cpu_start
+
+    print(f"{file_name:>8} {weather:>5}: {frames / wall:10.1f} fps  {100 * cpu / wall:5.1f}% cpu  "
+          f"first frame {first_frame * 1000:.2f}ms  {view.win1._win.calls // (frames + 1)} addstr/frame")
+
+
+def main():
+    fakecurses.install()
+    file_name = sys.argv[1] if len(sys.argv) > 1 else 'forest'
+    frames = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    for weather in ('Clear', 'Rain'):
+        run(file_name, frames, weather)
+
+
+if __name__ == '__main__':
+    main()
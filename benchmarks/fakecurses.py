@@ -0,0 +1,43 @@
+import curses
+
+
+class FakeScreen:
+    """
+    Stands in for a curses window so views can be drawn without a terminal. Only counts the calls made to it.
+    """
+
+    def __init__(self, height=40, width=106):
+        self.height = height
+        self.width = width
+        self.calls = 0
+
+    def subwin(self, height, width, y, x):
+        return FakeScreen(height, width)
+
+    def getmaxyx(self):
+        return self.height, self.width
+
+    def addstr(self, y, x, string):
+        self.calls += 1
+
+    def attron(self, attr):
+        pass
+
+    def attroff(self, attr):
+        pass
+
+    def border(self):
+        pass
+
+    def erase(self):
+        pass
+
+    def refresh(self):
+        pass
+
+
+def install():
+    """
+    curses.color_pair refuses to work before curses.initscr(), so swap in one which doesn't need a terminal.
+    """
+    curses.color_pair = lambda n: n << 8
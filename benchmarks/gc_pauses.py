@@ -0,0 +1,86 @@
+"""
+Compares tick times and garbage collection pauses with Python's default collector settings against the server's
+GCManager (world frozen after loading, tuned thresholds), with every player moving each tick.
+
+    python -m benchmarks.gc_pauses [players=20] [ticks=100] [items=5000]
+"""
+import gc
+import statistics
+import sys
+import time
+
+from benchmarks import world
+
+
+def run(server, protos, ticks: int) -> dict:
+    from networking import packet
+
+    pauses = {0: [], 1: [], 2: []}
+    started = [0.0]
+
+    def callback(phase, info):
+        if phase == 'start':
+            started[0] = time.perf_counter()
+        else:
+            pauses[info['generation']].append(time.perf_counter() - started[0])
+
+    moves = (packet.MoveUpPacket, packet.MoveRightPacket, packet.MoveDownPacket, packet.MoveLeftPacket)
+    times = []
+    gc.callbacks.append(callback)
+    try:
+        for t in range(ticks):
+            for i, proto in enumerate(protos):
+                proto.next_packet = moves[(t // 2 + i) % len(moves)](t)
+            start = time.perf_counter()
+            server.tick()
+            times.append(time.perf_counter() - start)
+    finally:
+        gc.callbacks.remove(callback)
+
+    times.sort()
+    return {'times': times, 'pauses': pauses}
+
+
+def report(name: str, result: dict):
+    times = result['times']
+    print(f"{name:>8}: tick p50 {statistics.median(times) * 1000:7.2f}ms  "
+          f"p99 {times[int(len(times) * 0.99)] * 1000:7.2f}ms  max {times[-1] * 1000:7.2f}ms")
+    for generation, pauses in result['pauses'].items():
+        if pauses:
+            print(f"          gen {generation}: {len(pauses):5} collections, "
+                  f"total {sum(pauses) * 1000:8.2f}ms, longest {max(pauses) * 1000:6.2f}ms")
+
+
+def main():
+    players = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    ticks = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    items = int(sys.argv[3]) if len(sys.argv) > 3 else 5000
+
+    from networking import logger
+    logger.configure('WARNING')
+
+    server, protos = world.make_world(players, 20)
+
+    # The rest of the world: long-lived instances in another room, which the collector has to look at but which
+    # don't add to what the players are sent
+    from server import models
+    room = models.Room.objects.create(name='Tavern', file_name='tavern')
+    beer = models.Entity.objects.get(name='Beer')
+    models.InstancedEntity.objects.bulk_create(
+        models.InstancedEntity(entity=beer, room=room, y=0, x=0) for _ in range(items))
+    for instance in models.InstancedEntity.objects.filter(room=room).select_related('entity', 'room'):
+        server.instances[instance.pk] = instance
+
+    # make_world loads the world after the server has already frozen what it had, so start again from Python's
+    # defaults to compare against
+    gc.unfreeze()
+    gc.set_threshold(700, 10, 10)
+    gc.collect()
+    report('default', run(server, protos, ticks))
+
+    server.gc.freeze()
+    report('tuned', run(server, protos, ticks))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+"""
+Replays a burst of server traffic through the client's frame readers, comparing the frame decoder which receives
+into one reusable buffer, the buffered netstring decoder before it, and reading the length prefix a byte at a time
+as the client used to. Decryption is left out so only the framing is measured.
+
+    python -m benchmarks.netstring [capture]
+
+The capture is the raw bytes a client received, as written by running the client with MOONLAPSE_CAPTURE set
+to a filename. Only the frame decoder can read one with binary frames in it. Without one, a burst like a player
+arriving in a busy room is made up instead, framed both ways.
+"""
+import sys
+import time
+from typing import *
+
+from networking import framing, packet
+
+
+class ReplaySocket:
+    """
+    Hands out the captured bytes as a socket would, at most bufsize at a time, counting the calls to recv.
+    """
+
+    def __init__(self, data: bytes, chunk: int = 1448):
+        self.data = data
+        self.view = memoryview(data)
+        self.pos = 0
+        self.chunk = chunk     # no more than a TCP segment arrives at once
+        self.calls = 0
+
+    def recv(self, bufsize: int) -> bytes:
+        self.calls += 1
+        n = min(bufsize, self.chunk)
+        data = self.data[self.pos:self.pos + n]
+        self.pos += len(data)
+        return data
+
+    def recv_into(self, buffer: memoryview) -> int:
+        self.calls += 1
+        n = min(len(buffer), self.chunk, len(self.data) - self.pos)
+        buffer[:n] = self.view[self.pos:self.pos + n]
+        self.pos += n
+        return n
+
+    def exhausted(self) -> bool:
+        return self.pos >= len(self.data)
+
+
+def read_bytewise(s) -> bytes:
+    """
+    How NetworkState._receive used to read one netstring.
+    """
+    length: bytes = b''
+    while len(length) <= len(str(packet.Packet.MAX_LENGTH)):
+        c: bytes = s.recv(1)
+        if c != b':':
+            int(c)
+            length += c
+        else:
+            data: bytes = s.recv(int(length))
+            while len(data) < int(length):
+                data += s.recv(int(length) - len(data))
+            s.recv(1)
+            return data
+    raise ValueError("Too long")
+
+
+def read_buffered(s, decoder: framing.NetstringDecoder) -> list:
+    return decoder.feed(s.recv(65536))
+
+
+def read_frames(s, decoder: framing.FrameDecoder) -> list:
+    with decoder.space() as view:
+        decoder.received(s.recv_into(view))
+    return decoder.frames()
+
+
+def made_up_burst(players: int = 200, framed: Optional[str] = None) -> bytes:
+    frames = []
+    for i in range(players):
+        instance = {'id': i, 'entity': {'id': i, 'typename': 'Player', 'name': f"player{i}"}, 'room': 1,
+                    'y': i % 32, 'x': i // 32, 'amount': 1, 'respawn_time': 0}
+        p = packet.ServerModelPacket('Instance', instance)
+        # Encrypted packets carry a 64 byte key in front and are the same length as the plain text otherwise
+        frames.append(framing.frame(bytes(64) + p.tobytes(), framed))
+        if i % 10 == 0:
+            frames.append(framing.frame(bytes(64) + packet.ServerLogPacket(f"player{i} has arrived.").tobytes(),
+                                        framed))
+    return b''.join(frames)
+
+
+def measure(name: str, burst: bytes, rounds: int = 50):
+    frames = calls = 0
+    start = time.perf_counter()
+    for _ in range(rounds):
+        s = ReplaySocket(burst)
+        netstrings = framing.NetstringDecoder()
+        decoder = framing.FrameDecoder()
+        while not s.exhausted():
+            if name == 'bytewise':
+                read_bytewise(s)
+                frames += 1
+            elif name == 'buffered':
+                frames += len(read_buffered(s, netstrings))
+            else:
+                frames += len(read_frames(s, decoder))
+        calls += s.calls
+    elapsed = time.perf_counter() - start
+    print(f"{name:>15}: {frames / elapsed:12.0f} packets/s  {len(burst) * rounds / elapsed / 1e6:8.1f} MB/s  "
+          f"{calls / frames:6.2f} recv calls/packet")
+
+
+def main():
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], 'rb') as f:
+            burst = f.read()
+        measure('frames', burst)
+        try:
+            framing.NetstringDecoder().feed(burst)
+        except framing.FramingError:
+            return      # there are binary frames in it
+        measure('bytewise', burst)
+        measure('buffered', burst)
+        return
+
+    netstrings = made_up_burst()
+    for name in ('bytewise', 'buffered', 'frames'):
+        measure(name, netstrings)
+    measure('frames (binary)', made_up_burst(framed=framing.BINARY))
+
+
+if __name__ == '__main__':
+    main()
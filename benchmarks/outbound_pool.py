@@ -0,0 +1,53 @@
+"""
+Measures how long the end-of-tick flush takes with 1000 connected players each sent a typical tick's worth of
+packets, encrypting on the reactor thread and then on pools of threads and of processes of different sizes.
+
+    python -m benchmarks.outbound_pool [players=1000] [packets=5] [ticks=10]
+"""
+import statistics
+import sys
+import time
+
+from benchmarks import world
+
+
+def run(server, protos, packets: int, ticks: int) -> float:
+    from networking import packet
+    from server import protocol
+
+    times = []
+    for _ in range(ticks):
+        for proto in protos:
+            model = packet.ServerModelPacket('Instance', protocol.create_dict('Instance', proto.player_instance))
+            proto.outgoing.extend([model] * packets)
+        start = time.perf_counter()
+        if server.sendpool:
+            server.sendpool.flush(protos)
+        else:
+            for proto in protos:
+                proto.flush()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def main():
+    players = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    packets = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    ticks = int(sys.argv[3]) if len(sys.argv) > 3 else 10
+
+    # Players out of each other's sight, so only the flush is measured
+    server, protos = world.make_world(players, 0, spread=True)
+    from server.sendpool import SendPool
+
+    print(f"{players} players, {packets} packets each per tick")
+    print(f"{'reactor thread':>16}: median flush {run(server, protos, packets, ticks) * 1000:8.1f}ms")
+    for processes in (False, True):
+        for workers in (1, 2, 4, 8):
+            server.sendpool = SendPool(workers, processes)
+            median = run(server, protos, packets, ticks)
+            server.sendpool.close()
+            print(f"{workers:>2} {'processes' if processes else 'threads':<13}: median flush {median * 1000:8.1f}ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+"""
+The microbenchmarks run by `python -m benchmarks`. Each is registered with @benchmark and does its setup when
+called, returning the function to time. Anything a benchmark needs that isn't installed raises ImportError
+during setup and the benchmark is skipped.
+"""
+import functools
+from typing import *
+
+BENCHMARKS: Dict[str, Callable[[], Callable[[], Any]]] = {}
+
+
+def benchmark(name: str):
+    def register(setup: Callable[[], Callable[[], Any]]):
+        BENCHMARKS[name] = setup
+        return setup
+    return register
+
+
+# What the server sends most: an instance moving about
+INSTANCE = {
+    'id': 1042, 'entity': {'id': 517, 'typename': 'Player', 'name': 'josh'},
+    'room': 1, 'y': 40, 'x': 52, 'amount': 1, 'respawn_time': 0
+}
+
+
+@functools.lru_cache()
+def _keys():
+    import rsa
+    return rsa.newkeys(512)     # The size the game uses
+
+
+@functools.lru_cache()
+def _world():
+    from benchmarks import world
+    return world.make_world(players=50, items=50)
+
+
+@benchmark('packet.tobytes')
+def packet_tobytes():
+    from networking import packet
+    return packet.ServerModelPacket('Instance', INSTANCE).tobytes
+
+
+@benchmark('packet.frombytes')
+def packet_frombytes():
+    from networking import packet
+    data = packet.ServerModelPacket('Instance', INSTANCE).tobytes()
+    return lambda: packet.frombytes(data)
+
+
+@benchmark('Payload.serialize')
+def payload_serialize():
+    from networking.payload import Payload
+    return Payload(INSTANCE).serialize
+
+
+@benchmark('payload.deserialize')
+def payload_deserialize():
+    from networking import payload
+    serialized = payload.Payload(INSTANCE).serialize()
+    return lambda: payload.deserialize(serialized)
+
+
+@benchmark('cryptography.encrypt')
+def encrypt():
+    from networking import cryptography, packet
+    public_key, _ = _keys()
+    data = packet.ServerModelPacket('Instance', INSTANCE).tobytes()
+    return lambda: cryptography.encrypt(data, public_key)
+
+
+@benchmark('cryptography.decrypt')
+def decrypt():
+    from networking import cryptography, packet
+    public_key, private_key = _keys()
+    data = cryptography.encrypt(packet.ServerModelPacket('Instance', INSTANCE).tobytes(), public_key)
+    return lambda: cryptography.decrypt(data, private_key)
+
+
+@benchmark('Compressor.compress')
+def compress():
+    from networking import compression, packet
+    data = packet.ServerModelPacket('Instance', INSTANCE).tobytes()
+    return functools.partial(compression.Compressor().compress, data)
+
+
+@benchmark('Compressor.compress + Decompressor.decompress')
+def compress_decompress():
+    from networking import compression, packet
+    data = packet.ServerModelPacket('Instance', INSTANCE).tobytes()
+    compressor, decompressor = compression.Compressor(), compression.Decompressor()
+    # Each packet is decompressed against the ones before it, so keep the stream going rather than repeat one
+    return lambda: decompressor.decompress(compressor.compress(data))
+
+
+@benchmark('create_dict')
+def create_dict():
+    _, protos = _world()
+    from server import protocol
+    instance = protos[0].player_instance
+    return lambda: protocol.create_dict('Instance', instance)
+
+
+@benchmark('process_visible_instances (50 players, 50 items)')
+def process_visible_instances():
+    _, protos = _world()
+    proto = protos[0]
+
+    def run():
+        proto.process_visible_instances()
+        proto.outgoing.clear()
+    return run
+
+
+@benchmark('maps.Room.at')
+def room_at():
+    import maps
+    room = maps.Room(0, 'Forest', 'forest')
+    y, x = room.height // 2, room.width // 2
+    return lambda: room.at('solid', y, x)
+
+
+@benchmark('GameView.draw_map (Clear)')
+def draw_map_clear():
+    return _draw_map('Clear')
+
+
+@benchmark('GameView.draw_map (Rain)')
+def draw_map_rain():
+    return _draw_map('Rain')
+
+
+def _draw_map(weather: str):
+    from benchmarks import draw_map, fakecurses
+    fakecurses.install()
+    view = draw_map.make_view('forest', weather)
+    view.draw_map()     # Build the map layer first
+    return view.draw_map
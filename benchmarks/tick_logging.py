@@ -0,0 +1,45 @@
+"""
+Measures how long MoonlapseServer.tick takes with every player moving each tick, first with only INFO messages
+logged and then with DEBUG messages logged too. Log output goes nowhere so only the cost of logging is measured.
+
+    python -m benchmarks.tick_logging [players=20] [ticks=10]
+"""
+import io
+import logging
+import statistics
+import sys
+import time
+
+from benchmarks import world
+
+
+def run(players: int, ticks: int, level: int) -> float:
+    from networking import logger, packet
+
+    logger.configure(level)
+    logging.getLogger('moonlapse').handlers[0].stream = io.StringIO()
+
+    server, protos = world.make_world(players, players)
+    moves = (packet.MoveUpPacket, packet.MoveRightPacket, packet.MoveDownPacket, packet.MoveLeftPacket)
+
+    times = []
+    for t in range(ticks):
+        for i, proto in enumerate(protos):
+            proto.next_packet = moves[(t + i) % len(moves)](t)
+        start = time.perf_counter()
+        server.tick()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def main():
+    players = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    ticks = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+    for level in (logging.INFO, logging.DEBUG):
+        median = run(players, ticks, level)
+        print(f"{logging.getLevelName(level):>5}: median tick {median * 1000:8.2f}ms with {players} players moving")
+
+
+if __name__ == '__main__':
+    main()
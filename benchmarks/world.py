@@ -0,0 +1,128 @@
+"""
+A game world held in an in-memory database, with players connected through transports that go nowhere, for
+benchmarking the server without a database server or any sockets.
+"""
+import random
+import sys
+import types
+
+import django
+from django.conf import settings
+
+
+def setup_django():
+    if settings.configured:
+        return
+
+    settings.configure(
+        INSTALLED_APPS=['server'],
+        DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}}
+    )
+    django.setup()
+
+    # server.manage would connect to the real database from connectionstrings.json instead
+    sys.modules.setdefault('server.manage', types.ModuleType('server.manage'))
+
+    from django.apps import apps
+    from django.db import connection
+    with connection.schema_editor() as editor:
+        for model in apps.get_app_config('server').get_models():
+            editor.create_model(model)
+
+
+class FakeTransport:
+    """
+    Counts what a protocol writes instead of sending it anywhere.
+    """
+
+    def __init__(self):
+        self.written = 0
+        self.disconnecting = False
+
+    def write(self, data):
+        self.written += len(data)
+
+    def writeSequence(self, seq):
+        for data in seq:
+            self.write(data)
+
+    def loseConnection(self):
+        self.disconnecting = True
+
+    def abortConnection(self):
+        self.disconnecting = True
+
+    def getPeer(self):
+        from twisted.internet.address import IPv4Address
+        return IPv4Address('TCP', '127.0.0.1', 0)
+
+    def registerProducer(self, producer, streaming):
+        pass
+
+    def unregisterProducer(self):
+        pass
+
+
+def make_world(players: int, items: int, file_name: str = 'forest', seed: int = 0, spread: bool = False):
+    """
+    Creates a room with players logged in and items lying around, everything within a few tiles of each other
+    so they can all see each other.
+    :param spread: put the players anywhere in the room instead, so each sees only a few others
+    :return: the server, and the protocols of the players
+    """
+    setup_django()
+
+    import maps
+    from server import models, protocol
+    from server.mlserver import MoonlapseServer
+    from networking import cryptography
+
+    rng = random.Random(seed)
+    room = models.Room.objects.create(name=file_name.title(), file_name=file_name)
+    roommap = maps.Room(room.pk, room.name, room.file_name)
+    free = [(y, x) for y in range(roommap.height) for x in range(roommap.width)
+            if roommap.at('solid', y, x) == maps.NOTHING]
+    centre = free[len(free) // 2]
+    nearby = [pos for pos in free if abs(pos[0] - centre[0]) <= 8 and abs(pos[1] - centre[1]) <= 8]
+
+    server = MoonlapseServer()
+    server.load()
+    client_public_key, _ = cryptography.load_rsa_keypair(_client_dir())
+
+    beer = models.Entity.objects.create(typename='Item', name='Beer')
+    models.Item.objects.create(entity=beer, value=6)
+    for _ in range(items):
+        y, x = rng.choice(nearby)
+        instance = models.InstancedEntity.objects.create(entity=beer, room=room, y=y, x=x, respawn_time=5)
+        server.instances[instance.pk] = instance
+
+    protos = []
+    for i in range(players):
+        user = models.User.objects.create(username=f"bot{i}", password='')
+        entity = models.Entity.objects.create(typename='Player', name=user.username)
+        player = models.Player.objects.create(user=user, entity=entity, inventory=models.Container.objects.create())
+        y, x = rng.choice(free if spread else nearby)
+        instance = models.InstancedEntity.objects.create(entity=entity, room=room, y=y, x=x)
+        server.instances[instance.pk] = instance
+
+        proto = protocol.MoonlapseProtocol(server)
+        proto.makeConnection(FakeTransport())
+        proto.client_pub_key = client_public_key
+        proto.username = user.username
+        proto.player_info = player
+        proto.player_instance = instance
+        proto.roommap = roommap
+        proto.logged_in = True
+        proto.state = proto.PLAY
+        protos.append(proto)
+
+    for proto in protos:
+        proto.process_visible_instances()
+        proto.outgoing.clear()
+
+    return server, protos
+
+
+def _client_dir() -> str:
+    import os
+    return os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'client')
@@ -14,7 +14,7 @@ get_dependencies.install_requirements(parent)
 vpy = get_dependencies.get_vpy_from_root_dir(parent)
 if sys.executable != vpy:
     import subprocess
-    subprocess.run([vpy, parent] + sys.argv[1:])
+    subprocess.run([vpy] + get_dependencies.interpreter_flags() + [parent] + sys.argv[1:])
     exit()
 
 # From here on out, we have all the dependencies
@@ -10,20 +10,41 @@ class Controller:
         self.cs = cs
         self.view = None
         self.running = False
+        self.dirty = True       # whether the view needs redrawing
 
         self.widgets = []
 
     def start(self):
         self.running = True
+        self.dirty = True
         self.view.start()
+        last_frame = 0
 
         # begin main loop
         while self.running:
-            self._process_packet()
+            if self._process_packets():
+                self.dirty = True
+            if self.running and self._get_input():
+                self.dirty = True
+            if not self.running:
+                break
+
             self.update()
-            self.view._draw()
-            self.cs.stdscr.refresh()
-            self._get_input()
+
+            # Never draw faster than the server can change anything, and only draw when something did change
+            timeout = None
+            if self.dirty or self.animating():
+                frame_time = 1 / self.cs.ns.tickrate
+                now = time.monotonic()
+                timeout = last_frame + frame_time - now
+                if timeout <= 0:
+                    self.view._draw()
+                    self.cs.stdscr.refresh()
+                    self.dirty = False
+                    last_frame = now
+                    timeout = frame_time if self.animating() else None
+
+            self.cs.wait_for_events(timeout)
 
     def ready(self):
         pass
@@ -31,20 +52,42 @@ class Controller:
     def update(self):
         pass
 
-    def _process_packet(self):
-        if not self.cs.packets:
-            return
-
-        p = self.cs.packets.pop(0)
-        if not self.process_packet(p):
-            self.cs.packets.insert(0, p)
+    def animating(self) -> bool:
+        """
+        Whether the view changes by itself and so needs redrawing every frame, even when nothing happened.
+        """
+        return False
+
+    def _process_packets(self) -> bool:
+        """
+        Processes every packet waiting, stopping early at one this controller doesn't handle.
+        :return: True if any packet was processed
+        """
+        processed = False
+        while self.running and self.cs.packets:
+            p = self.cs.packets.popleft()
+            if not self.process_packet(p):
+                self.cs.packets.appendleft(p)
+                break
+            processed = True
+        return processed
 
     def process_packet(self, p) -> bool:
         pass
 
-    def _get_input(self):
-        key = self.cs.stdscr.getch()
-        self.process_input(key)
+    def _get_input(self) -> bool:
+        """
+        Processes every key press waiting.
+        :return: True if any key was pressed
+        """
+        pressed = False
+        while self.running:
+            key = self.cs.stdscr.getch()
+            if key == -1:
+                break
+            self.process_input(key)
+            pressed = True
+        return pressed
 
     def process_input(self, key: int):
         pass
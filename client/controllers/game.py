@@ -7,25 +7,11 @@ from client.views.gameview import GameView
 from networking import packet
 from networking.logger import Log
 from client.controllers.widgets import TextField
+from client.controllers.prediction import MovementPredictor
+from client.controllers.models import InstanceModel, PlayerModel, ContainerItemModel, EntityStore
 from client.controllers import keybindings
 
 
-class Model:
-    def __init__(self, attr: dict):
-        self.id = 0
-        for k, v in attr.items():
-            setattr(self, k, v)
-
-    def update(self, delta: dict):
-        if delta['id'] != self.id:
-            raise ValueError("Cannot change model's ID")
-        for k, v in delta.items():
-            setattr(self, k, v)
-
-    def __getitem__(self, item):
-        return self.__dict__[item]
-
-
 class Context:
     NORMAL = 0
     LOGOUT = 1
@@ -43,7 +29,7 @@ class Game(Controller):
         super().__init__(cs)
         self.chatbox = TextField(self, title="Say: ", max_length=80)
 
-        self.visible_instances = set()
+        self.visible_instances = EntityStore()
         self.player_info = None  # id, entity, inventory
         self.player_instance = None  # id, entity, room_id, y, x
         self.inventory = {}     # item.id : {id, item, amount}
@@ -57,6 +43,8 @@ class Game(Controller):
 
         self.weather = "Clear"
 
+        self.predictor = MovementPredictor(self)
+
         self.logger = Log()
         self.quicklog = ""      # line that appears above win1
 
@@ -77,9 +65,7 @@ class Game(Controller):
         elif isinstance(p, packet.GoodbyePacket):
             # Some instance has been removed from room (item picked up, player logged out, etc.)
             entityid: int = p.payloads[0].value
-            departed = next((e for e in self.visible_instances if e['id'] == entityid), None)
-            if departed:
-                self.visible_instances.remove(departed)
+            self.visible_instances.remove(entityid)
 
         elif isinstance(p, packet.WeatherChangePacket):
             self.weather = p.payloads[0].value
@@ -87,6 +73,10 @@ class Game(Controller):
         elif isinstance(p, packet.MoveRoomsPacket):
             self.context = Context.MOVE_ROOMS
 
+        elif isinstance(p, packet.MoveAckPacket):
+            if self.ready():
+                self.predictor.acknowledge(p.payloads[0].value, p.payloads[1].value, p.payloads[2].value)
+
         elif isinstance(p, packet.ServerLogPacket):
             self.logger.log(p.payloads[0].value)
 
@@ -99,39 +89,49 @@ class Game(Controller):
             else:
                 pass
         elif isinstance(p, packet.DenyPacket):
-            if self.state == State.GRABBING_ITEM:
+            if self.cs.ns.resume_failed:
+                # The session couldn't be resumed after reconnecting, so back to the main menu to say why
+                self.cs.ns.resume_failed = False
+                self.cs.packets.appendleft(p)
+                self.cs.change_controller("MainMenu")
+            elif self.state == State.GRABBING_ITEM:
                 self.quicklog = p.payloads[0].value
                 self.state = State.NORMAL
         elif isinstance(p, packet.ServerTickRatePacket):
-            pass
+            self.cs.ns.tickrate = p.payloads[0].value
 
         else:
             return False
 
         return True
 
+    def animating(self) -> bool:
+        # Rain splashes move every frame, and moves waiting to be acknowledged might need undoing at any time
+        return self.ready() and (self.weather == "Rain" or bool(self.predictor.pending))
+
     def initialise_my_models(self, mtype: str, data: dict):
         if mtype == 'Room':
             self.room = maps.Room(data['id'], data['name'], data['file_name'])
         elif mtype == 'Instance':
-            self.player_instance = Model(data)
+            self.player_instance = InstanceModel(data)
+            self.predictor.authoritative(self.player_instance.y, self.player_instance.x)
         elif mtype == 'Player':
-            self.player_info = Model(data)
+            self.player_info = PlayerModel(data)
 
     def process_model(self, mtype: str, data: dict):
         if mtype == 'Instance':
-            instance = Model(data)
-            visible_instance = next((e for e in self.visible_instances if e['id'] == instance['id']), None)
-            if visible_instance:  # If the incoming entity is already visible to us, update it
-                visible_instance.update(data)
-                # If the incoming entity is ours, update it
-                if instance.id == self.player_instance['id']:
-                    self.player_instance.update(data)
-            else:  # If not visible already, add to visible list (it is only ever sent to us if it's in view)
-                self.visible_instances.add(instance)
+            # If the incoming entity is already visible to us, update it. If not, add it (it is only ever sent
+            # to us if it's in view)
+            already_visible = data['id'] in self.visible_instances
+            self.visible_instances.upsert(data)
+
+            # If the incoming entity is ours, update it
+            if already_visible and data['id'] == self.player_instance.id:
+                self.player_instance.update(data)
+                self.predictor.authoritative(self.player_instance.y, self.player_instance.x)
 
         elif mtype == 'ContainerItem':
-            ci = Model(data)
+            ci = ContainerItemModel(data)
             itemid = ci['item']['id']
 
             amt = ci['amount']
@@ -145,13 +145,13 @@ class Game(Controller):
             self.inventory[itemid] = ci
 
     def update(self):
+        if self.ready() and self.predictor.expire():
+            self.dirty = True
+
         if self.state == State.LOOKING:
-            cpos = self.look_cursor_y, self.look_cursor_x
-            for instance in self.visible_instances:
-                pos = instance['y'], instance['x']
-                if cpos == pos:
-                    self.quicklog = instance['entity']['name']
-                    return
+            for instance in self.visible_instances.at(self.look_cursor_y, self.look_cursor_x):
+                self.quicklog = instance.entity['name']
+                return
             self.quicklog = ""
 
     def process_input(self, key: int):
@@ -176,6 +176,7 @@ class Game(Controller):
             self.chatbox.select()
         elif key == ord('q'):
             self.cs.ns.send_packet(packet.LogoutPacket(self.cs.ns.username))
+            self.cs.ns.resume_token = None
             self.context = Context.LOGOUT
         elif key == ord('k'):
             self.quicklog = ""
@@ -192,13 +193,13 @@ class Game(Controller):
 
     def process_normal_input(self, key: int) -> bool:
         if key == curses.KEY_UP:
-            self.cs.ns.send_packet(packet.MoveUpPacket())
+            self.move(packet.MoveUpPacket, -1, 0)
         elif key == curses.KEY_DOWN:
-            self.cs.ns.send_packet(packet.MoveDownPacket())
+            self.move(packet.MoveDownPacket, 1, 0)
         elif key == curses.KEY_LEFT:
-            self.cs.ns.send_packet(packet.MoveLeftPacket())
+            self.move(packet.MoveLeftPacket, 0, -1)
         elif key == curses.KEY_RIGHT:
-            self.cs.ns.send_packet(packet.MoveRightPacket())
+            self.move(packet.MoveRightPacket, 0, 1)
         elif key == ord('g'):
             self.state = State.GRABBING_ITEM
             self.cs.ns.send_packet(packet.GrabItemPacket())
@@ -230,10 +231,20 @@ class Game(Controller):
 
         return True
 
+    def move(self, packet_type: type, dy: int, dx: int):
+        if not self.ready():
+            self.cs.ns.send_packet(packet_type())
+            return
+
+        # Show the move straight away rather than waiting for the server to send our new position
+        seq = self.predictor.predict(dy, dx)
+        self.cs.ns.send_packet(packet_type(seq))
+
     def send_chat(self, message):
         self.cs.ns.send_packet(packet.ChatPacket(message))
 
     def reinitialize(self):
         self.room = None
         self.player_instance = None
-        self.visible_instances = set()
+        self.visible_instances = EntityStore()
+        self.predictor.reset()
@@ -48,6 +48,8 @@ class Menu(Controller):
             self.view.title = p.payloads[0].value
         elif isinstance(p, packet.ServerTickRatePacket):
             self.cs.ns.tickrate = p.payloads[0].value
+        elif isinstance(p, packet.QueuePositionPacket):
+            self.view.title = f"The server is busy. You are number {p.payloads[0].value} in the queue..."
         else:
             return False
 
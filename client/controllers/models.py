@@ -0,0 +1,106 @@
+from typing import *
+
+
+class Model:
+    """
+    A model sent from the server as a dictionary. Only the fields it declares are kept; anything else the
+    server sends along is ignored.
+    """
+    __slots__ = ('id',)
+    fields: Tuple[str, ...] = __slots__
+
+    def __init__(self, attr: dict):
+        for field in self.fields:
+            setattr(self, field, None)
+        self.id = 0
+
+        for k, v in attr.items():
+            if k in self.fields:
+                setattr(self, k, v)
+
+    def update(self, delta: dict):
+        if delta['id'] != self.id:
+            raise ValueError("Cannot change model's ID")
+        for k, v in delta.items():
+            if k in self.fields:
+                setattr(self, k, v)
+
+    def __getitem__(self, item):
+        try:
+            return getattr(self, item)
+        except AttributeError:
+            raise KeyError(item)
+
+
+class InstanceModel(Model):
+    __slots__ = ('entity', 'room', 'y', 'x', 'amount', 'respawn_time')
+    fields = Model.fields + __slots__
+
+
+class PlayerModel(Model):
+    __slots__ = ('user', 'entity', 'inventory')
+    fields = Model.fields + __slots__
+
+
+class ContainerItemModel(Model):
+    __slots__ = ('container', 'item', 'amount')
+    fields = Model.fields + __slots__
+
+
+class EntityStore:
+    """
+    The instances visible to the player, indexed both by id and by the tile they're standing on so that
+    looking one up stays cheap however crowded the room is.
+    """
+
+    def __init__(self):
+        self._by_id: Dict[int, InstanceModel] = {}
+        self._by_pos: Dict[Tuple[int, int], Dict[int, InstanceModel]] = {}
+
+    def __iter__(self) -> Iterator[InstanceModel]:
+        return iter(self._by_id.values())
+
+    def __len__(self) -> int:
+        return len(self._by_id)
+
+    def __contains__(self, instanceid: int) -> bool:
+        return instanceid in self._by_id
+
+    def get(self, instanceid: int) -> Optional[InstanceModel]:
+        return self._by_id.get(instanceid)
+
+    def at(self, y: int, x: int) -> Iterable[InstanceModel]:
+        """
+        :return: every instance standing at the given position, in the order they came into view
+        """
+        here = self._by_pos.get((y, x))
+        return here.values() if here else ()
+
+    def upsert(self, data: dict) -> InstanceModel:
+        """
+        Updates the instance with data if it's already visible, otherwise adds a new one.
+        :return: the instance
+        """
+        instance = self._by_id.get(data['id'])
+        if instance:
+            self._unindex(instance)
+            instance.update(data)
+        else:
+            instance = InstanceModel(data)
+            self._by_id[instance.id] = instance
+        self._by_pos.setdefault((instance.y, instance.x), {})[instance.id] = instance
+        return instance
+
+    def remove(self, instanceid: int) -> Optional[InstanceModel]:
+        instance = self._by_id.pop(instanceid, None)
+        if instance:
+            self._unindex(instance)
+        return instance
+
+    def _unindex(self, instance: InstanceModel):
+        pos = instance.y, instance.x
+        here = self._by_pos.get(pos)
+        if here:
+            here.pop(instance.id, None)
+            if not here:
+                del self._by_pos[pos]
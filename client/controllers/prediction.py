@@ -0,0 +1,102 @@
+import time
+from collections import deque
+from typing import *
+
+import maps
+
+
+class MovementPredictor:
+    """
+    Moves the player as soon as an arrow key is pressed instead of waiting for the server to send the player's
+    new position back. Every move is numbered and kept until the server acknowledges it with a MoveAckPacket
+    saying where the player really ended up. The shown position is always the server's latest position with
+    the unacknowledged moves replayed on top, so whenever the server disagrees (a portal, a resource node, a
+    move it never got to) the player snaps back to where the server put them.
+    """
+
+    TIMEOUT = 2     # seconds to wait for a move to be acknowledged before giving up on it
+
+    def __init__(self, game):
+        self.game = game
+        self.seq = 0
+        self.pending: Deque[Tuple[int, int, int, float]] = deque()      # seq, dy, dx, time sent
+
+        # Where the server last said the player is
+        self.server_y: Optional[int] = None
+        self.server_x: Optional[int] = None
+
+    def predict(self, dy: int, dx: int) -> int:
+        """
+        Moves the player straight away, if the move looks possible.
+        :return: the sequence number to send with the move
+        """
+        self.seq += 1
+        self.pending.append((self.seq, dy, dx, time.monotonic()))
+
+        instance = self.game.player_instance
+        instance.y, instance.x = self.step(instance.y, instance.x, dy, dx)
+        return self.seq
+
+    def acknowledge(self, seq: int, y: int, x: int):
+        while self.pending and self.pending[0][0] <= seq:
+            self.pending.popleft()
+        self.authoritative(y, x)
+
+    def authoritative(self, y: int, x: int):
+        """
+        Takes the server's word on where the player is, then replays any moves it hasn't processed yet.
+        """
+        self.server_y, self.server_x = y, x
+        self.reconcile()
+
+    def expire(self) -> bool:
+        """
+        Forgets moves which have gone unacknowledged for too long; the server must have dropped them.
+        :return: True if the player's position changed
+        """
+        now = time.monotonic()
+        expired = False
+        while self.pending and now - self.pending[0][3] > MovementPredictor.TIMEOUT:
+            self.pending.popleft()
+            expired = True
+
+        if not expired:
+            return False
+
+        instance = self.game.player_instance
+        before = instance.y, instance.x
+        self.reconcile()
+        return (instance.y, instance.x) != before
+
+    def reconcile(self):
+        if self.server_y is None:
+            return
+
+        y, x = self.server_y, self.server_x
+        for _, dy, dx, _ in self.pending:
+            y, x = self.step(y, x, dy, dx)
+
+        instance = self.game.player_instance
+        instance.y, instance.x = y, x
+
+    def step(self, y: int, x: int, dy: int, dx: int) -> Tuple[int, int]:
+        """
+        Where the server will most likely put the player after a move, using the same rules as the server.
+        """
+        desired_y, desired_x = y + dy, x + dx
+
+        for instance in self.game.visible_instances.at(desired_y, desired_x):
+            # Portals take us who knows where and resource nodes start gathering instead. Stay put and let the
+            # server tell us what happened.
+            if instance.entity['typename'] in ("Portal", "OreNode", "TreeNode"):
+                return y, x
+
+        room = self.game.room
+        if 0 <= desired_y < room.height and 0 <= desired_x < room.width \
+                and room.at('solid', desired_y, desired_x) == maps.NOTHING:
+            return desired_y, desired_x
+        return y, x
+
+    def reset(self):
+        self.pending.clear()
+        self.server_y, self.server_x = None, None
@@ -2,9 +2,15 @@ import curses
 import json
 import os
 import random
+import select
+import socket
 import string
+import sys
 import threading
 import time
+import zlib
+from collections import deque
+from typing import *
 
 from networking import cryptography
 import rsa
@@ -12,102 +18,202 @@ import rsa
 from client.controllers.game import Game
 from client.controllers import menus
 from client.views.view import Window
-from networking import packet
+from networking import compression, packet, framing
 
 
 class NetworkState:
     """
     Higher level abstraction for keeping network state. Keeps public_key and socket in neat spot.
     """
+    RECV_SIZE = 65536
+    RESUME_SECONDS = 30     # to keep trying to reconnect for, which is how long the server holds the session
 
     def __init__(self, socket):
         self.socket = socket
+        self.address = socket.getpeername()
         self.server_public_key = None
         self.username = ""
         self.tickrate = 20
 
+        # The server's token for picking up where we left off if the connection drops, once logged in
+        self.resume_token: Optional[str] = None
+        self.resuming = False       # whether we've reconnected and are waiting to hear if the session's resumed
+        self.resume_failed = False  # whether the server refused to resume the session
+
+        # Packets are sent from the main thread and, while reconnecting, the network thread
+        self._send_lock = threading.Lock()
+
+        self._decoder = framing.FrameDecoder(size=NetworkState.RECV_SIZE)
+        self._framing: Optional[str] = None     # what we send with once the server says it can read it
+
+        # One stream each way per connection. We compress once the server's said it will, but it might at any time
+        self._compressor: Optional[compression.Compressor] = None
+        self._decompressor = compression.Decompressor()
+
+        # Everything received is also appended to this file if set, to be replayed by benchmarks.netstring
+        self._capture = None
+        capture_filename = os.environ.get('MOONLAPSE_CAPTURE')
+        if capture_filename:
+            self._capture = open(capture_filename, 'ab', buffering=0)
+
         # get encryption keys for sending
         clientdir = os.path.dirname(os.path.realpath(__file__))
         self.my_public_key, self.my_private_key = cryptography.load_rsa_keypair(clientdir)
 
         # Send the server our public key
-        self.send_packet(packet.ClientKeyPacket(self.my_public_key.n, self.my_public_key.e))
+        self.send_packet(self.client_key_packet())
+
+    def client_key_packet(self) -> packet.ClientKeyPacket:
+        return packet.ClientKeyPacket(self.my_public_key.n, self.my_public_key.e, compression.SUPPORTED,
+                                      framing.SUPPORTED)
 
     def send_packet(self, p: packet.Packet):
         """
         Converts packet to bytes; then encrypts bytes; then converts to netstring; then send over socket
         :param p: packet to send
         """
-        self._send(p, self.socket, public_key=self.server_public_key)
+        with self._send_lock:
+            try:
+                self._send(p, self.socket, public_key=self.server_public_key)
+            except OSError:
+                pass    # The connection's dropped, and the network thread will reconnect if it can
 
-    def receive_packet(self) -> packet.Packet:
+    def reconnect(self) -> bool:
+        """
+        Connects to the server again after the connection dropped, and starts the key exchange, after which
+        intercept asks to resume the session. Keeps trying for up to RESUME_SECONDS.
+        :return: whether it reconnected
+        """
+        give_up = time.monotonic() + NetworkState.RESUME_SECONDS
+        delay = 0.25
+        while time.monotonic() < give_up:
+            try:
+                s = socket.create_connection(self.address, timeout=10)
+            except OSError:
+                time.sleep(delay)
+                delay = min(delay * 2, 4)
+                continue
+            with self._send_lock:
+                self.socket.close()
+                self.socket = s
+                self._decoder = framing.FrameDecoder(size=NetworkState.RECV_SIZE)
+                self._framing = None
+                self._compressor = None
+                self._decompressor = compression.Decompressor()
+                self.resuming = True
+                self._send(self.client_key_packet(), s)
+            return True
+        return False
+
+    def intercept(self, packets: List[packet.Packet]) -> List[packet.Packet]:
+        """
+        Picks out of what's been received the packets about the connection itself, i.e. pings and resuming the
+        session, which the network thread deals with itself rather than the controllers.
+        :return: the rest of the packets
+        """
+        rest = []
+        for p in packets:
+            if isinstance(p, packet.PingPacket):
+                # Answered straight away, so the server measures the network rather than the game loop
+                self.send_packet(packet.PongPacket(p.payloads[0].value))
+            elif isinstance(p, packet.ResumeTokenPacket):
+                self.resume_token = p.payloads[0].value
+                self.resuming = False
+            elif not self.resuming:
+                rest.append(p)
+            elif isinstance(p, packet.ClientKeyPacket):
+                # The server's answered the key exchange on the new connection, so it's ready for the token
+                self.server_public_key = rsa.PublicKey(p.payloads[0].value, p.payloads[1].value)
+                self.send_packet(packet.ResumePacket(self.resume_token))
+            elif isinstance(p, packet.DenyPacket):
+                self.resuming = False
+                self.resume_token = None
+                self.resume_failed = True
+                rest.append(p)
+            elif isinstance(p, packet.ServerTickRatePacket):
+                self.tickrate = p.payloads[0].value
+        return rest
+
+    def receive_packets(self) -> List[packet.Packet]:
         return self._receive(self.socket)
 
-    def _to_netstring(self, data: bytes) -> bytes:
-        length = len(data)
-        return str(length).encode('ascii') + b':' + data + b','
+    def _frame(self, data: bytes) -> bytes:
+        return framing.frame(data, self._framing)
 
     def _send(self, p: packet.Packet, s, public_key=None) -> bytes:
         """
-        Converts a Packet to bytes and sends it over a socket. Ensures all the data is sent and no more.
+        Converts a Packet to bytes, compressed if the server agreed to, and sends it over a socket in a netstring or,
+        once the server's said it can read them, a binary frame. Ensures all the data is sent and no more.
         """
         b = p.tobytes()
         if not isinstance(p, packet.ClientKeyPacket):   # Don't encrypt the sending of our public key
+            if self._compressor:
+                b = self._compressor.compress(b)
             try:
                 b = cryptography.encrypt(b, public_key)
             except Exception:   # TODO: If public key is None, request it to be sent again
                 return b''
-        b = self._to_netstring(b)
+        b = self._frame(b)
 
         failure = s.sendall(b)
         if failure is not None:
             self._send(p, s, public_key=public_key)
         return b
 
-    def _receive(self, s) -> packet.Packet:
+    def _receive(self, s) -> List[packet.Packet]:
         """
-        Receives a netstring bytes over a socket. Ensure all data is received and no more. Then
-        converts the data into the original Packet (preserving the exact type from the ones defined
-        in this module) and original payloads depickled as python objects.
+        Receives whatever framed bytes are available over a socket, in one go, straight into the decoder's buffer,
+        and converts every frame completed by them back into the original Packet (preserving the exact type from
+        the ones defined in this module) with its original payloads depickled as python objects. Partial frames
+        are kept until the rest arrives on a later call.
 
         Arguments:
-            s {socket.socket} -- The socket to receive netstring-encoded packets over.
+            s {socket.socket} -- The socket to receive framed packets over.
 
         Raises:
-            PacketParseError: If the netstring is too long or there was an error reading the length of the
-                              netstring.
+            PacketParseError: If the stream doesn't contain valid frames.
+            ConnectionError: If the server closed the connection.
 
         Returns:
-            Packet -- The original Packet that was sent with the exact subtype preserved. All original
-                      payloads associated are depickled as python objects.
+            List[Packet] -- The packets completed, in the order they were sent. Could be empty.
         """
-        length: bytes = b''
-        while len(length) <= len(str(packet.Packet.MAX_LENGTH)):
-            c: bytes = s.recv(1)
-            if c != b':':
-                try:
-                    int(c)
-                except ValueError:
-                    raise PacketParseError(
-                        f"Error reading packet length. So far got {length} but next digit came in as {c}.")
-                else:
-                    length += c
-            else:
-                if len(length) < 1:
-                    raise PacketParseError(f"Parsing packet but length doesn't seem to be a number. Got {length}.")
-                data: bytes = s.recv(int(length))
-
-                # Perhaps all the data is not received yet
-                while len(data) < int(length):
-                    nextLength = int(length) - len(data)
-                    data += s.recv(nextLength)
-
-                # Read off the trailing comma
-                s.recv(1)
-                data = cryptography.decrypt(data, self.my_private_key)
-                return packet.frombytes(data)
-
-        raise PacketParseError("Error reading packet length. Too long.")
+        with self._decoder.space() as view:
+            n = s.recv_into(view)
+            if self._capture:
+                self._capture.write(view[:n])
+        if not n:
+            raise ConnectionError("Connection closed by the server.")
+        self._decoder.received(n)
+
+        try:
+            frames = self._decoder.frames()
+        except framing.FramingError as e:
+            raise PacketParseError(str(e))
+
+        packets = []
+        for frame in frames:
+            try:
+                data = cryptography.decrypt(frame, self.my_private_key)
+            except Exception:
+                continue    # Lose this packet but not the ones which came with it
+            try:
+                data = self._decompressor.decompress(data)
+            except zlib.error as e:
+                # The rest of the stream depends on this packet, so there's no reading any more of it
+                raise ConnectionError(f"Couldn't decompress a packet from the server: {e}")
+            try:
+                p = packet.frombytes(data)
+            except Exception:
+                continue
+            if isinstance(p, packet.ClientKeyPacket):
+                # Anything we send after this can be compressed and framed as the server chose
+                with self._send_lock:
+                    if p.payloads[2].value:
+                        self._compressor = compression.Compressor()
+                    self._framing = p.payloads[3].value
+            if p:
+                packets.append(p)
+        return packets
 
 
 class PacketParseError(Exception):
@@ -123,7 +229,15 @@ class ClientState:
 
         self.window = Window(self.stdscr, 0, 0, 40, 106)
 
-        self.packets = []
+        self.packets = deque()      # appended to by the network thread, popped from the left by the controller
+
+        # The network thread writes to this pipe to wake up the main loop when packets arrive. Windows can't
+        # select on the console, so the main loop polls there instead.
+        self._wakeup_r, self._wakeup_w = None, None
+        if os.name != 'nt':
+            self._wakeup_r, self._wakeup_w = os.pipe()
+            os.set_blocking(self._wakeup_r, False)
+            os.set_blocking(self._wakeup_w, False)
 
         # Listen for data in its own thread
         threading.Thread(target=self._receive_data, daemon=True).start()
@@ -163,10 +277,46 @@ class ClientState:
 
         self.controller.start()
 
+    def wait_for_events(self, timeout: Optional[float]):
+        """
+        Blocks until a key is pressed or a packet arrives.
+        :param timeout: the longest to wait in seconds, or None to wait for as long as it takes
+        """
+        if self._wakeup_r is None:
+            time.sleep(timeout if timeout is not None else 1 / self.ns.tickrate)
+            return
+
+        readable, _, _ = select.select([sys.stdin, self._wakeup_r], [], [], timeout)
+        if self._wakeup_r in readable:
+            try:
+                os.read(self._wakeup_r, 4096)
+            except BlockingIOError:
+                pass
+
+    def _wake(self):
+        if self._wakeup_w is None:
+            return
+        try:
+            os.write(self._wakeup_w, b'\0')
+        except BlockingIOError:
+            pass    # The pipe is full so the main loop is bound to wake up anyway
+
     def _receive_data(self):
         while self.running:
             try:
-                p = self.ns.receive_packet()
-                self.packets.append(p)
+                packets = self.ns.intercept(self.ns.receive_packets())
+            except ConnectionError:
+                if not self.running or not self.ns.resume_token:
+                    break
+                self.packets.append(packet.ServerLogPacket("Lost connection to the server. Reconnecting..."))
+                self._wake()
+                if not self.ns.reconnect():
+                    self.packets.append(packet.ServerLogPacket("Couldn't reconnect to the server."))
+                    self._wake()
+                    break
+                continue
             except Exception as e:
-                pass
+                continue
+            if packets:
+                self.packets.extend(packets)
+                self._wake()
@@ -1,9 +1,9 @@
 import curses
 import random
 import time
-from typing import Dict
+from typing import Dict, Optional
 
-import maps
+from client.views.maplayer import MapLayer
 from client.views.view import View, Window
 import client.controllers.game as game
 
@@ -14,6 +14,9 @@ class GameView(View):
         self.visible_log: Dict[float, str] = {}
         self.times_logged: int = 0
 
+        self.maplayer: Optional[MapLayer] = None
+        self._rain = random.Random()
+
         # Init windows
         self.win1 = Window(self.controller.cs.stdscr, 3, 0, 23, 53)
         self.win2 = Window(self.controller.cs.stdscr, 3, 53, 23, 53)
@@ -53,44 +56,30 @@ class GameView(View):
         win1_hwidth, win1_hheight = self.win1.width // 2, self.win1.height // 2
         room = self.controller.room
 
+        # The terrain never changes so it is only worked out once per room
+        if self.maplayer is None or self.maplayer.room is not room:
+            self.maplayer = MapLayer(room)
+        layer = self.maplayer
+
+        py, px = self.controller.player_instance['y'], self.controller.player_instance['x']
+        raining = self.controller.weather == "Rain"
+
         for row in range(-view_radius, view_radius + 1):
-            for col in range(-view_radius, view_radius + 1):
-                pos = (self.controller.player_instance['y'] + row, self.controller.player_instance['x'] + col)
-                random.seed(hash(pos))
-
-                if self.coordinate_exists(*pos):
-                    cy, cx = win1_hheight + row, win1_hwidth + col * 2
-                    for what in ('ground', 'solid'):
-                        c = room.at(what, *pos)
-
-                        if c == maps.STONE:
-                            self.win1.addstr(cy, cx, '·', 0)
-                        elif c == maps.GRASS:
-                            self.win1.addstr(cy, cx, random.choice([',', '`']), curses.COLOR_GREEN)
-                        elif c == maps.SAND:
-                            self.win1.addstr(cy, cx, '~', curses.COLOR_YELLOW)
-                        elif c == maps.WATER:
-                            self.win1.addstr(cy, cx, '#', curses.COLOR_BLUE)
-                        elif c == maps.LEAF:
-                            self.win1.addstr(cy, cx, random.choice(['╭', '╮', '╯', '╰']), curses.COLOR_GREEN)
-                        elif c == maps.COBBLESTONE:
-                            self.win1.addstr(cy, cx, '░', 0)
-                        elif c == maps.WOOD:
-                            self.win1.addstr(cy, cx, '·', curses.COLOR_YELLOW)
-
-                    # rain splashes
-                    if self.controller.weather == "Rain":
-                        random.seed()
-                        if room.at('ground', pos[0], pos[1]) and room.at('ceiling', pos[0], pos[1]) == maps.NOTHING:
-                            if random.randrange(0, 8) == 0:
-                                self.win1.addstr(cy, cx, random.choice([',', '.', '`']), curses.COLOR_BLUE)
-
-                    # Overrides: Enter in here if solid must look different from ground, for example
-                    c = room.at('solid', *pos)
-                    if c == maps.STONE:
-                        self.win1.addstr(cy, cx, '█', 0)
-                    elif c == maps.WOOD:
-                        self.win1.addstr(cy, cx, '◍', curses.COLOR_YELLOW)
+            y = py + row
+            if not 0 <= y < room.height:
+                continue
+
+            cy = win1_hheight + row
+            for offset, s, colour in layer.runs(y, px - view_radius, px + view_radius):
+                self.win1.addstr(cy, win1_hwidth + (offset - view_radius) * 2, s, colour)
+
+            # rain splashes
+            if raining:
+                exposed = layer.exposed[y]
+                for col in range(-view_radius, view_radius + 1):
+                    x = px + col
+                    if 0 <= x < room.width and exposed[x] and self._rain.randrange(0, 8) == 0:
+                        self.win1.addstr(cy, win1_hwidth + col * 2, self._rain.choice([',', '.', '`']), curses.COLOR_BLUE)
 
         # Draw entities
         for e in self.controller.visible_instances:
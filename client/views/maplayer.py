@@ -0,0 +1,98 @@
+import curses
+import random
+from typing import *
+
+import maps
+
+
+class MapLayer:
+    """
+    The static part of a room as it appears on screen: one (glyph, colour) pair per tile, plus whether the
+    tile is open to the sky. Built once per room so drawing the map is a matter of slicing the visible
+    window out of the layer instead of reading the map images and picking glyphs every frame.
+    """
+
+    def __init__(self, room: maps.Room):
+        self.room = room
+
+        # cells[y][x] is (glyph, colour), or None where nothing is drawn
+        self.cells: List[List[Optional[Tuple[str, int]]]] = []
+
+        # exposed[y][x] is True where rain can splash on the tile
+        self.exposed: List[List[bool]] = []
+
+        self._build()
+
+    def _build(self):
+        room = self.room
+        for y in range(room.height):
+            cells_row = []
+            exposed_row = []
+            for x in range(room.width):
+                # Same seed as the tile has always used so grass and leaves keep their look
+                random.seed(hash((y, x)))
+
+                cell = None
+                for what in ('ground', 'solid'):
+                    cell = self._glyph(room.at(what, y, x)) or cell
+
+                # Overrides: Enter in here if solid must look different from ground, for example
+                solid = room.at('solid', y, x)
+                if solid == maps.STONE:
+                    cell = ('█', 0)
+                elif solid == maps.WOOD:
+                    cell = ('◍', curses.COLOR_YELLOW)
+
+                cells_row.append(cell)
+                exposed_row.append(room.at('ceiling', y, x) == maps.NOTHING and solid not in (maps.STONE, maps.WOOD))
+
+            self.cells.append(cells_row)
+            self.exposed.append(exposed_row)
+
+        # Don't leave the shared generator seeded with the last tile
+        random.seed()
+
+    @staticmethod
+    def _glyph(c: Tuple[int, int, int]) -> Optional[Tuple[str, int]]:
+        if c == maps.STONE:
+            return '·', 0
+        elif c == maps.GRASS:
+            return random.choice([',', '`']), curses.COLOR_GREEN
+        elif c == maps.SAND:
+            return '~', curses.COLOR_YELLOW
+        elif c == maps.WATER:
+            return '#', curses.COLOR_BLUE
+        elif c == maps.LEAF:
+            return random.choice(['╭', '╮', '╯', '╰']), curses.COLOR_GREEN
+        elif c == maps.COBBLESTONE:
+            return '░', 0
+        elif c == maps.WOOD:
+            return '·', curses.COLOR_YELLOW
+        return None
+
+    def runs(self, y: int, x0: int, x1: int) -> Iterator[Tuple[int, str, int]]:
+        """
+        Yields the tiles of row y between columns x0 and x1 (inclusive) as runs of the same colour, ready to be
+        drawn with a single addstr each. Tiles are spaced two screen columns apart, as in the map window.
+        :return: (offset of the run's first tile from x0, string to draw, colour) for each run
+        """
+        row = self.cells[y]
+        start, glyphs, colour = 0, [], None
+        for x in range(max(x0, 0), min(x1, self.room.width - 1) + 1):
+            cell = row[x]
+            if cell is None:
+                if glyphs:
+                    yield start, ' '.join(glyphs), colour
+                    glyphs = []
+                continue
+
+            glyph, c = cell
+            if glyphs and c == colour:
+                glyphs.append(glyph)
+            else:
+                if glyphs:
+                    yield start, ' '.join(glyphs), colour
+                start, glyphs, colour = x - x0, [glyph], c
+
+        if glyphs:
+            yield start, ' '.join(glyphs), colour
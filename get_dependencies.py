@@ -1,3 +1,4 @@
+import hashlib
 import os
 import os.path
 import subprocess
@@ -163,6 +164,41 @@ def get_vpy_from_root_dir(rootdir):
     return vpy
 
 
+STAMP_FILENAME = '.requirements-stamp'
+
+
+def requirements_stamp(rootdir, dependencies) -> str:
+    """
+    A hash of what the virtual environment should have: the requirements installed on it, and the version of Python
+    it was made with (read from its pyvenv.cfg). Empty if there's no virtual environment.
+    """
+    try:
+        with open(os.path.join(get_vdir_from_root_dir(rootdir), 'pyvenv.cfg'), 'r') as f:
+            cfg = f.read().splitlines()
+    except OSError:
+        return ''
+    version = [line.strip() for line in cfg if line.split('=')[0].strip() in ('version', 'version_info')]
+    return hashlib.sha256('\n'.join(dependencies + version).encode('utf-8')).hexdigest()
+
+
+def read_stamp(rootdir) -> str:
+    try:
+        with open(os.path.join(get_vdir_from_root_dir(rootdir), STAMP_FILENAME), 'r') as f:
+            return f.read().strip()
+    except OSError:
+        return ''
+
+
+def interpreter_flags() -> list:
+    """
+    Flags to re-run the module in the virtual environment with. Set MOONLAPSE_IMPORT_TIME=1 to have Python print
+    how long every import takes (to stderr) and see where startup time goes.
+    """
+    if os.environ.get('MOONLAPSE_IMPORT_TIME'):
+        return ['-X', 'importtime']
+    return []
+
+
 def configure_venv(rootdir):
     # Install a virtual environment with pip installed on it
     compatible = True
@@ -178,7 +214,7 @@ def configure_venv(rootdir):
         builder.create(get_vdir_from_root_dir(rootdir))
 
     # Re-run with the new environment now that pip is installed
-    subprocess.run([get_vpy_from_root_dir(rootdir), rootdir] + sys.argv[1:])
+    subprocess.run([get_vpy_from_root_dir(rootdir)] + interpreter_flags() + [rootdir] + sys.argv[1:])
     exit()
 
 
@@ -198,6 +234,12 @@ def install_requirements(module_path):
         for s in winstrs:
             dependencies.remove(s)
 
+    # Checking the virtual environment takes a few subprocesses and seconds, so don't if the requirements are
+    # the same as when it was last set up
+    stamp = requirements_stamp(rootdir, dependencies)
+    if stamp and os.path.exists(vpy) and read_stamp(rootdir) == stamp:
+        return
+
     if not venv_exists(vpy):
         configure_venv(rootdir)
     elif not pip_installed(vpy):
@@ -207,8 +249,15 @@ def install_requirements(module_path):
         shutil.rmtree(vdir)
         configure_venv(rootdir)
 
+    installed = True
     for d in missing_dependencies(rootdir, dependencies):
         r = subprocess.run([vpy, '-m', 'pip', 'install', d])
+        installed = installed and r.returncode == 0
+
+    # Only skip the checks next time if everything installed
+    if installed:
+        with open(os.path.join(vdir, STAMP_FILENAME), 'w') as f:
+            f.write(requirements_stamp(rootdir, dependencies))
 
 
 
@@ -0,0 +1,11 @@
+"""
+Load testing for the server: a headless client which speaks the real protocol, and a runner which connects
+thousands of scripted bots to a server to see how many players it can hold. See loadtest/__main__.py.
+"""
+# Required to import from shared modules
+import sys
+from pathlib import Path
+
+root = Path(__file__).resolve().parents[1]
+if str(root) not in sys.path:
+    sys.path.append(str(root))
@@ -0,0 +1,218 @@
+"""
+Connects scripted bots to a server, a few at a time, and reports once a second how the server is coping:
+
+    python -m loadtest [--bots 1000] [--ramp 20] [--procs 4] [--duration 300] [--no-compression]
+                       [--spawn-server [--shards N] [--frontends M] | --server-pid PID]
+
+Run it against a local server using the SQLite debug database ("debug": true in server/connectionstrings.json)
+which has had `python server/manage.py loaddata` run on it, and started with --login-rate 0 as the bots all connect
+from one address. Bots are called bot0, bot1... and register the first time they connect. Each line reports:
+    bots        how many bots are in the game, out of how many have connected
+    in/out      packets and kilobytes per second received from and sent to the server, across all bots
+    ack         percentiles of the time from sending a move to receiving its MoveAckPacket. The server handles
+                one packet per player per tick, so this is about half a tick when the server is keeping up and
+                grows as ticks start to overrun.
+    cpu         the server's CPU usage (including any processes it started), with --spawn-server or --server-pid
+"""
+import argparse
+import multiprocessing
+import os
+import queue
+import signal
+import socket
+import subprocess
+import sys
+import time
+from typing import *
+
+from loadtest import root
+from loadtest.bots import run_worker
+
+
+class ProcessCPU:
+    """
+    Measures the CPU usage of a process and its children from /proc (so only on Linux).
+    """
+
+    def __init__(self, pid: int):
+        self.pid = pid
+        self.ticks_per_second = os.sysconf('SC_CLK_TCK')
+        self.last_ticks = self.ticks()
+        self.last_time = time.monotonic()
+
+    def ticks(self) -> int:
+        total = 0
+        for pid in self.tree(self.pid):
+            try:
+                with open(f"/proc/{pid}/stat") as f:
+                    # The command name can have spaces in it, so split after it. utime and stime follow.
+                    fields = f.read().rsplit(')', 1)[1].split()
+                total += int(fields[11]) + int(fields[12])
+            except (OSError, IndexError):
+                pass
+        return total
+
+    def tree(self, pid: int) -> List[int]:
+        pids = [pid]
+        try:
+            for tid in os.listdir(f"/proc/{pid}/task"):
+                with open(f"/proc/{pid}/task/{tid}/children") as f:
+                    for child in f.read().split():
+                        pids += self.tree(int(child))
+        except OSError:
+            pass
+        return pids
+
+    def percent(self) -> float:
+        """
+        :return: CPU usage since the last call, where 100 means one core fully used
+        """
+        ticks, now = self.ticks(), time.monotonic()
+        used = (ticks - self.last_ticks) / self.ticks_per_second / (now - self.last_time)
+        self.last_ticks, self.last_time = ticks, now
+        return used * 100
+
+
+def percentile(samples: List[float], p: float) -> float:
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+
+def spawn_server(address: Tuple[str, int], shards: Optional[int] = None, frontends: Optional[int] = None,
+                 timeout: float = 300) -> subprocess.Popen:
+    """
+    Starts a server and waits until it's listening on address, which takes a while the first time as it sets up
+    its virtual environment.
+    """
+    env = dict(os.environ, MOONLAPSE_LOG_LEVEL='WARNING')
+    # All the bots come from this machine, so they'd soon use up one address's allowance of logins
+    args = [sys.executable, str(root / 'server'), '--login-rate', '0']
+    if shards:
+        args += ['--shards', str(shards)]
+    if frontends:
+        args += ['--frontends', str(frontends)]
+    # In a session of its own, so stop_server can stop the server which it re-runs itself as in its virtual
+    # environment, and any workers and front-ends, rather than just the process started here
+    server = subprocess.Popen(args, env=env, start_new_session=os.name != 'nt')
+
+    give_up = time.monotonic() + timeout
+    while True:
+        if server.poll() is not None:
+            raise RuntimeError(f"The server exited with status {server.returncode} before it started listening")
+        try:
+            socket.create_connection(address, timeout=1).close()
+            return server
+        except OSError:
+            if time.monotonic() > give_up:
+                stop_server(server)
+                raise RuntimeError(f"The server wasn't listening on {address[0]}:{address[1]} after {timeout:.0f}s")
+            time.sleep(0.25)
+
+
+def stop_server(server: subprocess.Popen):
+    if os.name == 'nt':
+        server.terminate()
+        return
+    try:
+        os.killpg(server.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        pass    # it's already gone
+    server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m loadtest', description="Load test a MoonlapseMUD server.")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=42523)
+    parser.add_argument('--bots', type=int, default=100, help="how many bots to connect in total")
+    parser.add_argument('--ramp', type=float, default=10, help="how many bots to connect per second")
+    parser.add_argument('--procs', type=int, default=os.cpu_count() or 1,
+                        help="processes to run the bots on; each bot decrypts everything it receives")
+    parser.add_argument('--duration', type=float, default=None,
+                        help="seconds to run for, by default until a minute after the last bot connects")
+    parser.add_argument('--interval', type=float, default=0.5, help="average seconds between each bot's actions")
+    parser.add_argument('--password', default='loadtest')
+    parser.add_argument('--no-compression', action='store_true',
+                        help="don't offer to compress packets, to compare the bandwidth with and without")
+    server_group = parser.add_mutually_exclusive_group()
+    server_group.add_argument('--spawn-server', action='store_true', help="start a server and stop it afterwards")
+    server_group.add_argument('--server-pid', type=int, help="process id of the server, to report its CPU usage")
+    parser.add_argument('--shards', type=int, help="with --spawn-server, run it with this many worker processes")
+    parser.add_argument('--frontends', type=int, help="with --spawn-server, run it with this many front-end processes")
+    args = parser.parse_args()
+
+    duration = args.duration if args.duration is not None else args.bots / args.ramp + 60
+
+    server = spawn_server((args.host, args.port), args.shards, args.frontends) if args.spawn_server else None
+    server_pid = server.pid if server else args.server_pid
+    cpu = ProcessCPU(server_pid) if server_pid and os.path.exists(f"/proc/{server_pid}") else None
+
+    # Deal the bots out to the workers so they all ramp up together
+    reports = multiprocessing.Queue()
+    workers = []
+    procs = max(1, min(args.procs, args.bots))
+    for w in range(procs):
+        indices = range(w, args.bots, procs)
+        worker = multiprocessing.Process(target=run_worker, daemon=True, args=(
+            (args.host, args.port), [f"bot{i}" for i in indices], args.password, [i / args.ramp for i in indices],
+            args.interval, duration, 1.0, reports, not args.no_compression
+        ))
+        worker.start()
+        workers.append(worker)
+
+    start = time.monotonic()
+    latest: Dict[int, dict] = {}    # worker pid -> its last report
+    all_latencies: List[float] = []
+    finished = 0
+    try:
+        while finished < procs:
+            time.sleep(1)
+            interval: List[dict] = []
+            while True:
+                try:
+                    report = reports.get_nowait()
+                except queue.Empty:
+                    break
+                if report is None:
+                    finished += 1
+                else:
+                    interval.append(report)
+            if not interval:
+                continue
+
+            for report in interval:
+                latest[report['pid']] = report
+            latencies = sorted(l for r in interval for l in r['latencies'])
+            all_latencies += latencies
+            for error in (e for r in interval for e in r['errors']):
+                print(f"  ! {error}")
+
+            # Each worker reports once a second, so the sums are per second
+            playing = sum(r['playing'] for r in latest.values())
+            connected = sum(r['connected'] for r in latest.values())
+            line = f"{time.monotonic() - start:5.0f}s  bots {playing:5}/{connected:<5}" \
+                   f"  in {sum(r['packets_in'] for r in interval):6} pkt/s" \
+                   f" {sum(r['bytes_in'] for r in interval) / 1024:8.1f} KB/s" \
+                   f"  out {sum(r['packets_out'] for r in interval):5} pkt/s" \
+                   f" {sum(r['bytes_out'] for r in interval) / 1024:7.1f} KB/s"
+            if latencies:
+                line += "  ack p50 {:5.0f}ms p90 {:5.0f}ms p99 {:5.0f}ms".format(
+                    *(percentile(latencies, p) * 1000 for p in (50, 90, 99)))
+            if cpu:
+                line += f"  cpu {cpu.percent():4.0f}%"
+            print(line, flush=True)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for worker in workers:
+            worker.terminate()
+        if server:
+            stop_server(server)
+
+    if all_latencies:
+        all_latencies.sort()
+        print("Overall move acknowledgement: " + ", ".join(
+            f"p{p} {percentile(all_latencies, p) * 1000:.0f}ms" for p in (50, 90, 99, 99.9)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+import os
+import random
+import selectors
+import time
+from collections import deque
+from typing import *
+
+import rsa
+
+from loadtest.headless import HeadlessClient
+from networking import packet
+
+
+class Bot:
+    """
+    A scripted player. It registers (or logs in, if it's already registered from an earlier run), then every
+    so often moves in a random direction, says something or tries to pick something up, timing how long the
+    server takes to acknowledge each move.
+    """
+
+    CONNECTING, REGISTERING, LOGGING_IN, PLAYING, FAILED, WAITING = range(6)
+
+    DIRECTIONS = ('up', 'down', 'left', 'right')
+
+    def __init__(self, client: HeadlessClient, username: str, password: str, action_interval: float,
+                 rng: random.Random):
+        self.client = client
+        self.username = username
+        self.password = password
+        self.action_interval = action_interval
+        self.rng = rng
+
+        self.state = Bot.CONNECTING
+        self.next_action = 0.0
+        self.moves_sent: Dict[int, float] = {}     # seq -> time sent
+        self.latencies: List[float] = []
+        self.denied: Optional[str] = None
+
+    def handle(self, p: packet.Packet):
+        if self.state == Bot.CONNECTING and isinstance(p, packet.ClientKeyPacket):
+            self.client.register(self.username, self.password)
+            self.state = Bot.REGISTERING
+
+        elif self.state in (Bot.REGISTERING, Bot.LOGGING_IN) and isinstance(p, packet.DenyPacket) \
+                and "try again in a moment" in p.payloads[0].value:
+            # The server isn't ready for us yet, or too busy, so start again in a second
+            self.state = Bot.WAITING
+            self.next_action = time.monotonic() + 1
+
+        elif self.state == Bot.REGISTERING and isinstance(p, (packet.OkPacket, packet.DenyPacket)):
+            # Denied means we registered on an earlier run, so log in either way
+            self.client.login(self.username, self.password)
+            self.state = Bot.LOGGING_IN
+
+        elif self.state == Bot.LOGGING_IN:
+            if isinstance(p, packet.OkPacket):
+                self.state = Bot.PLAYING
+                self.next_action = time.monotonic() + self.rng.uniform(0, self.action_interval)
+            elif isinstance(p, packet.DenyPacket):
+                self.denied = p.payloads[0].value
+                self.state = Bot.FAILED
+
+        elif self.state == Bot.PLAYING and isinstance(p, packet.MoveAckPacket):
+            sent = self.moves_sent.pop(p.payloads[0].value, None)
+            if sent is not None:
+                self.latencies.append(time.monotonic() - sent)
+
+    def act(self, now: float):
+        if self.state == Bot.WAITING and now >= self.next_action:
+            self.client.register(self.username, self.password)
+            self.state = Bot.REGISTERING
+        if self.state != Bot.PLAYING or now < self.next_action:
+            return
+        # Jitter so the bots don't all act on the same tick
+        self.next_action = now + self.action_interval * self.rng.uniform(0.5, 1.5)
+
+        roll = self.rng.random()
+        if roll < 0.05:
+            self.client.chat(f"{self.username} says hello")
+        elif roll < 0.1:
+            self.client.grab_item()
+        else:
+            seq = self.client.move(self.rng.choice(Bot.DIRECTIONS))
+            self.moves_sent[seq] = now
+
+        # Moves the server dropped will never be acknowledged
+        for seq in [s for s, sent in self.moves_sent.items() if now - sent > 10]:
+            del self.moves_sent[seq]
+
+
+def run_worker(address: Tuple[str, int], names: List[str], password: str, start_times: List[float],
+               action_interval: float, duration: float, report_interval: float, reports, compress: bool = True):
+    """
+    Runs a share of the bots on a single thread, connecting each at its start time (seconds after the worker
+    started) and putting a report of what happened on the reports queue every report_interval seconds.
+    :param compress: whether the bots offer to compress packets
+    """
+    public_key, private_key = rsa.newkeys(512)
+    selector = selectors.DefaultSelector()
+    rng = random.Random()
+    bots: List[Bot] = []
+    waiting = deque(zip(start_times, names))
+    errors: List[str] = []
+    latencies: List[float] = []
+    last_totals = [0, 0, 0, 0]
+
+    start = time.monotonic()
+    next_report = start + report_interval
+    while True:
+        now = time.monotonic()
+        if now - start > duration:
+            break
+
+        while waiting and now - start >= waiting[0][0]:
+            _, name = waiting.popleft()
+            try:
+                client = HeadlessClient(address, public_key, private_key, compress=compress)
+            except OSError as e:
+                errors.append(f"{name}: {e}")
+                continue
+            bot = Bot(client, name, password, action_interval, rng)
+            selector.register(client, selectors.EVENT_READ, bot)
+            bots.append(bot)
+
+        for key, events in selector.select(0.01):
+            bot: Bot = key.data
+            try:
+                if events & selectors.EVENT_WRITE:
+                    bot.client.flush()
+                if events & selectors.EVENT_READ:
+                    for p in bot.client.receive():
+                        bot.handle(p)
+            except OSError as e:
+                errors.append(f"{bot.username}: {e}")
+                bot.state = Bot.FAILED
+
+        now = time.monotonic()
+        for bot in bots:
+            if bot.state == Bot.FAILED:
+                continue
+            try:
+                bot.act(now)
+            except OSError as e:
+                errors.append(f"{bot.username}: {e}")
+                bot.state = Bot.FAILED
+            latencies += bot.latencies
+            bot.latencies.clear()
+
+        for bot in bots:
+            if bot.state == Bot.FAILED:
+                if not bot.client.closed:
+                    if bot.denied:
+                        errors.append(f"{bot.username}: {bot.denied}")
+                    selector.unregister(bot.client)
+                    bot.client.close()
+                continue
+
+            # Only wait to write on sockets which have a backlog
+            events = selectors.EVENT_READ | (selectors.EVENT_WRITE if bot.client.wants_write() else 0)
+            if selector.get_key(bot.client).events != events:
+                selector.modify(bot.client, events, bot)
+
+        if now >= next_report:
+            next_report += report_interval
+            totals = [
+                sum(b.client.packets_received for b in bots), sum(b.client.bytes_received for b in bots),
+                sum(b.client.packets_sent for b in bots), sum(b.client.bytes_sent for b in bots)
+            ]
+            reports.put({
+                'pid': os.getpid(),
+                'playing': sum(b.state == Bot.PLAYING for b in bots),
+                'connected': len(bots),
+                'packets_in': totals[0] - last_totals[0],
+                'bytes_in': totals[1] - last_totals[1],
+                'packets_out': totals[2] - last_totals[2],
+                'bytes_out': totals[3] - last_totals[3],
+                'latencies': latencies,
+                'errors': errors
+            })
+            last_totals = totals
+            latencies, errors = [], []
+
+    for bot in bots:
+        if bot.state == Bot.PLAYING:
+            try:
+                bot.client.logout(bot.username)
+            except OSError:
+                pass
+        bot.client.close()
+    reports.put(None)
@@ -0,0 +1,150 @@
+import socket
+from typing import *
+
+import rsa
+
+from networking import compression, cryptography, framing, packet
+
+
+class HeadlessClient:
+    """
+    A client with no user interface which speaks the same protocol as the game client: it sends its public key
+    as soon as it connects, picks up the server's key from the reply, and encrypts everything after that. Unless
+    told not to, it offers to compress packets, as the game client does.
+
+    The socket is non-blocking so that many clients can share one thread: register fileno() with a selector,
+    call receive() when it's readable and flush() when it's writable and wants_write() is True. Received packets
+    are returned for the caller to act on, except pings, which are answered straight away.
+    """
+
+    def __init__(self, address: Tuple[str, int], public_key: rsa.PublicKey, private_key: rsa.PrivateKey,
+                 timeout: float = 10, compress: bool = True):
+        self.sock = socket.create_connection(address, timeout=timeout)
+        self.sock.setblocking(False)
+        self.private_key = private_key
+        self.server_public_key: Optional[rsa.PublicKey] = None
+        self.resume_token: Optional[str] = None     # the server's latest, once logged in
+
+        self._decoder = framing.FrameDecoder()
+        self._framing: Optional[str] = None
+        self._compressor: Optional[compression.Compressor] = None
+        self._decompressor = compression.Decompressor()
+        self._outgoing = bytearray()
+        self.seq = 0
+        self.closed = False
+
+        self.packets_sent = 0
+        self.packets_received = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+        offer = compression.SUPPORTED if compress else None
+        self.send_packet(packet.ClientKeyPacket(public_key.n, public_key.e, offer, framing.SUPPORTED))
+
+    def fileno(self) -> int:
+        return self.sock.fileno()
+
+    def send_packet(self, p: packet.Packet):
+        """
+        Queues a packet and sends as much as the socket will take straight away.
+        """
+        b = p.tobytes()
+        if not isinstance(p, packet.ClientKeyPacket):   # Our public key is the only thing sent in the clear
+            if not self.server_public_key:
+                raise ValueError(f"Can't send {p} before the server has sent its public key")
+            if self._compressor:
+                b = self._compressor.compress(b)
+            b = cryptography.encrypt(b, self.server_public_key)
+        if self._framing == framing.BINARY:
+            self._outgoing += framing.binary_header(b)
+            self._outgoing += b
+        else:
+            self._outgoing += framing.to_netstring(b)
+        self.packets_sent += 1
+        self.flush()
+
+    def wants_write(self) -> bool:
+        return bool(self._outgoing)
+
+    def flush(self):
+        while self._outgoing:
+            try:
+                sent = self.sock.send(self._outgoing)
+            except BlockingIOError:
+                return
+            self.bytes_sent += sent
+            del self._outgoing[:sent]
+
+    def receive(self) -> List[packet.Packet]:
+        """
+        Reads everything available on the socket.
+        :return: every packet completed, in order
+        :raises ConnectionError: if the server closed the connection
+        """
+        packets = []
+        while True:
+            try:
+                with self._decoder.space() as view:
+                    n = self.sock.recv_into(view)
+            except BlockingIOError:
+                return packets
+            if not n:
+                raise ConnectionError("Connection closed by the server.")
+            self.bytes_received += n
+            self._decoder.received(n)
+
+            for frame in self._decoder.frames():
+                p = packet.frombytes(self._decompressor.decompress(cryptography.decrypt(frame, self.private_key)))
+                if isinstance(p, packet.ClientKeyPacket):
+                    self.server_public_key = rsa.PublicKey(p.payloads[0].value, p.payloads[1].value)
+                    if p.payloads[2].value:
+                        self._compressor = compression.Compressor()
+                    self._framing = p.payloads[3].value
+                elif isinstance(p, packet.ResumeTokenPacket):
+                    self.resume_token = p.payloads[0].value
+                elif isinstance(p, packet.PingPacket):
+                    self.send_packet(packet.PongPacket(p.payloads[0].value))
+                    continue
+                if p:
+                    self.packets_received += 1
+                    packets.append(p)
+
+    def register(self, username: str, password: str):
+        self.send_packet(packet.RegisterPacket(username, password))
+
+    def login(self, username: str, password: str):
+        self.send_packet(packet.LoginPacket(username, password))
+
+    def resume(self, token: str):
+        """
+        Asks to take over the session of an earlier connection, whose token the server gave it.
+        """
+        self.send_packet(packet.ResumePacket(token))
+
+    def logout(self, username: str):
+        self.send_packet(packet.LogoutPacket(username))
+
+    def move(self, direction: str) -> int:
+        """
+        :param direction: one of 'up', 'down', 'left' or 'right'
+        :return: the move's sequence number, which the server's MoveAckPacket will carry
+        """
+        packet_type = {
+            'up': packet.MoveUpPacket,
+            'down': packet.MoveDownPacket,
+            'left': packet.MoveLeftPacket,
+            'right': packet.MoveRightPacket
+        }[direction]
+        self.seq += 1
+        self.send_packet(packet_type(self.seq))
+        return self.seq
+
+    def chat(self, message: str):
+        self.send_packet(packet.ChatPacket(message))
+
+    def grab_item(self):
+        self.send_packet(packet.GrabItemPacket())
+
+    def close(self):
+        self.closed = True
+        self.sock.close()
@@ -1,4 +1,3 @@
-from PIL import Image
 import os
 
 STONE = (0, 0, 0)
@@ -102,6 +101,8 @@ class Room:
         self._unpack()
 
     def _unpack(self):
+        from PIL import Image     # Only when needed, since importing it takes a while
+
         mapsdir = os.path.dirname(os.path.realpath(__file__))
         mapdir = os.path.join(mapsdir, self._file_name)
 
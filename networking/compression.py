@@ -0,0 +1,128 @@
+"""
+Compression of the packets on a connection, if both ends want it. The client offers the codecs it knows in its
+ClientKeyPacket and the server names the one it chose in its own, or None. Each end then compresses every packet
+it sends before encrypting it, and decompresses every packet it receives after decrypting it.
+
+Each direction is one deflate stream for as long as the connection lasts, so a packet is compressed against
+everything sent before it as well as a preset dictionary of the strings in most packets, and even the first few
+compress well. Packets are flushed one at a time, so each can be decompressed as soon as it arrives.
+
+A packet is only sent compressed once the other end has said it can take it, but packets already on their way
+aren't, so either kind can arrive for a while. Packets are JSON objects, which start with '{', and a deflate
+stream flushed after each packet never does (its first bit says whether the block is the last, which none are),
+so the decompressor passes the plain packets straight through.
+"""
+import zlib
+from typing import *
+
+from . import packet
+
+ZLIB = 'zlib'
+
+SUPPORTED: List[str] = [ZLIB]   # in order of preference
+
+# Set False (the server's --no-compression) to turn down every offer
+ENABLED = True
+
+# 4KB is plenty for packets of a few hundred bytes, and keeps each stream's memory to around 50KB a direction
+WINDOW_BITS = 12
+MEM_LEVEL = 6
+LEVEL = 6
+
+# The empty stored block which ends every flush, so left off the wire and put back before decompressing
+_FLUSH_TAIL = b'\x00\x00\xff\xff'
+
+
+def _sample_packets() -> List[packet.Packet]:
+    """
+    Packets like the ones sent most, least common first, as deflate finds strings near the end of the dictionary
+    in fewer bits. The dictionary is built from these, so changing how they encode changes it, which both ends
+    need to agree on: give the codec a new name when it does.
+    """
+    entity = {'id': 0, 'typename': 'Player', 'name': ''}
+    item = {'id': 0, 'entity': 0, 'value': 1}
+    return [
+        packet.WelcomePacket(),
+        packet.ServerTickRatePacket(20),
+        packet.ClientKeyPacket(0, 65537, None),
+        packet.LoginPacket('', ''),
+        packet.RegisterPacket('', ''),
+        packet.LogoutPacket(''),
+        packet.ResumeTokenPacket(''),
+        packet.ServerModelPacket('Room', {'id': 0, 'name': '', 'file_name': ''}),
+        packet.ServerModelPacket('Player', {'id': 0, 'user': 0, 'entity': 0, 'inventory': 0}),
+        packet.ServerModelPacket('ContainerItem', {'id': 0, 'container': 0, 'item': dict(item, entity=entity),
+                                                   'amount': 1}),
+        packet.WeatherChangePacket('Clear'),
+        packet.DenyPacket("There is no item here."),
+        packet.MoveRoomsPacket(0),
+        packet.OkPacket(),
+        packet.GoodbyePacket(0),
+        packet.ServerLogPacket(" has arrived."),
+        packet.ServerLogPacket(" says: "),
+        packet.ChatPacket(''),
+        packet.PongPacket(0),
+        packet.PingPacket(0),
+        packet.MoveUpPacket(0),
+        packet.MoveDownPacket(0),
+        packet.MoveLeftPacket(0),
+        packet.MoveRightPacket(0),
+        packet.MoveAckPacket(0, 0, 0),
+        packet.ServerModelPacket('Instance', {'id': 0, 'entity': dict(entity, typename='Item'), 'room': 0,
+                                              'y': 0, 'x': 0, 'amount': 1, 'respawn_time': 0}),
+        packet.ServerModelPacket('Instance', {'id': 0, 'entity': entity, 'room': 0, 'y': 0, 'x': 0,
+                                              'amount': 1, 'respawn_time': 0}),
+    ]
+
+
+DICTIONARY: bytes = b''.join(p.tobytes() for p in _sample_packets())
+
+
+def choose(offered: Optional[Sequence[str]]) -> Optional[str]:
+    """
+    :param offered: the codecs a client said it knows, or None if it didn't say
+    :return: the codec to use on its connection, or None not to compress
+    """
+    if not ENABLED or not offered:
+        return None
+    for codec in SUPPORTED:
+        if codec in offered:
+            return codec
+    return None
+
+
+class Compressor:
+    """
+    Compresses the packets one end of a connection sends, in the order it sends them.
+    """
+
+    def __init__(self):
+        self._stream = zlib.compressobj(LEVEL, zlib.DEFLATED, -WINDOW_BITS, MEM_LEVEL, zlib.Z_DEFAULT_STRATEGY,
+                                        DICTIONARY)
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def compress(self, data: bytes) -> bytes:
+        compressed = self._stream.compress(data) + self._stream.flush(zlib.Z_SYNC_FLUSH)
+        compressed = compressed[:-len(_FLUSH_TAIL)]
+        self.bytes_in += len(data)
+        self.bytes_out += len(compressed)
+        return compressed
+
+
+class Decompressor:
+    """
+    Decompresses the packets one end of a connection receives, in the order they were sent. Packets which weren't
+    compressed are returned as they are.
+    """
+
+    def __init__(self):
+        self._stream = zlib.decompressobj(-WINDOW_BITS, DICTIONARY)
+
+    def decompress(self, data: bytes) -> bytes:
+        """
+        :raises zlib.error: if the data is neither a packet nor the next one in the stream
+        """
+        if data[:1] == b'{':
+            return data
+        return self._stream.decompress(data + _FLUSH_TAIL)
@@ -0,0 +1,253 @@
+"""
+How packets are framed on the wire. Every connection starts out with netstrings (see
+http://cr.yp.to/proto/netstrings.txt), and switches to binary frames once the other end has said in the key
+exchange that it can read them: a 4 byte big-endian length, then that many bytes.
+
+Either end can switch whenever it likes, as FrameDecoder reads both, frame by frame: a netstring starts with a
+digit, and a binary frame's header starts with a zero byte, as no frame is MAX_BINARY_LENGTH or longer.
+"""
+import struct
+from typing import *
+
+BINARY = 'binary'
+
+SUPPORTED: List[str] = [BINARY]     # in order of preference
+
+HEADER = struct.Struct('!I')
+MAX_BINARY_LENGTH = 2 ** 24 - 1     # so the header's first byte is always zero
+
+_DIGITS = b'0123456789'
+_COMMA = ord(',')
+
+
+class FramingError(Exception):
+    pass
+
+
+def choose(offered: Optional[Sequence[str]]) -> Optional[str]:
+    """
+    :param offered: the framings the other end said it can read, or None if it didn't say
+    :return: the framing to send with, or None to send netstrings
+    """
+    for framing in SUPPORTED:
+        if offered and framing in offered:
+            return framing
+    return None
+
+
+class NetstringDecoder:
+    """
+    Incrementally splits a stream of netstrings into the data they carry. See
+    http://cr.yp.to/proto/netstrings.txt for the specification of netstrings.
+
+    Feed it whatever arrives on the socket, however it happens to be split up, and it gives back every netstring
+    completed so far. Anything left over is kept until the rest of it arrives.
+
+    For example:
+        decoder = NetstringDecoder()
+        decoder.feed(b'5:hello,3:w')    # [b'hello']
+        decoder.feed(b'ho,')            # [b'who']
+    """
+
+    def __init__(self, max_length: int = 2 ** 63 - 1):
+        self._buffer = bytearray()
+        self._max_digits = len(str(max_length))
+
+    def feed(self, data: bytes) -> List[bytes]:
+        """
+        :param data: the next bytes received
+        :return: the data of every netstring completed by these bytes, in order
+        :raises FramingError: if the stream isn't made of valid netstrings. The decoder is reset so it can be
+                              fed again, although what comes next is probably garbage too.
+        """
+        buffer = self._buffer
+        buffer += data
+
+        frames = []
+        start = 0
+        try:
+            while True:
+                colon = buffer.find(b':', start, start + self._max_digits + 1)
+                if colon == -1:
+                    if len(buffer) - start > self._max_digits:
+                        raise FramingError("Error reading netstring length. Too long.")
+                    if len(buffer) > start and not buffer[start:].isdigit():
+                        raise FramingError(f"Error reading netstring length. Got {bytes(buffer[start:])}.")
+                    break
+
+                length = buffer[start:colon]
+                if not length.isdigit():
+                    raise FramingError(f"Error reading netstring length. Got {bytes(length)}.")
+
+                end = colon + 1 + int(length)
+                if len(buffer) <= end:
+                    break   # Wait for the rest of the data and the trailing comma
+                if buffer[end] != ord(','):
+                    raise FramingError(f"Netstring of length {int(length)} is missing its trailing comma.")
+
+                frames.append(bytes(buffer[colon + 1:end]))
+                start = end + 1
+        except FramingError:
+            self.reset()
+            raise
+
+        del buffer[:start]
+        return frames
+
+    def reset(self):
+        self._buffer.clear()
+
+
+class FrameDecoder:
+    """
+    Incrementally splits a stream of netstrings and binary frames, in any mix, into the data they carry. Like
+    NetstringDecoder, but what's received is kept in one buffer which is reused rather than reallocated and
+    trimmed as frames are taken out of it, and which can be received into directly:
+
+        with decoder.space() as view:
+            n = sock.recv_into(view)
+        decoder.received(n)
+        frames = decoder.frames()
+
+    or fed bytes which have already been received with decoder.feed(data).
+    """
+
+    SPACE = 4096    # the least space() makes room for
+
+    def __init__(self, max_length: int = MAX_BINARY_LENGTH, size: int = 65536):
+        self._buffer = bytearray(size)
+        self._start = 0     # where the data not yet taken out as frames starts
+        self._end = 0       # and ends
+        self._max_length = min(max_length, MAX_BINARY_LENGTH)
+        self._max_digits = len(str(self._max_length))
+
+    def space(self, at_least: int = SPACE) -> memoryview:
+        """
+        :return: the free end of the buffer, at least at_least bytes long, to receive into. Release it, e.g. by
+                 using it in a with block, before calling anything else.
+        """
+        self._reserve(at_least)
+        return memoryview(self._buffer)[self._end:]
+
+    def _reserve(self, at_least: int):
+        buffer = self._buffer
+        if len(buffer) - self._end < at_least:
+            # Move what's left of the last frame to the start, then grow the buffer if that's not enough
+            pending = self._end - self._start
+            if self._start:
+                buffer[:pending] = buffer[self._start:self._end]
+                self._start, self._end = 0, pending
+            if len(buffer) - pending < at_least:
+                buffer.extend(bytes(max(at_least, len(buffer))))
+
+    def received(self, n: int):
+        """
+        :param n: how many bytes were received into the last space()
+        """
+        self._end += n
+
+    def feed(self, data: bytes) -> List[bytes]:
+        """
+        :param data: the next bytes received
+        :return: the data of every frame completed by these bytes, in order
+        :raises FramingError: as frames does
+        """
+        self._reserve(len(data))
+        self._buffer[self._end:self._end + len(data)] = data
+        self._end += len(data)
+        return self.frames()
+
+    def frames(self) -> List[bytes]:
+        """
+        :return: the data of every frame completed by what's been received, in order
+        :raises FramingError: if the stream isn't made of valid frames. The decoder is reset so it can be used
+                              again, although what comes next is probably garbage too.
+        """
+        buffer, start, end = self._buffer, self._start, self._end
+        max_digits, max_length = self._max_digits, self._max_length
+        frames = []
+        try:
+            while start < end:
+                if buffer[start] in _DIGITS:
+                    # Past the end of the data is whatever was in the buffer before, so mustn't be looked at
+                    limit = start + max_digits + 1
+                    colon = buffer.find(b':', start, limit if limit < end else end)
+                    if colon == -1:
+                        if end - start > max_digits:
+                            raise FramingError("Error reading netstring length. Too long.")
+                        if not buffer[start:end].isdigit():
+                            raise FramingError(f"Error reading netstring length. Got {bytes(buffer[start:end])}.")
+                        break
+                    length = buffer[start:colon]
+                    if not length.isdigit():
+                        raise FramingError(f"Error reading netstring length. Got {bytes(length)}.")
+                    length = int(length)
+                    if length > max_length:
+                        raise FramingError(f"Netstring of length {length} is too long.")
+                    data_start = colon + 1
+                    frame_end = data_start + length
+                    if end <= frame_end:
+                        break   # Wait for the rest of the data and the trailing comma
+                    if buffer[frame_end] != _COMMA:
+                        raise FramingError(f"Netstring of length {length} is missing its trailing comma.")
+                    next_start = frame_end + 1
+                else:
+                    if end - start < HEADER.size:
+                        break
+                    length, = HEADER.unpack_from(buffer, start)
+                    if length > max_length:
+                        raise FramingError(f"Frame of length {length} is too long.")
+                    data_start = start + HEADER.size
+                    frame_end = next_start = data_start + length
+                    if end < frame_end:
+                        break
+                frames.append(bytes(buffer[data_start:frame_end]))
+                start = next_start
+        except FramingError:
+            self.reset()
+            raise
+
+        if start == end:
+            start = end = 0     # Nothing's left over, so start again from the front
+        self._start, self._end = start, end
+        return frames
+
+    def reset(self):
+        self._start = self._end = 0
+
+
+def to_netstring(data: bytes) -> bytes:
+    return str(len(data)).encode('ascii') + b':' + data + b','
+
+
+def binary_header(data: bytes) -> bytes:
+    """
+    :return: what goes in front of the data to make it a binary frame
+    """
+    if len(data) > MAX_BINARY_LENGTH:
+        raise FramingError(f"Can't frame {len(data)} bytes. Too long.")
+    return HEADER.pack(len(data))
+
+
+def frame(data: bytes, framing: Optional[str]) -> bytes:
+    """
+    :param framing: BINARY, or None for a netstring
+    """
+    if framing == BINARY:
+        return binary_header(data) + data
+    return to_netstring(data)
+
+
+def frame_sequence(messages: Sequence[bytes], framing: Optional[str]) -> List[bytes]:
+    """
+    Frames messages for a writeSequence, without copying them: a binary frame's header and data are separate
+    items. Netstrings have a trailing comma too, so they're built whole.
+    :param framing: BINARY, or None for netstrings
+    """
+    if framing != BINARY:
+        return [to_netstring(m) for m in messages]
+    sequence = []
+    for m in messages:
+        sequence.append(binary_header(m))
+        sequence.append(m)
+    return sequence
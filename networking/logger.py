@@ -1,12 +1,117 @@
+import atexit
+import logging
+import sys
+import threading
 import time
 import os
+from collections import deque
 from typing import *
 
 
+class LogWriter:
+    """
+    Writes log messages to a daily log file from a background thread. Messages are queued in memory and written
+    in batches, every flush_interval seconds or as soon as batch_size of them are waiting, so logging a message
+    never waits on the disk. A day's file which grows past max_bytes is rolled over to <day>.1.log, <day>.2.log
+    and so on, keeping up to backup_count of them. Anything still queued is written when the program exits.
+    """
+
+    def __init__(self, logdir: str, flush_interval: float = 1, batch_size: int = 256,
+                 max_bytes: int = 10 * 1024 * 1024, backup_count: int = 5):
+        self.logdir = logdir
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+
+        self._records: Deque[Tuple[float, str]] = deque()
+        self._wakeup = threading.Event()
+        self._flush_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self._closed = False
+
+    def write(self, timestamp: float, message: str):
+        self._records.append((timestamp, message))
+
+        if self._closed:
+            # There's no thread to write it any more, e.g. it's logged by another atexit function after ours
+            self.flush()
+        elif self._thread is None:
+            # Don't start a thread until there's something to write
+            self._start()
+        elif len(self._records) >= self.batch_size:
+            self._wakeup.set()
+
+    def _start(self):
+        # Messages are logged from the reactor thread and from the thread pool, which could both get here at once
+        with self._start_lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        """
+        Writes every queued message to disk now.
+        """
+        with self._flush_lock:
+            if not self._records:
+                return
+
+            # Group the lines by the day they were logged on so a batch spanning midnight lands in both files
+            lines: Dict[str, List[str]] = {}
+            while self._records:
+                timestamp, message = self._records.popleft()
+                datestr: str = time.strftime('%Y-%m-%d', time.gmtime(timestamp))
+                lines.setdefault(datestr, []).append(f"{time.strftime('%R', time.gmtime(timestamp))}: {message}\n")
+
+            os.makedirs(self.logdir, exist_ok=True)
+            for datestr, day_lines in lines.items():
+                data: str = ''.join(day_lines)
+                logfile: str = os.path.join(self.logdir, f"{datestr}.log")
+                self._rollover_if_full(logfile, len(data))
+                with open(logfile, 'a') as f:
+                    f.write(data)
+
+    def _rollover_if_full(self, logfile: str, incoming: int):
+        try:
+            size: int = os.path.getsize(logfile)
+        except OSError:
+            return
+        if size == 0 or size + incoming <= self.max_bytes:
+            return
+
+        base, ext = os.path.splitext(logfile)
+        for i in range(self.backup_count - 1, 0, -1):
+            older = f"{base}.{i}{ext}"
+            if os.path.exists(older):
+                os.replace(older, f"{base}.{i + 1}{ext}")
+        os.replace(logfile, f"{base}.1{ext}")
+
+    def close(self):
+        self._closed = True
+        self._wakeup.set()
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join(timeout=self.flush_interval + 1)
+        self.flush()
+
+
+_writer = LogWriter(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'logs'))
+
+
 class Log:
-    def __init__(self):
+    def __init__(self, writer: LogWriter = _writer):
         self.latest: Dict[float, str] = {}
         self.size: int = 0
+        self._writer = writer
 
     def log(self, message: str):
         # Log times as seconds since 1-Jan-1970 (Unix time)
@@ -15,11 +120,43 @@ class Log:
         self.latest = {timestamp: message}
         self.size += 1
 
-        logdir: str = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'logs')
-        if not os.path.exists(logdir):
-            os.makedirs(logdir)
+        self._writer.write(timestamp, message)
+
+
+# Attributes a record can be logged with (through extra=) to say who it's about
+CONTEXT_FIELDS = ('username', 'state', 'room')
+
+
+class ContextFormatter(logging.Formatter):
+    """
+    Formats records like "12:00:00 DEBUG moonlapse.protocol [josh][PLAY][Garden]: message", with whichever
+    context fields the record was logged with.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        context = ''.join(f"[{getattr(record, f)}]" for f in CONTEXT_FIELDS if hasattr(record, f))
+        record.context = f" {context}" if context else ''
+        return super().format(record)
+
+
+def get_logger(subsystem: str) -> logging.Logger:
+    """
+    Loggers are per subsystem (e.g. 'server', 'protocol') so each can be turned up or down on its own. Messages
+    are formatted lazily, so pass arguments separately rather than as an f-string:
+        log.debug("Received packet %s", p)
+    """
+    return logging.getLogger(f"moonlapse.{subsystem}")
+
+
+def configure(level: Union[int, str] = logging.INFO):
+    """
+    Sends every subsystem's messages at or above level to stdout. Anything below level costs a single comparison.
+    :param level: a level name like 'DEBUG', or a number
+    """
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(ContextFormatter('%(asctime)s %(levelname)s %(name)s%(context)s: %(message)s', '%X'))
 
-        datestr: str = time.strftime('%Y-%m-%d', time.gmtime())
-        logfile: str = os.path.join(logdir, f"{datestr}.log")
-        with open(logfile, 'a') as f:
-            print(f"{time.strftime('%R', time.gmtime(timestamp))}: {message}", file=f)
+    root = logging.getLogger('moonlapse')
+    root.handlers = [handler]
+    root.setLevel(level.upper() if isinstance(level, str) else level)
+    root.propagate = False
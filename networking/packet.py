@@ -1,10 +1,12 @@
-import traceback
 import json
 
 from . import payload
+from .logger import get_logger
 from .payload import Payload
 from typing import *
 
+log = get_logger('packet')
+
 
 class Packet:
     """
@@ -177,8 +179,15 @@ class ChatPacket(Packet):
 class MovePacket(Packet):
     """
     This class should not be instantiated directly but instead one of its implementations below should.
+    An optional sequence number can be supplied, in which case the protocol will answer with a MoveAckPacket
+    once the move has been processed.
     """
-    pass
+
+    def __init__(self, seq: Optional[int] = None):
+        if seq is None:
+            super().__init__()
+        else:
+            super().__init__(Payload(seq))
 
 
 class MoveUpPacket(MovePacket):
@@ -209,6 +218,16 @@ class MoveRightPacket(MovePacket):
     pass
 
 
+class MoveAckPacket(Packet):
+    """
+    A packet sent from a protocol to its client after processing a move with a sequence number, saying where
+    the player really ended up. The client should correct any position it predicted for moves up to seq.
+    """
+
+    def __init__(self, seq: int, y: int, x: int):
+        super().__init__(Payload(seq), Payload(y), Payload(x))
+
+
 class MoveRoomsPacket(Packet):
     def __init__(self, roomid: Optional[int]):
         super().__init__(Payload(roomid))
@@ -258,10 +277,14 @@ class ServerTickRatePacket(Packet):
 class ClientKeyPacket(Packet):
     """
     A packet sent from a protocol to its client with the client's public key used in encrypting traffic.
+    The client's also lists the compression codecs it knows (see networking/compression.py) and the framings
+    it can read (see networking/framing.py), and the protocol's answer says which of each it chose, or None to
+    send everything uncompressed or as netstrings.
     """
 
-    def __init__(self, n: int, e: int):
-        super().__init__(Payload(n), Payload(e))
+    def __init__(self, n: int, e: int, compression: Optional[Union[List[str], str]] = None,
+                 framing: Optional[Union[List[str], str]] = None):
+        super().__init__(Payload(n), Payload(e), Payload(compression), Payload(framing))
 
 
 class GrabItemPacket(Packet):
@@ -287,6 +310,60 @@ class WeatherChangePacket(Packet):
         super().__init__(Payload(new_weather))
 
 
+class QueuePositionPacket(Packet):
+    """
+    A packet sent from a protocol to its client while its login or registration waits its turn, saying how many
+    are ahead of it, counting itself.
+    """
+
+    def __init__(self, position: int):
+        super().__init__(Payload(position))
+
+
+class ResumeTokenPacket(Packet):
+    """
+    A packet sent from a protocol to its client once logged in, and again whenever the token changes, with a
+    token the client can present in a ResumePacket to pick up where it left off if its connection drops.
+    """
+
+    def __init__(self, token: str):
+        super().__init__(Payload(token))
+
+
+class ResumePacket(Packet):
+    """
+    A packet sent from a client to a protocol, on a new connection after the key exchange, to take over the
+    session its last connection left behind instead of logging in. The protocol answers with a new
+    ResumeTokenPacket and whatever the client missed, or a DenyPacket if the session has expired.
+    """
+
+    def __init__(self, token: str):
+        super().__init__(Payload(token))
+
+    def __repr__(self):
+        return f"{self.action}: (Payload: ***)"
+
+
+class PingPacket(Packet):
+    """
+    A packet sent from a protocol to its client every few seconds, which the client answers straight away with a
+    PongPacket carrying the same number, so the server knows the connection is still alive and how long a round
+    trip takes.
+    """
+
+    def __init__(self, seq: int):
+        super().__init__(Payload(seq))
+
+
+class PongPacket(Packet):
+    """
+    A packet sent from a client to a protocol answering the PingPacket with the same number.
+    """
+
+    def __init__(self, seq: int):
+        super().__init__(Payload(seq))
+
+
 def frombytes(data: bytes) -> Packet:
     """
     Constructs a proper packet type from bytes encoding a netstring. See
@@ -317,7 +394,6 @@ def frombytes(data: bytes) -> Packet:
         rPacket = constructor(*payloads_values)
         return rPacket
     except KeyError:
-        print(f"KeyError: {specificPacketClassName} is not a valid packet name. Stacktrace: ")
-        print(traceback.format_exc())
+        log.warning("%s is not a valid packet name.", specificPacketClassName, exc_info=True)
     except TypeError:
-        print(f"TypeError: {specificPacketClassName} can't handle arguments {tuple(payloads_values)}.")
+        log.warning("%s can't handle arguments %s.", specificPacketClassName, tuple(payloads_values))
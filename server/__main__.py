@@ -14,17 +14,147 @@ get_dependencies.install_requirements(parent)
 vpy = get_dependencies.get_vpy_from_root_dir(parent)
 if sys.executable != vpy:
     import subprocess
-    subprocess.run([vpy, parent] + sys.argv[1:])
+    subprocess.run([vpy] + get_dependencies.interpreter_flags() + [parent] + sys.argv[1:])
     exit()
 
-from twisted.internet import reactor, task
-from server import manage
-from server.mlserver import MoonlapseServer
+import argparse
+import socket
+import time
+from networking import compression, logger
+
+# Set MOONLAPSE_LOG_LEVEL=DEBUG to see every packet sent and received
+logger.configure(os.environ.get('MOONLAPSE_LOG_LEVEL', 'INFO'))
+log = logger.get_logger('server')
+
+# Only what the arguments need, neither of which imports Twisted: the rest of the server does, and sets up Django and
+# imports the models, rsa and pycryptodome, so it's imported once there's a port listening, or by whichever mode
+# needs it
+from server import admission, heartbeat
 
 
 if __name__ == '__main__':
-    print(f"Starting MoonlapseMUD server")
+    parser = argparse.ArgumentParser(prog='server', description="Run the MoonlapseMUD server.")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--record', metavar='PATH', help="record the session to replay later")
+    mode.add_argument('--replay', metavar='PATH', help="replay a recorded session as fast as possible, then exit")
+    parser.add_argument('--profile', metavar='PATH', help="with --replay, save cProfile stats of the ticks here")
+    parser.add_argument('--metrics-port', type=int, help="serve metrics at http://127.0.0.1:<port>/metrics")
+    parser.add_argument('--admin-socket', metavar='PATH', help="listen for admin commands on a UNIX socket (not on Windows)")
+    parser.add_argument('--send-workers', type=int, metavar='N',
+                        help="encrypt outgoing packets on this many processes (or threads, with --send-threads)")
+    parser.add_argument('--send-threads', action='store_true', help="with --send-workers, use threads, which only "
+                                                                    "overlap the AES part of encryption")
+    parser.add_argument('--logins-per-tick', type=int, metavar='N',
+                        help=f"start at most this many logins and registrations each tick (default {admission.PER_TICK})")
+    parser.add_argument('--login-concurrency', type=int, metavar='N',
+                        help=f"hash at most this many passwords at once (default {admission.CONCURRENCY})")
+    parser.add_argument('--login-rate', type=float, metavar='PER_SECOND',
+                        help=f"logins and registrations each address can attempt a second after the first "
+                             f"{admission.BURST}, or 0 for no limit (default {admission.RATE})")
+    parser.add_argument('--ping-interval', type=float, metavar='SECONDS',
+                        help=f"ping each client this often (default {heartbeat.INTERVAL})")
+    parser.add_argument('--ping-timeout', type=float, metavar='SECONDS',
+                        help=f"disconnect clients which haven't answered for this long (default {heartbeat.TIMEOUT})")
+    parser.add_argument('--idle-timeout', type=float, metavar='SECONDS',
+                        help=f"disconnect players who haven't done anything for this long (default {heartbeat.IDLE_SECONDS})")
+    parser.add_argument('--no-compression', action='store_true', help="turn down clients' offers to compress packets")
+    parser.add_argument('--shards', type=int, help="simulate the rooms in this many worker processes (not on Windows)")
+    parser.add_argument('--frontends', type=int, help="handle connections and encryption in this many processes, "
+                                                      "apart from the simulation (not on Windows)")
+    # how the first front-end starts the workers and the other front-ends
+    parser.add_argument('--worker', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--frontend', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--socket', help=argparse.SUPPRESS)
+    parser.add_argument('--listen-fd', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.replay:
+        from server import recording
+        recording.replay(args.replay, args.profile)
+        exit()
+
+    # For whichever server handles logins and clients, and passed on to the workers if it's split up
+    worker_args = []
+    if args.logins_per_tick:
+        admission.PER_TICK = args.logins_per_tick
+        worker_args += ['--logins-per-tick', str(args.logins_per_tick)]
+    if args.login_concurrency:
+        admission.CONCURRENCY = args.login_concurrency
+        worker_args += ['--login-concurrency', str(args.login_concurrency)]
+    if args.login_rate is not None:
+        admission.RATE = args.login_rate
+        worker_args += ['--login-rate', str(args.login_rate)]
+    if args.ping_interval:
+        heartbeat.INTERVAL = args.ping_interval
+        worker_args += ['--ping-interval', str(args.ping_interval)]
+    if args.ping_timeout:
+        heartbeat.TIMEOUT = args.ping_timeout
+        worker_args += ['--ping-timeout', str(args.ping_timeout)]
+    if args.idle_timeout:
+        heartbeat.IDLE_SECONDS = args.idle_timeout
+        worker_args += ['--idle-timeout', str(args.idle_timeout)]
+    if args.no_compression:
+        # The workers answer the offer and the front-ends compress, so both need to know
+        compression.ENABLED = False
+        worker_args += ['--no-compression']
+
     PORT: int = 42523
-    reactor.listenTCP(PORT, MoonlapseServer())
-    print(f"Server listening on port {42523}")
+    if args.worker is not None:
+        from server import worker
+        worker.run(args.worker, args.shards, args.socket)
+        exit()
+    if args.frontend is not None:
+        from server import gateway
+        gateway.run_frontend(args.frontend, args.shards, args.socket, args.listen_fd)
+        exit()
+    if args.shards or args.frontends:
+        if args.record:
+            parser.error("--record needs the simulation in one process")
+        from server import gateway
+        if args.metrics_port:
+            from server import metrics
+            metrics.listen(args.metrics_port)
+        gateway.run(PORT, args.shards or 1, args.frontends or 1, worker_args)
+        exit()
+
+    log.info("Starting MoonlapseMUD server")
+    # Listen before importing the rest, so clients connecting meanwhile wait in the backlog rather than being
+    # refused, and then in the queue until the world has loaded. Twisted can't adopt a socket on Windows, where
+    # it listens once the server's imported instead.
+    listener = None
+    if os.name != 'nt':
+        listener = socket.create_server(('', PORT))
+        listener.setblocking(False)
+        log.info("Server listening on port %s", PORT)
+
+    started = time.perf_counter()
+    from twisted.internet import reactor
+    from server.mlserver import MoonlapseServer
+    log.info("Imported the server in %.2fs", time.perf_counter() - started)
+
+    server = MoonlapseServer()
+    if args.send_workers:
+        from server.sendpool import SendPool
+        server.sendpool = SendPool(args.send_workers, processes=not args.send_threads)
+        reactor.addSystemEventTrigger('after', 'shutdown', server.sendpool.close)
+    if args.record:
+        from server import recording
+        server.recorder = recording.Recorder(args.record)
+        reactor.addSystemEventTrigger('before', 'shutdown', server.recorder.close)
+        log.info("Recording session to %s", args.record)
+    if listener:
+        reactor.adoptStreamPort(listener.fileno(), socket.AF_INET, server)
+        listener.close()    # the reactor has its own copy
+    else:
+        reactor.listenTCP(PORT, server)
+        log.info("Server listening on port %s", PORT)
+    if args.metrics_port:
+        from server import metrics
+        metrics.listen(args.metrics_port)
+    if args.admin_socket:
+        from server import admin
+        admin.listen(args.admin_socket, server)
+
+    # Players can connect while the world loads; they're asked to wait until it has
+    reactor.callWhenRunning(server.start)
     reactor.run()
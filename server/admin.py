@@ -0,0 +1,273 @@
+"""
+An admin channel for looking inside the running server: run it with --admin-socket PATH and send one command per
+connection to that UNIX socket, e.g.
+
+    python -m server.admin server/admin.sock profile 30 > server.folded
+    flamegraph.pl server.folded > server.svg
+
+Commands:
+    profile SECONDS [INTERVAL_MS]   sample the reactor thread's stack for a while, returning collapsed stacks which
+                                    flamegraph.pl and speedscope understand
+    tracemalloc start [FRAMES]      start tracing memory allocations
+    tracemalloc snapshot [TOP]      memory allocated by subsystem, and what grew most, since the last snapshot
+    tracemalloc stop
+    sizes                           how big the server's per-player structures are
+    connections                     who is connected, and how far behind each is on receiving
+Only the user running the server can connect to the socket.
+"""
+import collections
+import os
+import socket
+import sys
+import threading
+import time
+import tracemalloc
+from typing import *
+
+from server import outbound
+
+root = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+
+class SamplingProfiler:
+    """
+    Samples a thread's stack from a background thread every interval seconds, counting how often each stack is
+    seen. The profiled thread doesn't do anything extra, so it costs little more than the sampling thread's share
+    of the GIL.
+    """
+
+    def __init__(self, thread_id: int, interval: float = 0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks: Counter[Tuple[str, ...]] = collections.Counter()
+        self.samples = 0
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame:
+                stack.append(describe(frame.f_code))
+                frame = frame.f_back
+            self.stacks[tuple(reversed(stack))] += 1
+            self.samples += 1
+
+    def collapsed(self) -> str:
+        """
+        :return: the stacks seen as "outermost;...;innermost count" lines
+        """
+        return ''.join(f"{';'.join(stack)} {count}\n" for stack, count in self.stacks.most_common())
+
+
+def describe(code) -> str:
+    return f"{code.co_name} ({relative(code.co_filename)}:{code.co_firstlineno})"
+
+
+def relative(filename: str) -> str:
+    if filename.startswith(root):
+        return os.path.relpath(filename, root)
+    return filename.rsplit(f"site-packages{os.sep}", 1)[-1]
+
+
+def subsystem(filename: str) -> str:
+    """
+    Which part of the game or which library a source file belongs to, e.g. 'server/protocol', 'networking',
+    'django'.
+    """
+    path = relative(filename)
+    if os.path.isabs(path) or path.startswith('<'):
+        return 'python'
+    parts = path.split(os.sep)
+    if parts[0] == 'server':
+        return os.path.splitext('/'.join(parts[:2]))[0]
+    return os.path.splitext(parts[0])[0]
+
+
+def tracemalloc_snapshot(previous: Optional[tracemalloc.Snapshot], top: int) -> Tuple[tracemalloc.Snapshot, str]:
+    """
+    Totals the memory allocated by each subsystem, blaming the game's own code where it's in the traceback rather
+    than the library it called.
+    :return: the snapshot, and a report comparing it to the previous snapshot
+    """
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, __file__),
+    ))
+
+    def by_subsystem(s: tracemalloc.Snapshot) -> Dict[str, int]:
+        totals = collections.Counter()
+        for stat in s.statistics('traceback'):
+            frames = [subsystem(frame.filename) for frame in reversed(stat.traceback)]
+            ours = [f for f in frames if f.startswith('server/') or f in ('networking', 'maps')]
+            totals[ours[0] if ours else frames[0]] += stat.size
+        return totals
+
+    now = by_subsystem(snapshot)
+    before = by_subsystem(previous) if previous else {}
+    lines = [f"{'subsystem':<24} {'KiB':>10} {'change':>10}"]
+    for name, size in now.most_common():
+        lines.append(f"{name:<24} {size / 1024:10.1f} {(size - before.get(name, 0)) / 1024:+10.1f}")
+
+    if previous:
+        lines.append("\nGrew most since the last snapshot:")
+        stats = snapshot.compare_to(previous, 'lineno')
+    else:
+        lines.append("\nLargest:")
+        stats = snapshot.statistics('lineno')
+    for stat in stats[:top]:
+        frame = stat.traceback[0]
+        change = f" ({stat.size_diff / 1024:+.1f} KiB)" if previous else ''
+        lines.append(f"{relative(frame.filename)}:{frame.lineno}: {stat.size / 1024:.1f} KiB in {stat.count} blocks"
+                     f"{change}")
+    return snapshot, '\n'.join(lines) + '\n'
+
+
+def sizes(server) -> str:
+    protos = list(server.connected_protocols)
+    lines = [f"{len(protos)} protocols, {len(server.instances)} instances, {len(server.deferreds)} deferreds"]
+
+    for name, measure in (('visible_instances', lambda p: len(p.visible_instances)),
+                          ('outgoing', lambda p: len(p.outgoing))):
+        values = [measure(p) for p in protos]
+        if values:
+            worst = max(protos, key=measure)
+            lines.append(f"{name}: total {sum(values)}, max {max(values)} ({worst.username or worst.connection_id})")
+
+    # A deferred which should have been removed (a gathering loop left running, say) shows up as a growing count
+    deferreds = collections.Counter(getattr(d._f, '__qualname__', repr(d._f)) for d in server.deferreds)
+    for f, count in deferreds.most_common():
+        lines.append(f"  {count:6} deferred {f}")
+    return '\n'.join(lines) + '\n'
+
+
+def connections(server) -> str:
+    lines = []
+    for proto in sorted(server.connected_protocols, key=lambda p: p.connection_id):
+        peer = proto.transport.getPeer() if proto.transport else None
+        where = f" at {proto.player_instance.y},{proto.player_instance.x} in room {proto.player_instance.room_id}" \
+            if proto.player_instance else ''
+        behind = f", behind for {time.monotonic() - proto.paused_since:.1f}s" if proto.paused_since is not None else ''
+        rtt = f", {proto.heartbeat.rtt * 1000:.0f}ms round trip" if proto.heartbeat.rtt is not None else ''
+        if proto.detached:
+            behind = ", disconnected and held to resume"
+        lines.append(f"#{proto.connection_id} {getattr(peer, 'host', '?')} {proto.state.__name__} "
+                     f"{proto.username or '-'}{where}: {len(proto.outgoing)} queued, "
+                     f"{outbound.buffered_bytes(proto.transport)} bytes buffered, "
+                     f"{proto.outgoing.coalesced} coalesced, {proto.outgoing.dropped} dropped{rtt}{behind}")
+    return '\n'.join(lines) + '\n' if lines else "Nobody is connected\n"
+
+
+def listen(path: str, server):
+    """
+    Listens for admin commands on a UNIX socket at path, which only this user can use.
+    """
+    from twisted.internet import reactor
+    from twisted.internet.protocol import Factory
+    from twisted.protocols.basic import LineOnlyReceiver
+    from networking.logger import get_logger
+
+    log = get_logger('admin')
+
+    class AdminProtocol(LineOnlyReceiver):
+        delimiter = b'\n'
+        profiling = False       # one profile at a time
+        last_snapshot: Optional[tracemalloc.Snapshot] = None
+
+        def lineReceived(self, line: bytes):
+            args = line.decode('utf-8', 'replace').split()
+            command = args[0] if args else 'help'
+            log.info("Admin command: %s", ' '.join(args))
+            try:
+                reply = self.run(command, args[1:])
+            except (ValueError, IndexError) as e:
+                reply = f"Bad arguments: {e}\n"
+            if reply is not None:
+                self.reply(reply)
+
+        def reply(self, text: str):
+            self.transport.write(text.encode('utf-8'))
+            self.transport.loseConnection()
+
+        def run(self, command: str, args: List[str]) -> Optional[str]:
+            if command == 'profile':
+                return self.profile(float(args[0]), float(args[1]) / 1000 if len(args) > 1 else 0.005)
+            if command == 'tracemalloc':
+                return self.tracemalloc(args[0], args[1:])
+            if command == 'sizes':
+                return sizes(server)
+            if command == 'connections':
+                return connections(server)
+            return __doc__
+
+        def profile(self, seconds: float, interval: float) -> Optional[str]:
+            # Checked before the sampler starts, which nothing would stop if callLater refused the time, and an
+            # interval of 0 would spin, keeping the reactor from the GIL
+            if not seconds > 0:
+                raise ValueError("SECONDS must be more than 0")
+            if not interval > 0:
+                raise ValueError("INTERVAL_MS must be more than 0")
+            if AdminProtocol.profiling:
+                return "Already profiling\n"
+            AdminProtocol.profiling = True
+            profiler = SamplingProfiler(threading.get_ident(), interval)
+            profiler.start()
+
+            def finish():
+                profiler.stop()
+                AdminProtocol.profiling = False
+                log.info("Profiled %s samples", profiler.samples)
+                self.reply(profiler.collapsed())
+            reactor.callLater(seconds, finish)
+
+        def tracemalloc(self, action: str, args: List[str]) -> str:
+            if action == 'start':
+                tracemalloc.start(int(args[0]) if args else 10)
+                AdminProtocol.last_snapshot = None
+                return "Tracing memory allocations\n"
+            if action == 'stop':
+                tracemalloc.stop()
+                AdminProtocol.last_snapshot = None
+                return "Stopped tracing memory allocations\n"
+            if action == 'snapshot':
+                if not tracemalloc.is_tracing():
+                    return "Not tracing memory allocations; send tracemalloc start first\n"
+                AdminProtocol.last_snapshot, report = tracemalloc_snapshot(AdminProtocol.last_snapshot,
+                                                                           int(args[0]) if args else 15)
+                return report
+            raise ValueError(f"unknown action {action}")
+
+    if os.path.exists(path):
+        os.remove(path)     # left behind by a server which didn't shut down cleanly
+    reactor.listenUNIX(path, Factory.forProtocol(AdminProtocol), mode=0o600)
+    log.info("Listening for admin commands on %s", path)
+
+
+def main():
+    """
+    Sends a command to the server's admin socket and prints the reply:
+        python -m server.admin SOCKET COMMAND [ARGS...]
+    """
+    if len(sys.argv) < 3:
+        print(__doc__)
+        sys.exit(1)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(sys.argv[1])
+        s.sendall(' '.join(sys.argv[2:]).encode('utf-8') + b'\n')
+        while True:
+            data = s.recv(65536)
+            if not data:
+                break
+            sys.stdout.buffer.write(data)
+
+
+if __name__ == '__main__':
+    main()
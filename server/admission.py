@@ -0,0 +1,135 @@
+"""
+Admission of logins and registrations, so a crowd of them, e.g. every client reconnecting after a restart, can't
+starve the tick or the database.
+
+Each login or registration costs a few queries and a PBKDF2 hash, so rather than being handled as they arrive they
+wait in a queue, and each tick takes at most per_tick of them off it, and none while concurrency of them are still
+hashing. Hashing is done in the reactor's thread pool, so it overlaps the ticks. Clients waiting are told how far
+from the front they are when they join the queue and every second after.
+
+Each address can only make so many attempts: BURST straight away, then RATE a second. Beyond that, and once
+MAX_QUEUED are waiting, attempts are refused.
+"""
+import time
+from collections import deque
+from typing import *
+
+from networking import packet
+from networking.logger import get_logger
+from server import metrics
+
+log = get_logger('admission')
+
+PER_TICK = 2            # logins and registrations started each tick
+CONCURRENCY = 4         # logins and registrations hashing passwords at once
+MAX_QUEUED = 1000
+RATE = 0.5              # attempts a second each address can make, once it's used its burst, or 0 for no limit
+BURST = 5               # attempts an address can make at once
+
+
+class AdmissionQueue:
+    def __init__(self, server):
+        self.server = server
+        self.per_tick = PER_TICK
+        self.concurrency = CONCURRENCY
+        self.rate = RATE        # or 0 for no limit
+        self.burst = BURST
+
+        self.waiting: Deque[Tuple[Any, packet.Packet, float]] = deque()   # protocol, packet, when it joined
+        self.hashing = 0
+        self.allowances: Dict[str, Tuple[float, float]] = {}    # address : attempts left, clock() when counted
+
+    def __len__(self) -> int:
+        return len(self.waiting)
+
+    def submit(self, proto, p: packet.Packet):
+        """
+        Queues a login or registration, or refuses it if there are too many.
+        """
+        if not self.allow(proto.host()):
+            metrics.ADMISSIONS_REFUSED.inc('rate')
+            proto.outgoing.append(packet.DenyPacket("Too many attempts. Please try again in a moment."))
+            return
+
+        # A client sending another while it's waiting keeps its place
+        for i, (queued, _, joined) in enumerate(self.waiting):
+            if queued is proto:
+                self.waiting[i] = (proto, p, joined)
+                return
+
+        if len(self.waiting) >= MAX_QUEUED:
+            metrics.ADMISSIONS_REFUSED.inc('full')
+            proto.outgoing.append(packet.DenyPacket("The server is busy. Please try again in a moment."))
+            return
+        self.waiting.append((proto, p, time.monotonic()))
+        if len(self.waiting) > self.per_tick:
+            proto.outgoing.append(packet.QueuePositionPacket(len(self.waiting)))
+
+    def allow(self, host: str) -> bool:
+        """
+        Counts an attempt from an address against its allowance.
+        :return: whether it has any allowance left
+        """
+        if not self.rate:
+            return True
+        now = self.clock()
+        left, counted = self.allowances.get(host, (self.burst, now))
+        left = min(self.burst, left + (now - counted) * self.rate)
+        if left < 1:
+            self.allowances[host] = left, now
+            return False
+        self.allowances[host] = left - 1, now
+        return True
+
+    def tick(self):
+        """
+        Starts this tick's share of the logins and registrations waiting.
+        """
+        started = 0
+        while self.waiting and started < self.per_tick and self.hashing < self.concurrency:
+            proto, p, joined = self.waiting.popleft()
+            if proto not in self.server.connected_protocols:
+                continue    # gave up waiting
+            metrics.ADMISSION_WAIT_SECONDS.observe(time.monotonic() - joined)
+            started += 1
+            if isinstance(p, packet.LoginPacket):
+                proto.login_user(p)
+            else:
+                proto.register_user(p)
+
+        if self.waiting and self.server.total_ticks % self.server.tickrate == 0:
+            for position, (proto, _, _) in enumerate(self.waiting, 1):
+                proto.outgoing.append(packet.QueuePositionPacket(position))
+
+        # Addresses which have made up their allowance needn't be remembered
+        if self.rate and self.server.total_ticks % (60 * self.server.tickrate) == 0:
+            now = self.clock()
+            full = [host for host, (left, counted) in self.allowances.items()
+                    if left + (now - counted) * self.rate >= self.burst]
+            for host in full:
+                del self.allowances[host]
+
+    def clock(self) -> float:
+        """
+        Seconds of game time, which replays of a recording go through in the same way, however fast they run.
+        """
+        return self.server.total_ticks / self.server.tickrate
+
+    def hash(self, f: Callable[..., Any], *args) -> 'defer.Deferred':
+        """
+        Calls a password hashing function in the reactor's thread pool, or straight away when recording or replaying,
+        so the result arrives on the same tick every time.
+        :return: a Deferred which fires with what it returns, back on the reactor thread
+        """
+        # Imported here rather than at the top, so the server can import this module for its arguments' defaults
+        # and still have its port bound before it imports Twisted
+        from twisted.internet import defer, threads
+        if self.server.recorder:
+            return defer.maybeDeferred(f, *args)
+
+        self.hashing += 1
+
+        def done(result):
+            self.hashing -= 1
+            return result
+        return threads.deferToThread(f, *args).addBoth(done)
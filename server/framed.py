@@ -0,0 +1,57 @@
+"""
+A client's connection as the server reads and writes it, framed as networking/framing.py describes. Netstrings and
+binary frames are both read, whichever the client sends, and everything's sent as netstrings until the client
+has said it can read binary frames and the protocol calls use_framing.
+"""
+from typing import *
+
+from twisted.internet.protocol import Protocol
+
+from networking import framing
+from networking.logger import get_logger
+
+log = get_logger('framed')
+
+
+class FramedReceiver(Protocol):
+    """
+    Like Twisted's NetstringReceiver, which it replaced: subclasses get each frame's data in stringReceived, and
+    send with sendString or, for several at once, sendStrings.
+    """
+    MAX_LENGTH = 99999
+    BUFFER_SIZE = 4096  # to start with, as there's one per connection; it grows if a read doesn't fit
+
+    def __init__(self):
+        self.framing: Optional[str] = None      # what we send with, or None for netstrings
+        self._decoder = framing.FrameDecoder(self.MAX_LENGTH, self.BUFFER_SIZE)
+
+    def use_framing(self, chosen: Optional[str]):
+        """
+        :param chosen: framing.BINARY to send binary frames from now on, or None to carry on with netstrings
+        """
+        self.framing = chosen
+
+    def dataReceived(self, data: bytes):
+        try:
+            frames = self._decoder.feed(data)
+        except framing.FramingError as e:
+            log.warning("Disconnecting %s: %s", self.transport.getPeer(), e)
+            self.transport.loseConnection()
+            return
+        for frame in frames:
+            if self.transport.disconnecting:
+                return
+            self.stringReceived(frame)
+
+    def stringReceived(self, string: bytes):
+        raise NotImplementedError
+
+    def sendString(self, string: bytes):
+        self.transport.write(framing.frame(string, self.framing))
+
+    def sendStrings(self, strings: Sequence[bytes]):
+        """
+        Sends several frames in one write, without copying them together first.
+        """
+        if strings:
+            self.transport.writeSequence(framing.frame_sequence(strings, self.framing))
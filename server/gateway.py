@@ -0,0 +1,308 @@
+"""
+The front-end of a server split into processes (python server --shards N --frontends M). The game is simulated by
+N workers, each ticking some of the rooms, and the M front-ends hold the clients' connections between them, do
+their encryption, compression and framing, and pass their packets to whichever worker simulates the room their
+player is in.
+See server/ipc.py for what passes between them.
+"""
+import json
+import logging
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from typing import *
+
+import rsa
+from twisted.application.internet import ClientService
+from twisted.internet import reactor
+from twisted.internet.endpoints import UNIXClientEndpoint
+from twisted.internet.interfaces import IPushProducer
+from twisted.internet.protocol import Factory, connectionDone
+from zope.interface import implementer
+
+from networking import compression, cryptography, framing, packet
+from networking.logger import get_logger
+from server import ipc, metrics, outbound, sessions
+from server.framed import FramedReceiver
+
+log = get_logger('gateway')
+
+serverdir = os.path.dirname(os.path.realpath(__file__))
+
+RESUME = b'{"a":"ResumePacket"'     # how a ResumePacket starts, to spot one without decoding every packet
+
+
+class Gateway(Factory):
+    def __init__(self, shards: int, socketdir: str, index: int = 0):
+        """
+        :param shards: how many workers there are
+        :param socketdir: where the workers' sockets are
+        :param index: which of the front-ends this is, when there are several sharing the listening socket
+        """
+        self.shards = shards
+        self.socketdir = socketdir
+        self.index = index
+        self.public_key, self.private_key = cryptography.load_rsa_keypair(serverdir)
+
+        # all connected clients. conn : protocol
+        self.clients: Dict[int, GatewayProtocol] = {}
+        self.connections_made = 0
+
+        self.links: List[Optional[WorkerLink]] = [None] * shards
+        self.pending: List[List[bytes]] = [[] for _ in range(shards)]    # messages for workers not connected yet
+        self.services: List[ClientService] = []
+        self.stopping = False
+
+    def connect_workers(self):
+        """
+        Keeps connecting to each worker until it's listening, and again if it goes away.
+        """
+        for index in range(self.shards):
+            factory = Factory.forProtocol(lambda i=index: WorkerLink(self, i))
+            endpoint = UNIXClientEndpoint(reactor, ipc.socket_path(self.socketdir, index))
+            service = ClientService(endpoint, factory, retryPolicy=lambda attempt: min(0.1 * 2 ** attempt, 2))
+            service.startService()
+            self.services.append(service)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+    def stop(self):
+        self.stopping = True
+        for service in self.services:
+            service.stopService()
+
+    def next_conn(self) -> int:
+        """
+        An id for a new connection, unique across all the front-ends: the top byte is this front-end's index.
+        """
+        self.connections_made += 1
+        return self.index << 24 | self.connections_made & 0xFFFFFF
+
+    def linked(self, link: 'WorkerLink'):
+        log.info("Connected to worker %s", link.index)
+        self.links[link.index] = link
+        for message in self.pending[link.index]:
+            link.sendString(message)
+        self.pending[link.index].clear()
+
+    def unlinked(self, link: 'WorkerLink'):
+        self.links[link.index] = None
+        if self.stopping:
+            return
+        log.error("Lost worker %s; disconnecting its clients", link.index)
+        for client in list(self.clients.values()):
+            if client.worker == link.index:
+                client.transport.loseConnection()
+
+    def send(self, worker: int, kind: int, conn: int, body: Union[bytes, dict] = b''):
+        link = self.links[worker]
+        if link:
+            link.send(kind, conn, body)
+        else:
+            self.pending[worker].append(ipc.encode(kind, conn, body))
+
+    def buildProtocol(self, addr):
+        log.info("Adding a new client from %s.", addr)
+        return GatewayProtocol(self)
+
+
+@implementer(IPushProducer)
+class GatewayProtocol(FramedReceiver):
+    """
+    A client's connection, relayed to the worker simulating its player's room.
+    """
+
+    def __init__(self, gateway: Gateway):
+        super().__init__()
+        self.gateway = gateway
+        self.conn: int = gateway.next_conn()
+        self.worker = ipc.LOBBY
+        self.client_pub_key: Optional[rsa.key.PublicKey] = None
+        self.compressor: Optional[compression.Compressor] = None
+        self.decompressor: Optional[compression.Decompressor] = None
+        self.paused_since: Optional[float] = None   # when the transport last asked us to stop writing, if it has
+
+    def connectionMade(self):
+        self.gateway.clients[self.conn] = self
+        self.transport.registerProducer(self, True)
+        self.gateway.send(self.worker, ipc.CONNECT, self.conn, self.hello())
+
+    def connectionLost(self, reason=connectionDone):
+        del self.gateway.clients[self.conn]
+        self.gateway.send(self.worker, ipc.LOST, self.conn)
+
+    def stringReceived(self, string: bytes):
+        start = time.perf_counter()
+        try:
+            string = cryptography.decrypt(string, self.gateway.private_key)
+        except Exception as e:
+            log.warning("Packet from connection %s came through unencrypted: %s", self.conn, e)
+        metrics.CRYPTO_SECONDS.observe(time.perf_counter() - start, 'decrypt')
+
+        if self.decompressor:
+            start = time.perf_counter()
+            try:
+                string = self.decompressor.decompress(string)
+            except zlib.error as e:
+                log.warning("Disconnecting connection %s: couldn't decompress packet: %s", self.conn, e)
+                self.transport.abortConnection()
+                return
+            metrics.COMPRESSION_SECONDS.observe(time.perf_counter() - start, 'decompress')
+
+        # The workers answer the key exchange, but it's the gateway which needs the client's key, and which
+        # compresses and frames as the worker's answer says, the worker choosing the same way
+        if not self.client_pub_key:
+            p = packet.frombytes(string)
+            if isinstance(p, packet.ClientKeyPacket):
+                self.client_pub_key = rsa.key.PublicKey(p.payloads[0].value, p.payloads[1].value)
+                if compression.choose(p.payloads[2].value):
+                    self.compressor = compression.Compressor()
+                    self.decompressor = compression.Decompressor()
+                self.use_framing(framing.choose(p.payloads[3].value))
+        elif string.startswith(RESUME):
+            self.route_resume(packet.frombytes(string))
+
+        self.gateway.send(self.worker, ipc.DATA, self.conn, string)
+
+    def route_resume(self, p: Optional[packet.Packet]):
+        """
+        Sends the connection to the worker holding the session it wants to resume, which its token says.
+        """
+        worker = sessions.worker_of(p.payloads[0].value) if p else None
+        if worker is None or worker == self.worker or worker >= self.gateway.shards:
+            return
+        self.gateway.send(self.worker, ipc.LOST, self.conn)
+        self.rebind(worker, ipc.CONNECT, self.hello())
+
+    def pauseProducing(self):
+        self.paused_since = time.monotonic()
+
+    def resumeProducing(self):
+        self.paused_since = None
+
+    def stopProducing(self):
+        pass
+
+    def send(self, data: bytes):
+        # Packets for a client who's behind can only pile up in the transport here, with nothing to coalesce them
+        if self.paused_since is not None and time.monotonic() - self.paused_since > outbound.MAX_PAUSED_SECONDS:
+            log.warning("Disconnecting connection %s: %s bytes buffered", self.conn,
+                        outbound.buffered_bytes(self.transport))
+            metrics.SLOW_DISCONNECTS.inc()
+            self.paused_since = None
+            self.transport.abortConnection()
+        if self.transport.disconnecting:
+            return
+
+        message = outbound.compress(self.compressor, data) if self.compressor else data
+        start = time.perf_counter()
+        try:
+            message = cryptography.encrypt(message, self.client_pub_key)
+        except Exception as e:
+            log.error("Couldn't encrypt packet %s for connection %s. Error was %s.", data, self.conn, e)
+            return
+        metrics.CRYPTO_SECONDS.observe(time.perf_counter() - start, 'encrypt')
+        self.sendString(message)
+
+    def hello(self) -> dict:
+        return {'host': getattr(self.transport.getPeer(), 'host', '')}
+
+    def rebind(self, worker: int, kind: int, body: Union[bytes, dict] = b''):
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Connection %s moving from worker %s to %s", self.conn, self.worker, worker)
+        self.worker = worker
+        self.gateway.send(worker, kind, self.conn, body)
+
+
+class WorkerLink(ipc.MessageReceiver):
+    def __init__(self, gateway: Gateway, index: int):
+        self.gateway = gateway
+        self.index = index
+
+    def connectionMade(self):
+        self.gateway.linked(self)
+
+    def connectionLost(self, reason=connectionDone):
+        self.gateway.unlinked(self)
+
+    def message_received(self, kind: int, conn: int, body: bytes):
+        if kind in (ipc.OFFLINE, ipc.HELD, ipc.RESUMED):
+            self.gateway.send(ipc.LOBBY, kind, conn, body)
+            return
+        if kind == ipc.RELEASE:
+            self.gateway.send(json.loads(body)['worker'], kind, conn, body)
+            return
+
+        client = self.gateway.clients.get(conn)
+        if kind == ipc.HANDOFF:
+            worker = ipc.worker_for(json.loads(body)['room'], self.gateway.shards)
+            if client:
+                client.rebind(worker, ipc.BIND, body)
+            else:
+                # It disconnected while being handed off, so the player still needs logging out
+                self.gateway.send(worker, ipc.BIND, conn, body)
+                self.gateway.send(worker, ipc.LOST, conn)
+        elif not client:
+            return      # it disconnected while the worker was busy
+        elif kind == ipc.SEND:
+            client.send(body)
+        elif kind == ipc.UNBIND:
+            client.rebind(ipc.LOBBY, ipc.CONNECT, client.hello())
+        elif kind == ipc.CLOSE:
+            if json.loads(body).get('graceful'):
+                client.transport.loseConnection()
+            else:
+                client.transport.abortConnection()
+
+
+def worker_command(index: int, shards: int, socketdir: str, extra: Sequence[str] = ()) -> List[str]:
+    return [sys.executable, serverdir, '--worker', str(index), '--shards', str(shards), '--socket', socketdir, *extra]
+
+
+def frontend_command(index: int, shards: int, socketdir: str, fd: int, extra: Sequence[str] = ()) -> List[str]:
+    return [sys.executable, serverdir, '--frontend', str(index), '--shards', str(shards), '--socket', socketdir,
+            '--listen-fd', str(fd), *extra]
+
+
+def run(port: int, shards: int, frontends: int, worker_args: Sequence[str] = ()):
+    """
+    Starts the workers and the other front-ends, then is the first front-end, until the reactor stops.
+    :param worker_args: more command line arguments for the workers, which the other front-ends are given too
+    """
+    socketdir = tempfile.mkdtemp(prefix='moonlapse-')
+    processes = [subprocess.Popen(worker_command(index, shards, socketdir, worker_args)) for index in range(shards)]
+
+    # The front-ends all accept connections from the one listening socket
+    listener = socket.create_server(('', port))
+    listener.setblocking(False)
+    for index in range(1, frontends):
+        processes.append(subprocess.Popen(frontend_command(index, shards, socketdir, listener.fileno(), worker_args),
+                                          pass_fds=(listener.fileno(),)))
+
+    def stop():
+        # The other front-ends first, so they don't see the workers go
+        for process in reversed(processes):
+            process.terminate()
+            process.wait()
+        shutil.rmtree(socketdir, ignore_errors=True)
+    reactor.addSystemEventTrigger('after', 'shutdown', stop)
+
+    log.info("Listening on port %s with %s front-ends and %s workers", port, frontends, shards)
+    run_frontend(0, shards, socketdir, listener.fileno())
+
+
+def run_frontend(index: int, shards: int, socketdir: str, fd: int):
+    """
+    Runs front-end number index, accepting clients from the listening socket fd and connecting to the workers'
+    sockets in socketdir.
+    """
+    gateway = Gateway(shards, socketdir, index)
+    reactor.adoptStreamPort(fd, socket.AF_INET, gateway)
+    gateway.connect_workers()
+    if index:
+        ipc.exit_with_parent()
+    reactor.run()
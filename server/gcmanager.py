@@ -0,0 +1,74 @@
+import gc
+import time
+from typing import *
+
+from server import metrics
+from networking.logger import get_logger
+
+log = get_logger('gc')
+
+_started = 0.0     # when the collection in progress started
+
+
+def _time_collection(phase: str, info: Dict[str, int]):
+    """
+    Records a collection's pause. One callback for the process, however many servers it makes, e.g. the benchmarks
+    and replays, so each collection is counted once.
+    """
+    global _started
+    if phase == 'start':
+        _started = time.perf_counter()
+    else:
+        generation = str(info['generation'])
+        metrics.GC_PAUSE_SECONDS.observe(time.perf_counter() - _started, generation)
+        metrics.GC_COLLECTED.inc(generation, amount=info['collected'])
+
+
+class GCManager:
+    """
+    Keeps the garbage collector out of the way of ticks. The world loaded at startup lives as long as the server,
+    so once it's loaded it's frozen, and collections never look at it again. The young generation's threshold is
+    raised so the packets and dicts made every tick (nearly all freed by reference counting anyway) trigger fewer
+    collections, and full collections are left to be run in the time between ticks instead of landing mid-tick.
+    Every collection's pause is recorded in the moonlapse_gc_pause_seconds metric, next to the tick times.
+    """
+
+    THRESHOLDS = (50000, 20, 1000)  # gen 0 allocations, gen 0 collections per gen 1, gen 1 collections per gen 2
+    FULL_INTERVAL = 60              # seconds between full collections, when there's time for one between ticks
+    MAX_INTERVAL = 600              # seconds after which a full collection runs even if ticks are overrunning
+
+    def __init__(self, tickrate: int):
+        self.tickrate = tickrate
+        self.last_full = time.monotonic()
+        self.full_pause = 0.0       # how long the last full collection took
+
+        if _time_collection not in gc.callbacks:
+            gc.callbacks.append(_time_collection)
+        metrics.GC_FROZEN.set_function(gc.get_freeze_count)
+
+    def freeze(self):
+        """
+        Moves everything alive now out of the collector's sight for good, and tunes the thresholds. Call this once
+        the world is loaded.
+        """
+        gc.collect()
+        gc.freeze()
+        gc.set_threshold(*GCManager.THRESHOLDS)
+        self.last_full = time.monotonic()
+        log.info("Froze %s objects after loading; collection thresholds now %s", gc.get_freeze_count(),
+                 GCManager.THRESHOLDS)
+
+    def after_tick(self, tick_seconds: float):
+        """
+        Runs a full collection if one is due and the rest of this tick's time is enough to fit it in.
+        """
+        since = time.monotonic() - self.last_full
+        if since < GCManager.FULL_INTERVAL:
+            return
+
+        spare = 1 / self.tickrate - tick_seconds
+        if self.full_pause < spare or since > GCManager.MAX_INTERVAL:
+            start = time.perf_counter()
+            gc.collect()
+            self.full_pause = time.perf_counter() - start
+            self.last_full = time.monotonic()
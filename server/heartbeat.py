@@ -0,0 +1,76 @@
+"""
+Pings each client every INTERVAL seconds, so connections which have died without TCP noticing are found and their
+players logged out, rather than being ticked and seen in their rooms until it does. A client which hasn't answered
+anything for TIMEOUT seconds is disconnected, as is one which hasn't done anything but answer pings for
+IDLE_SECONDS (or ENTRY_IDLE_SECONDS, before logging in). The time each ping takes to be answered is the connection's
+round trip time.
+
+Everything is counted in ticks, so replays of a recording ping and reap on the same ticks.
+"""
+import time
+from typing import *
+
+from networking import packet
+from server import metrics
+
+INTERVAL = 5
+TIMEOUT = 20
+IDLE_SECONDS = 30 * 60
+ENTRY_IDLE_SECONDS = 5 * 60
+
+UNRESPONSIVE = 'unresponsive'
+IDLE = 'idle'
+
+
+class Heartbeat:
+    """
+    One connection's pings, and when its client was last heard from.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.last_heard = server.total_ticks    # when anything, even a pong, last arrived
+        self.last_active = server.total_ticks   # when anything but a pong last arrived
+        self.last_ping = server.total_ticks
+        self.seq = 0
+        self.sent: Dict[int, float] = {}        # seq : when it was sent, of pings not answered yet
+        self.rtt: Optional[float] = None        # seconds, smoothed
+
+    def heard(self, active: bool = True):
+        self.last_heard = self.server.total_ticks
+        if active:
+            self.last_active = self.server.total_ticks
+
+    def check(self, logged_in: bool) -> Optional[str]:
+        """
+        :return: why the connection should be dropped, if it should
+        """
+        ticks, rate = self.server.total_ticks, self.server.tickrate
+        if ticks - self.last_heard > TIMEOUT * rate:
+            return UNRESPONSIVE
+        if ticks - self.last_active > (IDLE_SECONDS if logged_in else ENTRY_IDLE_SECONDS) * rate:
+            return IDLE
+        return None
+
+    def ping(self) -> Optional[packet.PingPacket]:
+        """
+        :return: a ping to send, if one's due
+        """
+        if self.server.total_ticks - self.last_ping < INTERVAL * self.server.tickrate:
+            return None
+        self.last_ping = self.server.total_ticks
+        self.seq += 1
+        # Pings which were never answered needn't be remembered for long
+        for seq in [seq for seq in self.sent if seq < self.seq - 4]:
+            del self.sent[seq]
+        self.sent[self.seq] = time.perf_counter()
+        return packet.PingPacket(self.seq)
+
+    def pong(self, seq: int):
+        self.heard(active=False)
+        sent = self.sent.pop(seq, None)
+        if sent is None:
+            return
+        rtt = time.perf_counter() - sent
+        metrics.RTT_SECONDS.observe(rtt)
+        self.rtt = rtt if self.rtt is None else 0.8 * self.rtt + 0.2 * rtt
@@ -0,0 +1,116 @@
+"""
+Messages between the front-ends (server/gateway.py) of a server split into processes and its workers
+(server/worker.py). The front-ends hold the clients' connections and do their encryption, and each worker simulates
+some of the rooms. Every message is one Int32StringReceiver string, over a UNIX socket: a header of the message type
+and the front-end's id for the client connection it's about, then a body.
+
+    gateway -> worker   CONNECT     a client connected, or logged out and came back to the lobby; body is JSON
+                                    {"host": ...}
+                        DATA        the client sent a packet; body is the packet decrypted and decompressed
+                        LOST        the client disconnected
+                        BIND        a player arrives from another worker; body is the JSON from HANDOFF
+                        OFFLINE     (to the lobby) a player logged out; body is JSON {"player": pk}
+                        HELD        (to the lobby) a player's connection dropped and their session is held; body
+                                    is JSON {"player": pk, "worker": index of the worker holding it}
+                        RESUMED     (to the lobby) a player's held session was resumed; body is JSON
+                                    {"player": pk}
+                        RELEASE     (from the lobby) the player is logging in again, so log their held session out;
+                                    body is JSON {"player": pk, "worker": index}
+    worker -> gateway   SEND        send a packet to the client; body is the packet, not yet compressed or
+                                    encrypted
+                        HANDOFF     the player is going to a room another worker owns; body is JSON {"room": pk,
+                                    "player": pk, "instance": pk, "y": y, "x": x, "username": ...}
+                        UNBIND      the player logged out, so send the connection back to the lobby
+                        OFFLINE     a player logged out; body is JSON {"player": pk}
+                        HELD        a player's session is held, which the gateway passes on to the lobby
+                        RESUMED     a player's held session was resumed, likewise
+                        RELEASE     (from the lobby) for the worker holding a player's session, which the gateway
+                                    passes on to it
+                        CLOSE       disconnect the client, e.g. as another connection has resumed its session;
+                                    body is JSON {"graceful": whether to send what's been sent so far first}
+"""
+import json
+import os
+import struct
+from typing import *
+
+from twisted.protocols.basic import Int32StringReceiver
+
+from networking.logger import get_logger
+
+log = get_logger('ipc')
+
+CONNECT = 1
+DATA = 2
+LOST = 3
+BIND = 4
+SEND = 5
+HANDOFF = 6
+UNBIND = 7
+OFFLINE = 8
+CLOSE = 9
+HELD = 10
+RESUMED = 11
+RELEASE = 12
+
+LOBBY = 0   # the worker which handles logins and registrations, and which connections start and end up on
+
+NAMES = {CONNECT: 'CONNECT', DATA: 'DATA', LOST: 'LOST', BIND: 'BIND', SEND: 'SEND', HANDOFF: 'HANDOFF',
+         UNBIND: 'UNBIND', OFFLINE: 'OFFLINE', CLOSE: 'CLOSE', HELD: 'HELD', RESUMED: 'RESUMED', RELEASE: 'RELEASE'}
+
+_header = struct.Struct('!BI')
+
+
+def worker_for(room_id: int, shards: int) -> int:
+    """
+    :return: the index of the worker which simulates the room
+    """
+    return room_id % shards
+
+
+def socket_path(socketdir: str, worker: int) -> str:
+    return os.path.join(socketdir, f"worker{worker}.sock")
+
+
+def exit_with_parent():
+    """
+    Stops the reactor if the process which started this one goes away, as it's what everything comes through.
+    """
+    from twisted.internet import reactor, task
+    parent = os.getppid()
+
+    def check():
+        if os.getppid() != parent:
+            log.warning("The process which started this one has gone; stopping")
+            reactor.stop()
+    task.LoopingCall(check).start(1, False)
+
+
+def encode(kind: int, conn: int, body: Union[bytes, dict] = b'') -> bytes:
+    if isinstance(body, dict):
+        body = json.dumps(body).encode('utf-8')
+    return _header.pack(kind, conn) + body
+
+
+def decode(message: bytes) -> Tuple[int, int, bytes]:
+    """
+    :return: the message's type, the connection it's about, and its body
+    """
+    kind, conn = _header.unpack_from(message)
+    return kind, conn, message[_header.size:]
+
+
+class MessageReceiver(Int32StringReceiver):
+    """
+    One end of the link between the gateway and a worker.
+    """
+    MAX_LENGTH = 1 << 24
+
+    def send(self, kind: int, conn: int, body: Union[bytes, dict] = b''):
+        self.sendString(encode(kind, conn, body))
+
+    def stringReceived(self, message: bytes):
+        self.message_received(*decode(message))
+
+    def message_received(self, kind: int, conn: int, body: bytes):
+        raise NotImplementedError
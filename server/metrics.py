@@ -0,0 +1,333 @@
+"""
+Metrics about the running server, served in the Prometheus text format to anything on the same machine which asks
+http://127.0.0.1:<port>/metrics (run the server with --metrics-port).
+
+Counters and histograms are updated as things happen and cost a dictionary update or two, so they're fine on hot
+paths. Gauges which can be read straight off the server (how many players are connected, etc.) are instead given a
+function which is only called when the metrics are asked for.
+"""
+import bisect
+import threading
+import time
+from typing import *
+
+from networking.logger import get_logger
+
+log = get_logger('metrics')
+
+Labels = Tuple[str, ...]
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, description: str, labels: Labels = ()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+
+    def samples(self) -> Iterator[Tuple[str, Labels, Labels, float]]:
+        """
+        :return: each sample as (name suffix, label names, label values, value)
+        """
+        raise NotImplementedError
+
+    def expose(self) -> str:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, names, values, value in self.samples():
+            labels = ','.join(f'{n}="{_escape(v)}"' for n, v in zip(names, values))
+            lines.append(f"{self.name}{suffix}{{{labels}}} {value}" if labels else f"{self.name}{suffix} {value}")
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, description: str, labels: Labels = ()):
+        super().__init__(name, description, labels)
+        self.values: Dict[Labels, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        for values, value in self.values.items():
+            yield '', self.labels, values, value
+
+
+class Gauge(Metric):
+    """
+    A value which goes up and down. Either set it, or give it a function to call whenever it's read which returns
+    the value, or a dictionary of values by labels.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name: str, description: str, labels: Labels = ()):
+        super().__init__(name, description, labels)
+        self.values: Dict[Labels, float] = {}
+        self.function: Optional[Callable[[], Union[float, Dict[Labels, float]]]] = None
+
+    def set(self, value: float, *labels: str):
+        self.values[labels] = value
+
+    def set_function(self, function: Callable[[], Union[float, Dict[Labels, float]]]):
+        self.function = function
+
+    def samples(self):
+        values = self.values
+        if self.function:
+            values = self.function()
+            if not isinstance(values, dict):
+                values = {(): values}
+        for labels, value in values.items():
+            yield '', self.labels, labels, value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    # Seconds, from a fraction of a millisecond up to well past a whole tick
+    DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+
+    def __init__(self, name: str, description: str, labels: Labels = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(buckets)
+        self.counts: Dict[Labels, List[int]] = {}     # per bucket, the last being +Inf
+        self.sums: Dict[Labels, float] = {}
+
+    def observe(self, value: float, *labels: str):
+        counts = self.counts.get(labels)
+        if counts is None:
+            counts = self.counts[labels] = [0] * (len(self.buckets) + 1)
+            self.sums[labels] = 0
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sums[labels] += value
+
+    def time(self, *labels: str) -> 'Timer':
+        """
+        Times a with block, e.g.
+            with TICK_SECONDS.time():
+                ...
+        """
+        return Timer(self, labels)
+
+    def samples(self):
+        for labels, counts in self.counts.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield '_bucket', self.labels + ('le',), labels + ('+Inf' if bound == float('inf') else str(bound),), \
+                    cumulative
+            yield '_sum', self.labels, labels, self.sums[labels]
+            yield '_count', self.labels, labels, cumulative
+
+
+class Timer:
+    def __init__(self, histogram: Histogram, labels: Labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self.metrics:
+            raise ValueError(f"A metric called {metric.name} is already registered")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def expose(self) -> str:
+        return '\n'.join(metric.expose() for metric in self.metrics.values()) + '\n'
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+registry = Registry()
+
+CONNECTED = registry.register(Gauge('moonlapse_connected_protocols', "Clients connected"))
+LOGGED_IN = registry.register(Gauge('moonlapse_logged_in_protocols', "Clients logged in"))
+PLAYERS = registry.register(Gauge('moonlapse_players', "Players logged in per room", ('room',)))
+INSTANCES = registry.register(Gauge('moonlapse_instances', "Instances per room", ('room',)))
+DEFERREDS = registry.register(Gauge('moonlapse_deferreds', "Deferreds waiting to fire"))
+TICK_SECONDS = registry.register(Histogram('moonlapse_tick_seconds', "Time taken by each game tick"))
+OUTGOING_DEPTH = registry.register(Histogram(
+    'moonlapse_outgoing_depth', "Packets queued to a client when the tick sends them",
+    buckets=(0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+))
+OUTGOING_COALESCED = registry.register(Counter(
+    'moonlapse_outgoing_coalesced_total', "Instance updates not sent to clients who were behind, as later ones replaced them"
+))
+OUTGOING_DROPPED = registry.register(Counter(
+    'moonlapse_outgoing_dropped_total', "Updates not sent because the player changed rooms before they could be"
+))
+OUTGOING_DEFERRED = registry.register(Counter(
+    'moonlapse_outgoing_deferred_total', "Packets left for the next tick by the per-tick byte budget, by lane", ('lane',)
+))
+PAUSED = registry.register(Gauge('moonlapse_paused_protocols', "Clients which have fallen behind receiving"))
+BUFFERED_BYTES = registry.register(Gauge(
+    'moonlapse_buffered_bytes', "Bytes written for clients but not yet sent, in total and for the worst client", ('of',)
+))
+SLOW_DISCONNECTS = registry.register(Counter(
+    'moonlapse_slow_disconnects_total', "Clients disconnected for falling too far behind"
+))
+ADMISSION_QUEUED = registry.register(Gauge(
+    'moonlapse_admission_queued', "Logins and registrations waiting their turn"
+))
+ADMISSION_HASHING = registry.register(Gauge(
+    'moonlapse_admission_hashing', "Logins and registrations hashing passwords"
+))
+ADMISSION_WAIT_SECONDS = registry.register(Histogram(
+    'moonlapse_admission_wait_seconds', "Time logins and registrations waited their turn",
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+))
+ADMISSIONS_REFUSED = registry.register(Counter(
+    'moonlapse_admissions_refused_total', "Logins and registrations refused, by whether the address made too many "
+                                          "or the queue was full", ('reason',)
+))
+RTT_SECONDS = registry.register(Histogram(
+    'moonlapse_rtt_seconds', "Time from pinging a client to its answer arriving",
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+))
+REAPED = registry.register(Counter(
+    'moonlapse_reaped_total', "Clients disconnected for not answering pings or for being idle, by which", ('reason',)
+))
+HELD_SESSIONS = registry.register(Gauge(
+    'moonlapse_held_sessions', "Sessions held for clients whose connections dropped to resume"
+))
+SESSIONS_HELD = registry.register(Counter(
+    'moonlapse_sessions_held_total', "Sessions held after their connections dropped"
+))
+SESSIONS_EXPIRED = registry.register(Counter(
+    'moonlapse_sessions_expired_total', "Held sessions whose players were logged out without being resumed"
+))
+RESUMES = registry.register(Counter(
+    'moonlapse_resumes_total', "Attempts to resume a session, by whether they were resumed or refused", ('result',)
+))
+PACKETS_SENT = registry.register(Counter('moonlapse_packets_sent_total', "Packets sent", ('type',)))
+BYTES_SENT = registry.register(Counter('moonlapse_bytes_sent_total', "Bytes sent, encrypted", ('type',)))
+PACKETS_RECEIVED = registry.register(Counter('moonlapse_packets_received_total', "Packets received", ('type',)))
+BYTES_RECEIVED = registry.register(Counter(
+    'moonlapse_bytes_received_total', "Bytes received, decrypted", ('type',)
+))
+DB_QUERY_SECONDS = registry.register(Histogram(
+    'moonlapse_db_query_seconds', "Time taken by each database query, by statement", ('statement',)
+))
+GC_PAUSE_SECONDS = registry.register(Histogram(
+    'moonlapse_gc_pause_seconds', "Time taken by each garbage collection, by generation", ('generation',)
+))
+GC_COLLECTED = registry.register(Counter(
+    'moonlapse_gc_collected_total', "Objects freed by garbage collection, by generation", ('generation',)
+))
+GC_FROZEN = registry.register(Gauge('moonlapse_gc_frozen_objects', "Objects frozen out of garbage collection"))
+STARTUP_SECONDS = registry.register(Gauge('moonlapse_startup_seconds', "Time taken by each stage of startup", ('stage',)))
+CRYPTO_SECONDS = registry.register(Histogram(
+    'moonlapse_crypto_seconds', "Time taken encrypting or decrypting each packet", ('operation',)
+))
+COMPRESSION_SECONDS = registry.register(Histogram(
+    'moonlapse_compression_seconds', "Time taken compressing or decompressing each packet", ('operation',),
+    buckets=(0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005)
+))
+COMPRESSION_BYTES = registry.register(Counter(
+    'moonlapse_compression_bytes_total', "Bytes of packets sent compressed, before and after compression", ('stage',)
+))
+
+
+def watch_server(server):
+    """
+    Reads the gauges which describe the game world from server whenever they're asked for.
+    """
+    def players() -> Dict[Labels, float]:
+        counts = {}
+        for proto in server.connected_protocols:
+            if proto.logged_in and proto.player_instance:
+                room = (str(proto.player_instance.room_id),)
+                counts[room] = counts.get(room, 0) + 1
+        return counts
+
+    def instances() -> Dict[Labels, float]:
+        counts = {}
+        for instance in server.instances.values():
+            room = (str(instance.room_id),)
+            counts[room] = counts.get(room, 0) + 1
+        return counts
+
+    from server import outbound
+
+    def buffered() -> Dict[Labels, float]:
+        sizes = [outbound.buffered_bytes(proto.transport) for proto in server.connected_protocols]
+        return {('total',): sum(sizes), ('max',): max(sizes, default=0)}
+
+    CONNECTED.set_function(lambda: len(server.connected_protocols))
+    PAUSED.set_function(lambda: sum(proto.paused_since is not None for proto in server.connected_protocols))
+    BUFFERED_BYTES.set_function(buffered)
+    LOGGED_IN.set_function(lambda: sum(proto.logged_in for proto in server.connected_protocols))
+    PLAYERS.set_function(players)
+    INSTANCES.set_function(instances)
+    DEFERREDS.set_function(lambda: len(server.deferreds))
+    HELD_SESSIONS.set_function(lambda: len(server.sessions.held))
+    ADMISSION_QUEUED.set_function(lambda: len(server.admission))
+    ADMISSION_HASHING.set_function(lambda: server.admission.hashing)
+
+
+def time_queries(execute, sql, params, many, context):
+    """
+    A Django execute wrapper timing every query, by statement (SELECT, UPDATE, ...).
+    """
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        seconds = time.perf_counter() - start
+        with _queries_lock:     # queries run on the reactor's thread pool too
+            DB_QUERY_SECONDS.observe(seconds, sql.split(None, 1)[0].upper() if sql else '')
+
+
+_queries_lock = threading.Lock()
+
+
+def _watch_connection(sender, connection, **kwargs):
+    if time_queries not in connection.execute_wrappers:
+        connection.execute_wrappers.append(time_queries)
+
+
+def watch_database():
+    """
+    Times the queries on every thread's database connection. Each thread has its own, e.g. those loading the world
+    and checking passwords in the reactor's thread pool, so each is watched as it connects, as well as this
+    thread's if it's already connected.
+    """
+    from django.db import connection
+    from django.db.backends.signals import connection_created
+    connection_created.connect(_watch_connection, dispatch_uid='moonlapse_time_queries')
+    _watch_connection(None, connection)
+
+
+def listen(port: int):
+    """
+    Serves the metrics at http://127.0.0.1:<port>/metrics. Only this machine can connect.
+    """
+    from twisted.internet import reactor
+    from twisted.web.resource import Resource
+    from twisted.web.server import Site
+
+    class MetricsResource(Resource):
+        isLeaf = True
+
+        def render_GET(self, request):
+            request.setHeader(b'Content-Type', b'text/plain; version=0.0.4; charset=utf-8')
+            return registry.expose().encode('utf-8')
+
+    root = Resource()
+    root.putChild(b'metrics', MetricsResource())
+    reactor.listenTCP(port, Site(root), interface='127.0.0.1')
+    log.info("Serving metrics at http://127.0.0.1:%s/metrics", port)
@@ -1,33 +1,63 @@
-import json
+import logging
 import os
+import random
+import time
 
-import rsa
-from Crypto.Cipher import AES
-from twisted.internet import task
+from twisted.internet import defer, task, threads
 from twisted.internet.protocol import Factory
 from typing import *
 
-from server import manage, models
+import rsa
+
+from server import admission, manage, metrics, models, sessions
+from server.gcmanager import GCManager
 import server.protocol as protocol
 from networking import packet, cryptography
+from networking.logger import get_logger
 import maps
 
+log = get_logger('server')
+
 
 class MoonlapseServer(Factory):
     def __init__(self):
+        metrics.watch_database()
+
         # all protocols connected to server
         self.connected_protocols: Set[protocol.MoonlapseProtocol] = set()
+        self.connections_made = 0
+
+        # set to a recording.Recorder to record the session
+        self.recorder = None
+
+        # set to a sendpool.SendPool to encrypt outgoing packets on other threads or processes
+        self.sendpool = None
+
+        # resume tokens, and the protocols held for clients whose connections dropped to resume
+        self.sessions = self.session_store()
+
+        # logins and registrations waiting their turn
+        self.admission = admission.AdmissionQueue(self)
 
         # dict of all instances in the game. instance.pk : instance
         self.instances: Dict[int, models.InstancedEntity] = {}
-        for instance in models.InstancedEntity.objects.all():
-            self.instances[instance.pk] = instance
+
+        # every room's map. room.pk : map
+        self.roommaps: Dict[int, maps.Room] = {}
+
+        # encryption keys for sending
+        self.public_key: Optional[rsa.PublicKey] = None
+        self.private_key: Optional[rsa.PrivateKey] = None
+
+        # logins are refused until the world, keys and maps are loaded, by start() or load()
+        self.ready = False
 
         # set up game tick
         self.tickrate = 20      # hertz (ticks per second)
         tickloop = task.LoopingCall(self.tick)
         tickloop.start(1/self.tickrate, False)
         self.total_ticks = 0
+        self.gc = GCManager(self.tickrate)
 
         self.deferreds = []
 
@@ -35,18 +65,113 @@ class MoonlapseServer(Factory):
         # weather change check
         self.add_deferred(self.rain_check, 10*self.tickrate, True)
 
+        # ping clients and drop those which don't answer, once a second
+        self.add_deferred(self.check_heartbeats, self.tickrate, True)
+
         # save all instances to DB after loop
         # todo: 20s for testing; obvs should be less often
         self.add_deferred(self.save_all_instances, 20*self.tickrate, True)
 
-        # get encryption keys for sending
+        metrics.watch_server(self)
+
+    def start(self) -> defer.Deferred:
+        """
+        Loads the world, the encryption keys and the rooms' maps, all at once in other threads, while the reactor
+        gets on with accepting connections and ticking. Fires once everything's loaded and the server is ready.
+        """
+        started = time.perf_counter()
+
+        def stage(name: str, load: Callable[[], Any], apply: Callable[[Any], None]) -> defer.Deferred:
+            d = threads.deferToThread(self._timed, name, self._in_thread(load))
+            d.addCallback(apply)
+            return d
+
+        # The world only appears once everything's loaded, so nothing happens in it until players can log in
+        world: Dict[int, models.InstancedEntity] = {}
+
+        def ready(_):
+            self.instances.update(world)
+            self.gc.freeze()
+            self.ready = True
+            if self.recorder:
+                self.recorder.ready(self)
+            log.info("Ready to accept logins %.2fs after starting to load", time.perf_counter() - started)
+
+        def failed(failure):
+            log.error("Couldn't start the server: %s", failure.value.subFailure.getTraceback())
+            from twisted.internet import reactor
+            reactor.stop()
+
+        d = defer.DeferredList([
+            stage('world', self._load_instances, world.update),
+            stage('keys', self._load_keys, self._set_keys),
+            stage('maps', self._load_maps, self.roommaps.update)
+        ], fireOnOneErrback=True, consumeErrors=True)
+        d.addCallbacks(ready, failed)
+        return d
+
+    def load(self):
+        """
+        Loads everything start() does, one after the other on this thread, for when there's no reactor running.
+        """
+        self.instances.update(self._timed('world', self._load_instances))
+        self._set_keys(self._timed('keys', self._load_keys))
+        self.roommaps.update(self._timed('maps', self._load_maps))
+        self.gc.freeze()
+        self.ready = True
+
+    @staticmethod
+    def _timed(name: str, load: Callable[[], Any]) -> Any:
+        start = time.perf_counter()
+        result = load()
+        seconds = time.perf_counter() - start
+        metrics.STARTUP_SECONDS.set(seconds, name)
+        log.info("Loaded %s in %.2fs", name, seconds)
+        return result
+
+    @staticmethod
+    def _in_thread(load: Callable[[], Any]) -> Callable[[], Any]:
+        def run():
+            from django.db import connection
+            try:
+                return load()
+            finally:
+                # Each thread gets its own database connection, which would otherwise be left open
+                connection.close()
+        return run
+
+    @staticmethod
+    def _load_instances() -> Dict[int, models.InstancedEntity]:
+        instances = models.InstancedEntity.objects.select_related('entity', 'room')
+        return {instance.pk: instance for instance in instances}
+
+    @staticmethod
+    def _load_keys() -> Tuple[rsa.PublicKey, rsa.PrivateKey]:
         serverdir = os.path.dirname(os.path.realpath(__file__))
-        self.public_key, self.private_key = cryptography.load_rsa_keypair(serverdir)
+        return cryptography.load_rsa_keypair(serverdir)
+
+    def _set_keys(self, keys: Tuple[rsa.PublicKey, rsa.PrivateKey]):
+        self.public_key, self.private_key = keys
+
+    @staticmethod
+    def _load_maps() -> Dict[int, maps.Room]:
+        return {room.pk: maps.Room(room.pk, room.name, room.file_name) for room in models.Room.objects.all()}
+
+    def roommap(self, room: models.Room) -> maps.Room:
+        """
+        The map of a room, loaded the first time it's needed if it wasn't already.
+        """
+        roommap = self.roommaps.get(room.pk)
+        if not roommap:
+            roommap = self.roommaps[room.pk] = maps.Room(room.pk, room.name, room.file_name)
+        return roommap
 
     def tick(self):
         """
         Where all updates happen. Tick rate is how many updates per second.
         """
+        start = time.perf_counter()
+
         for deferred in list(self.deferreds):
             if deferred.expected_tick == self.total_ticks:
                 deferred.fire()
@@ -55,11 +180,27 @@ class MoonlapseServer(Factory):
                 else:
                     self.remove_deferred(deferred)
 
-        for proto in self.connected_protocols:
+        # In the order they connected, so replays of a recording tick them in the same order
+        protos = sorted(self.connected_protocols, key=lambda p: p.connection_id)
+        for proto in protos:
             proto.tick()
+        self.admission.tick()
 
+        # Then send everything the tick has queued up for each client
+        if self.sendpool:
+            self.sendpool.flush(protos)
+        else:
+            for proto in protos:
+                proto.flush()
+
+        if self.recorder:
+            self.recorder.ticked(self)
         self.total_ticks += 1
 
+        duration = time.perf_counter() - start
+        metrics.TICK_SECONDS.observe(duration)
+        self.gc.after_tick(duration)
+
     def add_deferred(self, f: callable, ticks: int, loops: bool, *args) -> 'Deferred':
         """
         @param f the function to be fired
@@ -73,6 +214,17 @@ class MoonlapseServer(Factory):
     def remove_deferred(self, d: 'Deferred'):
         self.deferreds.remove(d)
 
+    def rng(self, site: str, proto: Optional[protocol.MoonlapseProtocol] = None) -> random.Random:
+        """
+        Random numbers for one use of randomness, e.g. one gathering attempt. When recording, the seed is recorded
+        so a replay makes the same random choices.
+        :param site: names what the numbers are for
+        :param proto: the protocol they're for, if any
+        """
+        if self.recorder:
+            return self.recorder.rng(self, site, proto.connection_id if proto else 0)
+        return random
+
     def protocols_in_room(self, roomid: int) -> Set[protocol.MoonlapseProtocol]:
         s = set()
         for proto in self.connected_protocols:
@@ -107,8 +259,10 @@ class MoonlapseServer(Factory):
             * broadcast(packet.ServerLogPacket("Hello"), including=(Sue, James)) will send to only Sue and James
             * broadcast(packet.ServerLogPacket("Hello"), including=(Mary,), excluding=(Mary,)) will send to noone
         """
-        print(f"Broadcasting {p} to {tuple(p.username for p in including) if including else 'everyone'} "
-              f"{'except' + str(tuple(p.username for p in excluding)) if tuple(p.username for p in excluding) else ''}")
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Broadcasting %s to %s%s", p,
+                      tuple(proto.username for proto in including) if including else 'everyone',
+                      f" except {tuple(proto.username for proto in excluding)}" if excluding else '')
 
         sendto = including
         sendto = {proto for proto in sendto if proto not in excluding and (state == 'ANY' or proto.state.__name__ == state)}
@@ -124,9 +278,19 @@ class MoonlapseServer(Factory):
         self.broadcast_to(p, including=self.protocols_in_room(roomid), excluding=excluding, state=state)
 
     def buildProtocol(self, addr):
-        print("Adding a new client.")
+        log.info("Adding a new client from %s.", addr)
         return protocol.MoonlapseProtocol(self)
 
+    def session_store(self) -> sessions.SessionStore:
+        return sessions.SessionStore(self)
+
+    def claim_instance(self, instance: models.InstancedEntity) -> models.InstancedEntity:
+        """
+        The server's own copy of a player's instance, which everything in the game refers to, given the instance
+        just read from the database.
+        """
+        return self.instances[instance.pk]
+
     def is_logged_in(self, pid: int) -> bool:
         for proto in self.connected_protocols:
             if proto.logged_in and proto.player_info:
@@ -135,7 +299,7 @@ class MoonlapseServer(Factory):
         return False
 
     def change_weather(self, new_weather: str):
-        print(f"Weather changed from {self.weather} to {new_weather}")
+        log.info("Weather changed from %s to %s", self.weather, new_weather)
 
         self.broadcast_to_all(packet.WeatherChangePacket(new_weather), state='PLAY')
         self.weather = new_weather
@@ -156,12 +320,17 @@ class MoonlapseServer(Factory):
             self.change_weather("Clear")
 
     def save_all_instances(self):
-        for key, instance in self.instances.items():
-            if instance.entity.typename == 'Player':
-                instance.save()
-        print("Saved all player instances to DB")
+        # Players who've logged out were saved as they left, and nothing else moves for good
+        for proto in self.connected_protocols:
+            if proto.logged_in:
+                proto.player_instance.save()
+        log.info("Saved all player instances to DB")
         self.broadcast_to_all(packet.ServerLogPacket("Game has been saved."), state='PLAY')
 
+    def check_heartbeats(self):
+        for proto in sorted(self.connected_protocols, key=lambda p: p.connection_id):
+            proto.check_heartbeat()
+
     def respawn_instance(self, instanceid: int):
         dbi = models.InstancedEntity.objects.get(pk=instanceid)
         self.instances[instanceid].y = dbi.y
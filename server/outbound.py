@@ -0,0 +1,175 @@
+"""
+What a protocol keeps for its client until it can be sent, and how far behind the client is allowed to fall.
+
+Packets wait in lanes by how much the player will notice them being late:
+    CONTROL     acknowledgements, refusals, room changes and the handshake, which the client acts on straight away
+    OWN         the player's own instance, player and room
+    NEARBY      other instances coming into, moving about in and leaving view
+    CHAT        chat and server log messages
+    BULK        inventory and weather
+Each tick the control and own lanes are sent in full, then the rest share what's left of BYTES_PER_TICK in
+proportion to their WEIGHTS (deficit round robin), so a burst in one lane can't hold the others up for long.
+Whatever doesn't fit waits for the next tick, with only the latest of the updates to each instance kept, since
+each one replaces the last. Order is kept within a lane, and the lanes are ordered so that the
+client always has its own models before anything else in a room. When the player changes rooms, their own and
+nearby updates still waiting are dropped, as they'd arrive after the client has moved on.
+
+A protocol is its transport's producer, so Twisted pauses it once more than the transport's bufferSize is waiting
+to go out to the client. While it's paused its queue is held rather than written, and coalesced the same way.
+If the client stays behind for longer than MAX_PAUSED_SECONDS, or the queue grows past MAX_PACKETS even so,
+whether it's paused or just being sent more than BYTES_PER_TICK, it's disconnected.
+"""
+import itertools
+import time
+from collections import deque
+from typing import *
+
+from networking import compression, packet
+from server import metrics
+
+MAX_PACKETS = 2000          # queued for a client who's behind, after coalescing
+MAX_PAUSED_SECONDS = 15     # that a client can stay behind
+
+CONTROL, OWN, NEARBY, CHAT, BULK = range(5)
+LANE_NAMES = ('control', 'own', 'nearby', 'chat', 'bulk')
+WEIGHTS = {NEARBY: 4, CHAT: 2, BULK: 1}
+QUANTUM = 256               # bytes a lane can send per round for each of its weight
+BYTES_PER_TICK = 16384      # for each client, if only the control and own lanes would go over
+
+
+class OutboundQueue:
+    """
+    A protocol's packets waiting to be sent to its client.
+    """
+
+    def __init__(self):
+        self.lanes: List[Deque[packet.Packet]] = [deque() for _ in LANE_NAMES]
+        self.deficits = [0] * len(LANE_NAMES)     # bytes each weighted lane is owed from earlier rounds
+        self.own_id: Optional[int] = None           # the pk of the player's instance
+        self.coalesced = 0      # updates dropped because a later one replaced them
+        self.dropped = 0        # updates dropped because the player changed rooms
+
+    def lane(self, p: packet.Packet) -> int:
+        if isinstance(p, packet.ServerModelPacket):
+            model = p.payloads[0].value
+            if model == 'Instance':
+                return OWN if p.payloads[1].value['id'] == self.own_id else NEARBY
+            return OWN if model in ('Room', 'Player') else BULK
+        if isinstance(p, packet.GoodbyePacket):
+            return NEARBY
+        if isinstance(p, (packet.ServerLogPacket, packet.ChatPacket)):
+            return CHAT
+        if isinstance(p, packet.WeatherChangePacket):
+            return BULK
+        return CONTROL
+
+    def append(self, p: packet.Packet):
+        if isinstance(p, packet.MoveRoomsPacket):
+            for lane in (OWN, NEARBY):
+                metrics.OUTGOING_DROPPED.inc(amount=len(self.lanes[lane]))
+                self.dropped += len(self.lanes[lane])
+                self.lanes[lane].clear()
+        self.lanes[self.lane(p)].append(p)
+
+    def extend(self, packets: Iterable[packet.Packet]):
+        for p in packets:
+            self.append(p)
+
+    def clear(self):
+        for lane in self.lanes:
+            lane.clear()
+        self.deficits = [0] * len(LANE_NAMES)
+
+    def __len__(self) -> int:
+        return sum(len(lane) for lane in self.lanes)
+
+    def __iter__(self) -> Iterator[packet.Packet]:
+        return itertools.chain(*self.lanes)
+
+    def drain(self, budget: Optional[int] = BYTES_PER_TICK) -> Iterator[Tuple[packet.Packet, bytes]]:
+        """
+        Takes packets off the queue, encoded, in the order they should be sent this tick. Once it's done, what's
+        left is coalesced, so a client being sent more than the budget falls behind by at most one update an
+        instance rather than by ever more of them.
+        :param budget: roughly how many bytes to send, or None to send everything
+        """
+        sent = 0
+        for lane in (CONTROL, OWN):
+            queue = self.lanes[lane]
+            while queue:
+                p = queue.popleft()
+                data = p.tobytes()
+                sent += len(data)
+                yield p, data
+
+        while budget is None or sent < budget:
+            active = [lane for lane in WEIGHTS if self.lanes[lane]]
+            if not active:
+                break
+            for lane in active:
+                queue = self.lanes[lane]
+                self.deficits[lane] += WEIGHTS[lane] * QUANTUM
+                while queue and (budget is None or sent < budget):
+                    data = queue[0].tobytes()
+                    if len(data) > self.deficits[lane]:
+                        break
+                    self.deficits[lane] -= len(data)
+                    sent += len(data)
+                    yield queue.popleft(), data
+                if not queue:
+                    self.deficits[lane] = 0
+
+        deferred = False
+        for lane in WEIGHTS:
+            if self.lanes[lane]:
+                metrics.OUTGOING_DEFERRED.inc(LANE_NAMES[lane], amount=len(self.lanes[lane]))
+                deferred = True
+        if deferred:
+            self.coalesce()
+
+    def coalesce(self) -> int:
+        """
+        Drops every Instance update which a later one in the same lane replaces, keeping the order of the rest.
+        :return: how many were dropped
+        """
+        dropped = 0
+        for lane in (OWN, NEARBY):
+            queue = self.lanes[lane]
+            latest: Dict[int, int] = {}     # instance.pk : index of its latest update
+            for i, p in enumerate(queue):
+                if is_instance_update(p):
+                    latest[p.payloads[1].value['id']] = i
+            kept = [p for i, p in enumerate(queue)
+                    if not is_instance_update(p) or latest[p.payloads[1].value['id']] == i]
+            if len(kept) < len(queue):
+                dropped += len(queue) - len(kept)
+                queue.clear()
+                queue.extend(kept)
+        self.coalesced += dropped
+        metrics.OUTGOING_COALESCED.inc(amount=dropped)
+        return dropped
+
+
+def is_instance_update(p: packet.Packet) -> bool:
+    return isinstance(p, packet.ServerModelPacket) and p.payloads[0].value == 'Instance'
+
+
+def compress(compressor: compression.Compressor, data: bytes) -> bytes:
+    """
+    Compresses a packet for sending, counting what it saved and what it cost. Packets must be compressed in the
+    order they're sent.
+    """
+    start = time.perf_counter()
+    compressed = compressor.compress(data)
+    metrics.COMPRESSION_SECONDS.observe(time.perf_counter() - start, 'compress')
+    metrics.COMPRESSION_BYTES.inc('before', amount=len(data))
+    metrics.COMPRESSION_BYTES.inc('after', amount=len(compressed))
+    return compressed
+
+
+def buffered_bytes(transport) -> int:
+    """
+    :return: how many bytes the transport has yet to hand to the operating system, if it's one which says
+    """
+    data = getattr(transport, 'dataBuffer', b'')
+    return len(data) - getattr(transport, 'offset', 0) + getattr(transport, '_tempDataLen', 0)
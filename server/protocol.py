@@ -1,23 +1,28 @@
-import random
+import logging
+import time
+import zlib
 
 import django
 from django.db.utils import DataError
 import rsa
 from django.core.exceptions import ObjectDoesNotExist
 from django.forms import model_to_dict
+from twisted.internet.interfaces import IPushProducer
 from twisted.internet.protocol import connectionDone
-from twisted.protocols.basic import NetstringReceiver
+from zope.interface import implementer
 
-from collections import deque
-from networking import cryptography
+from networking import compression, cryptography, framing
 
 from typing import *
 
 from networking import packet
-from networking.logger import Log
-from server import models, pbkdf2
+from networking.logger import Log, get_logger
+from server import heartbeat, metrics, models, outbound, pbkdf2
+from server.framed import FramedReceiver
 import maps
 
+log = get_logger('protocol')
+
 
 OOB = -32       # Out Of Bounds. All instances with y == OOB are awaiting to be respawned.
 
@@ -55,9 +60,13 @@ def create_dict(model_type: str, model) -> dict:
         return cidict
 
 
-class MoonlapseProtocol(NetstringReceiver):
+@implementer(IPushProducer)
+class MoonlapseProtocol(FramedReceiver):
     def __init__(self, server):
+        super().__init__()
         self.server = server
+        server.connections_made += 1
+        self.connection_id: int = server.connections_made
 
         # Information specific to the player using this protocol
         self.username = ""
@@ -66,12 +75,18 @@ class MoonlapseProtocol(NetstringReceiver):
         self.roommap: Optional[maps.Room] = None
         self.logged_in = False
         self.client_pub_key: Optional[rsa.key.PublicKey] = None
+        self.compressor: Optional[compression.Compressor] = None       # if the client chose compression
+        self.decompressor: Optional[compression.Decompressor] = None
+        self.resume_token: Optional[str] = None
+        self.detached = False   # whether the connection dropped and the session is being held for it to resume
 
         self.state = self.GET_ENTRY
         self.actionloop = None
 
-        self.outgoing = deque()
+        self.outgoing = outbound.OutboundQueue()
+        self.paused_since: Optional[float] = None   # when the transport last asked us to stop writing, if it has
         self.next_packet: Optional[packet.Packet] = None     # most recent packet from client to process next tick
+        self.heartbeat = heartbeat.Heartbeat(server)
 
         self.logger = Log()
 
@@ -79,20 +94,65 @@ class MoonlapseProtocol(NetstringReceiver):
 
     def connectionMade(self):
         self.server.connected_protocols.add(self)
+        if self.transport:
+            self.transport.registerProducer(self, True)
+        if self.server.recorder:
+            self.server.recorder.connected(self)
 
     def connectionLost(self, reason=connectionDone):
+        if self.server.recorder:
+            self.server.recorder.lost(self)
+        if self.server.sessions.hold(self):
+            return
         self.logout(packet.LogoutPacket(self.username))
-        self.server.connected_protocols.remove(self)
+        self.server.connected_protocols.discard(self)
+
+    def disconnect(self, graceful: bool = False):
+        """
+        :param graceful: whether to send what's already been written first
+        """
+        if graceful:
+            self.transport.loseConnection()
+        else:
+            self.transport.abortConnection()
 
     def stringReceived(self, string):
         # attempt to decrypt packet
+        start = time.perf_counter()
         try:
             string = cryptography.decrypt(string, self.server.private_key)
         except Exception as e:
-            self.debug(f"WARNING: Packet came through unencrypted")
-            self.debug(str(e))
-        p = packet.frombytes(string)
-        self.debug(f"Received packet from my client {p}")
+            self.log(logging.WARNING, "Packet came through unencrypted: %s", e)
+        metrics.CRYPTO_SECONDS.observe(time.perf_counter() - start, 'decrypt')
+
+        if self.decompressor:
+            start = time.perf_counter()
+            try:
+                string = self.decompressor.decompress(string)
+            except zlib.error as e:
+                # Everything after this is compressed against it, so there's no making sense of the rest either
+                self.log(logging.WARNING, "Disconnecting: couldn't decompress packet: %s", e)
+                self.disconnect()
+                return
+            metrics.COMPRESSION_SECONDS.observe(time.perf_counter() - start, 'decompress')
+        self.plaintext_received(string)
+
+    def plaintext_received(self, data: bytes):
+        """
+        Handles a packet from the client once it's been decrypted. Replays of recorded sessions start here.
+        """
+        if self.server.recorder:
+            self.server.recorder.received(self, data)
+        p = packet.frombytes(data)
+        self.debug("Received packet from my client %s", p)
+        if p:
+            metrics.PACKETS_RECEIVED.inc(p.action)
+            metrics.BYTES_RECEIVED.inc(p.action, amount=len(data))
+        if isinstance(p, packet.PongPacket):
+            # Answered straight away rather than taking the place of whatever the client sent for this tick
+            self.heartbeat.pong(p.payloads[0].value)
+            return
+        self.heartbeat.heard()
         self.next_packet = p
 
     def process_packet(self, p: packet.Packet):
@@ -100,45 +160,130 @@ class MoonlapseProtocol(NetstringReceiver):
 
     def GET_ENTRY(self, p: packet.Packet):
         if isinstance(p, packet.ClientKeyPacket):
+            if not self.server.public_key:
+                # Still loading the server's keys; try again next tick unless the client has sent something since
+                if not self.next_packet:
+                    self.next_packet = p
+                return
             # We have the client's public key so now we can send some initial data
             self.client_pub_key = rsa.key.PublicKey(p.payloads[0].value, p.payloads[1].value)
-            # Send the client the server's public key
-            self.outgoing.append(packet.ClientKeyPacket(self.server.public_key.n, self.server.public_key.e))
+            codec = compression.choose(p.payloads[2].value)
+            self.use_compression(codec)
+            chosen_framing = framing.choose(p.payloads[3].value)
+            self.use_framing(chosen_framing)
+            # Send the client the server's public key, and whether we'll compress and how we'll frame packets
+            self.outgoing.append(packet.ClientKeyPacket(self.server.public_key.n, self.server.public_key.e, codec,
+                                                        chosen_framing))
             # Send the client some initial info it needs to know
             self.outgoing.append(packet.ServerTickRatePacket(self.server.tickrate))
             self.outgoing.append(packet.WelcomePacket(
                 """Welcome to MoonlapseMUD\n ,-,-.\n/.( +.\\\n\ {. */\n `-`-'\n     Enjoy your stay ~"""))
-        if isinstance(p, packet.LoginPacket):
-            self.login_user(p)
-        elif isinstance(p, packet.RegisterPacket):
-            self.register_user(p)
+        if isinstance(p, (packet.LoginPacket, packet.RegisterPacket)) and not self.server.ready:
+            self.outgoing.append(packet.DenyPacket("The server is still starting up. Please try again in a moment."))
+        elif isinstance(p, (packet.LoginPacket, packet.RegisterPacket)):
+            self.server.admission.submit(self, p)
+        elif isinstance(p, packet.ResumePacket):
+            self.resume(p)
+
+    def use_compression(self, codec: Optional[str]):
+        """
+        Compresses what's sent to the client from now on, and decompresses what it sends once it's heard, if a
+        codec was chosen.
+        """
+        if codec:
+            self.compressor = compression.Compressor()
+            self.decompressor = compression.Decompressor()
 
     def login_user(self, p: packet.LoginPacket):
+        """
+        Checks the password in the server's admission.hash, then finishes logging in with complete_login if
+        it's right.
+        """
         username, password = p.payloads[0].value, p.payloads[1].value
-        if not models.User.objects.filter(username=username):
+        user = models.User.objects.filter(username=username).first()
+        if not user:
             self.outgoing.append(packet.DenyPacket("I don't know anybody by that name"))
             return
 
-        user = models.User.objects.get(username=username)
         player = models.Player.objects.get(user=user)
-
-        if self.server.is_logged_in(player.pk):
-            self.outgoing.append(packet.DenyPacket(f"{username} is already inhabiting this realm."))
+        if not self.may_log_in(user, player):
             return
 
-        if not pbkdf2.verify_password(user.password, password):
+        d = self.server.admission.hash(pbkdf2.verify_password, user.password, password)
+        d.addCallback(self.complete_login, user, player)
+        d.addErrback(self.entry_failed)
+
+    def may_log_in(self, user: models.User, player: models.Player) -> bool:
+        # A session held for the player to resume doesn't stop them logging in again from scratch
+        if self.server.is_logged_in(player.pk) and not self.server.sessions.held_for(player.pk):
+            self.outgoing.append(packet.DenyPacket(f"{user.username} is already inhabiting this realm."))
+            return False
+        return True
+
+    def complete_login(self, correct: bool, user: models.User, player: models.Player):
+        if self not in self.server.connected_protocols or self.state != self.GET_ENTRY:
+            return      # gone, or logged in some other way, while the password was being checked
+        if not correct:
             self.outgoing.append(packet.DenyPacket("Incorrect password"))
             return
+        # Somebody else could have logged in as the player meanwhile
+        if not self.may_log_in(user, player):
+            return
+
+        held = self.server.sessions.held_for(player.pk)
+        if held:
+            self.server.sessions.release(held)
 
         # The user exists in the database so retrieve the player and entity objects
         self.username = user.username
         self.player_info = player
         self.player_instance = models.InstancedEntity.objects.get(entity=self.player_info.entity)
-        self.player_instance = self.server.instances[self.player_instance.pk]
+        self.player_instance = self.server.claim_instance(self.player_instance)
 
         self.outgoing.append(packet.OkPacket())
+        self.server.sessions.issue(self)
         self.move_rooms(self.player_instance.room.id)
 
+    def resume(self, p: packet.ResumePacket):
+        """
+        Takes over the session another connection left behind, if the client has its token, sending the client
+        only what it missed.
+        """
+        old = self.server.sessions.claim(p.payloads[0].value)
+        if not old:
+            metrics.RESUMES.inc('refused')
+            self.outgoing.append(packet.DenyPacket("Your session has expired. Please log in again."))
+            return
+
+        metrics.RESUMES.inc('resumed')
+        missed = old.outgoing
+        self.username, self.player_info, self.player_instance = old.username, old.player_info, old.player_instance
+        self.roommap, self.visible_instances, self.logged_in = old.roommap, old.visible_instances, old.logged_in
+        self.state = self.PLAY
+        self.log(logging.INFO, "Resumed session of connection %s, with %s packets missed",
+                 old.connection_id, len(missed))
+
+        # The old protocol lets go of the player, so losing its connection, if it's not already lost, does nothing
+        if old.actionloop:
+            self.server.remove_deferred(old.actionloop)
+        if not old.detached:
+            old.disconnect()
+        old.outgoing = outbound.OutboundQueue()
+        old.username, old.player_info, old.player_instance, old.logged_in = "", None, None, False
+        old.actionloop, old.detached = None, False
+        self.server.connected_protocols.discard(old)
+
+        self.server.sessions.issue(self)
+        if len(missed) > outbound.MAX_PACKETS:
+            # Too much to catch up on, so start the client afresh in its room
+            self.visible_instances = set()
+            self.outgoing.append(packet.MoveRoomsPacket(self.player_instance.room_id))
+            self.outgoing.append(packet.OkPacket())
+            self.establish_player_in_room()
+        else:
+            self.outgoing.own_id = missed.own_id
+            self.outgoing.extend(missed)
+
     def register_user(self, p: packet.RegisterPacket):
         username, password = p.payloads[0].value, p.payloads[1].value
 
@@ -146,7 +291,17 @@ class MoonlapseProtocol(NetstringReceiver):
             self.outgoing.append(packet.DenyPacket("Somebody else already goes by that name"))
             return
 
-        password = pbkdf2.hash_password(password)
+        d = self.server.admission.hash(pbkdf2.hash_password, password)
+        d.addCallback(self.complete_registration, username)
+        d.addErrback(self.entry_failed)
+
+    def complete_registration(self, password: str, username: str):
+        if self not in self.server.connected_protocols:
+            return
+        # Somebody else could have taken the name while the password was being hashed
+        if models.User.objects.filter(username=username):
+            self.outgoing.append(packet.DenyPacket("Somebody else already goes by that name"))
+            return
 
         # Save the new user
         user = models.User(username=username, password=password)
@@ -181,6 +336,16 @@ class MoonlapseProtocol(NetstringReceiver):
 
         self.outgoing.append(packet.OkPacket())
 
+    def entry_failed(self, failure):
+        self.log(logging.ERROR, "Couldn't log in or register: %s", failure.getTraceback())
+        self.outgoing.append(packet.DenyPacket("Error. Please try again later."))
+
+    def host(self) -> str:
+        """
+        The address the client connected from.
+        """
+        return getattr(self.transport.getPeer(), 'host', '') if self.transport else ''
+
     def logout(self, p: packet.LogoutPacket):
         username = p.payloads[0].value
         if username == self.username:
@@ -190,8 +355,11 @@ class MoonlapseProtocol(NetstringReceiver):
             # tell everyone we're leaving
             if self.player_instance:
                 self.broadcast(packet.GoodbyePacket(self.player_instance.pk))
+                self.player_instance.save()
 
+            self.server.sessions.forget(self)
             self.logged_in = False
+            self.outgoing.own_id = None
             self.player_instance = None
             self.player_info = None
             self.roommap = None
@@ -324,8 +492,10 @@ class MoonlapseProtocol(NetstringReceiver):
         if not self.can_gather(node):
             return
 
+        rng = self.server.rng('attempt_gather', self)
+
         # change change based on difficulty
-        if random.randint(0, 5) == 0:
+        if rng.randint(0, 5) == 0:
             # success
             if self.actionloop:
                 self.server.remove_deferred(self.actionloop)
@@ -333,8 +503,8 @@ class MoonlapseProtocol(NetstringReceiver):
 
             dropitems = set(models.DropTableItem.objects.filter(droptable=node.droptable))
             for itm in dropitems:
-                if random.randint(1, itm.chance) == 1:
-                    amt = random.randint(itm.min_amt, itm.max_amt)
+                if rng.randint(1, itm.chance) == 1:
+                    amt = rng.randint(itm.min_amt, itm.max_amt)
                     item = itm.item
                     self.add_item_to_inventory(item, amt)
                     self.outgoing.append(packet.ServerLogPacket(f"You acquire {amt} {item.entity.name}."))
@@ -356,6 +526,8 @@ class MoonlapseProtocol(NetstringReceiver):
             self.server.remove_deferred(self.actionloop)
             self.actionloop = None
 
+        seq: Optional[int] = p.payloads[0].value if p.payloads else None
+
         # Calculate the desired destination
         desired_y = self.player_instance.y
         desired_x = self.player_instance.x
@@ -378,10 +550,12 @@ class MoonlapseProtocol(NetstringReceiver):
                 self.player_instance.y = desired_y
                 self.player_instance.x = desired_x
                 if self.player_instance.room != portal.linkedroom:
+                    self.acknowledge_move(seq)
                     self.move_rooms(portal.linkedroom.id)
                     return
 
             elif instance.entity.typename in ("OreNode", "TreeNode") and instance.y == desired_y and instance.x == desired_x:
+                self.acknowledge_move(seq)
                 self.start_gather(instance)
                 return
 
@@ -389,13 +563,24 @@ class MoonlapseProtocol(NetstringReceiver):
             self.player_instance.y = desired_y
             self.player_instance.x = desired_x
 
+            # Acknowledge before the update so the client never sees a position newer than its acknowledged moves
+            self.acknowledge_move(seq)
             for proto in self.server.protocols_in_room(self.player_instance.room_id):
                 proto.process_visible_instances()
         else:
             self.outgoing.append(packet.DenyPacket("Can't move there"))
+            self.acknowledge_move(seq)
+
+    def acknowledge_move(self, seq: Optional[int]):
+        """
+        Tells the client where its player is after the move numbered seq, so it can correct its prediction.
+        Moves without a sequence number aren't acknowledged.
+        """
+        if seq is not None:
+            self.outgoing.append(packet.MoveAckPacket(seq, self.player_instance.y, self.player_instance.x))
 
     def move_rooms(self, dest_roomid: Optional[int]):
-        print(f"\nmove_rooms(dest_roomid={dest_roomid})\n")
+        self.debug("move_rooms(dest_roomid=%s)", dest_roomid)
 
         if self.logged_in:
             # Tell people in the current (old) room we are leaving
@@ -413,12 +598,13 @@ class MoonlapseProtocol(NetstringReceiver):
         self.player_instance.room_id = dest_roomid
 
         room = self.player_instance.room
-        self.roommap = maps.Room(room.pk, room.name, room.file_name)
+        self.roommap = self.server.roommap(room)
 
         self.outgoing.append(packet.OkPacket())
         self.establish_player_in_room()
 
     def establish_player_in_room(self):
+        self.outgoing.own_id = self.player_instance.pk
         self.outgoing.append(packet.ServerModelPacket('Room', model_to_dict(self.player_instance.room)))
         self.outgoing.append(packet.ServerModelPacket('Instance', create_dict('Instance', self.player_instance)))
 
@@ -483,30 +669,145 @@ class MoonlapseProtocol(NetstringReceiver):
             #         delta = get_dict_delta(create_dict('Instance', before), create_dict('Instance', after))
             #         self.outgoing.append(packet.ServerModelPacket('Instance', delta))
 
+    def check_heartbeat(self):
+        """
+        Pings the client if it's due, or disconnects it if it's stopped answering or doing anything. The server
+        does this for every protocol each second.
+        """
+        if self.detached:
+            return
+        reason = self.heartbeat.check(self.logged_in)
+        if reason:
+            self.reap(reason)
+            return
+        ping = self.heartbeat.ping()
+        if ping and self.paused_since is None and self.handshaken():
+            # Sent now, not with the rest at the end of the tick, so the round trip doesn't include the tick
+            self.send_packet(ping)
+
+    def handshaken(self) -> bool:
+        """
+        Whether packets can be sent to the client yet, which they can't until its key has arrived.
+        """
+        return self.client_pub_key is not None
+
+    def reap(self, reason: str):
+        """
+        Logs out and disconnects a client which has stopped answering or been idle for too long.
+        """
+        self.log(logging.INFO, "Disconnecting: %s", reason)
+        metrics.REAPED.inc(reason)
+        idle = reason == heartbeat.IDLE
+        if idle:
+            self.outgoing.append(packet.DenyPacket("You've been disconnected for being idle."))
+        # Logged out now, so the session isn't held for a client which isn't coming back
+        self.logout(packet.LogoutPacket(self.username))
+        self.flush(None)
+        self.disconnect(graceful=idle)
+
     def tick(self):
         if self.next_packet:
-            self.process_packet(self.next_packet)
-            print("-----------------------PROCESSED------------------")
-            self.next_packet = None
+            # Cleared first so processing can put the packet back to try again next tick
+            p, self.next_packet = self.next_packet, None
+            self.process_packet(p)
+            self.debug("Processed packet %s", p)
+
+    def pauseProducing(self):
+        self.paused_since = time.monotonic()
+
+    def resumeProducing(self):
+        self.paused_since = None
+
+    def stopProducing(self):
+        pass
+
+    def can_send(self) -> bool:
+        """
+        Whether the queue can be sent to the client, which it can't while the client is behind receiving what's
+        already been sent. Until it catches up, the queue is coalesced, and if it doesn't, it's disconnected.
+        """
+        if self.detached:
+            # Kept for the client to resume, as short as it can be
+            self.outgoing.coalesce()
+            return False
+        if self.paused_since is None:
+            return True
 
-        # send all packets in queue back to client in order
-        for p in list(self.outgoing):
-            self.send_packet(p)
-            self.outgoing.popleft()
+        self.outgoing.coalesce()
+        behind = time.monotonic() - self.paused_since
+        if behind > outbound.MAX_PAUSED_SECONDS or len(self.outgoing) > outbound.MAX_PACKETS:
+            self.too_far_behind(behind)
+        return False
+
+    def check_backlog(self):
+        """
+        Disconnects the client if what's left of the queue once this tick's share has gone, coalesced, is still
+        more than MAX_PACKETS: it's keeping up with what it's sent, but it's being sent more than that.
+        """
+        if len(self.outgoing) > outbound.MAX_PACKETS:
+            self.too_far_behind(0.0)
 
-    def send_packet(self, p: packet.Packet):
+    def too_far_behind(self, behind: float):
+        """
+        :param behind: how many seconds the transport has been paused for
+        """
+        self.log(logging.WARNING, "Disconnecting: %.1fs behind, with %s packets queued and %s bytes buffered",
+                 behind, len(self.outgoing), outbound.buffered_bytes(self.transport))
+        metrics.SLOW_DISCONNECTS.inc()
+        self.outgoing.clear()
+        self.paused_since = None
+        self.disconnect()
+
+    def flush(self, budget: Optional[int] = outbound.BYTES_PER_TICK):
+        """
+        Sends this tick's share of the queue to the client, if it isn't behind. The server does this for every
+        protocol once they've all ticked.
+        :param budget: roughly how many bytes to send, or None to send everything
+        """
+        if not self.can_send():
+            return
+        if self.outgoing:
+            metrics.OUTGOING_DEPTH.observe(len(self.outgoing))
+            self.send_packets(self.outgoing.drain(budget))
+            self.check_backlog()
+
+    def send_packet(self, p: packet.Packet, data: Optional[bytes] = None):
         """
         Sends a packet to this protocol's client.
         Call this to communicate information back to the game client application.
+        :param data: the packet already encoded, if it has been
+        """
+        self.send_packets([(p, data or p.tobytes())])
+
+    def send_packets(self, packets: Iterable[Tuple[packet.Packet, bytes]]):
+        """
+        Sends packets to this protocol's client in one write.
+        :param packets: each packet and its encoding
+        """
+        messages = []
+        for p, data in packets:
+            message = self.seal(p, data)
+            if message is not None:
+                messages.append(message)
+        self.sendStrings(messages)
+
+    def seal(self, p: packet.Packet, data: bytes) -> Optional[bytes]:
         """
-        message: bytes = p.tobytes()
+        Compresses, if the client chose to, and encrypts an encoded packet, ready to be framed and sent.
+        :return: the message to send, or None if it couldn't be encrypted
+        """
+        message = outbound.compress(self.compressor, data) if self.compressor else data
+        start = time.perf_counter()
         try:
             message = cryptography.encrypt(message, self.client_pub_key)
         except Exception as e:
-            self.debug(f"FATAL: Couldn't encrypt packet {p} for sending. Error was {e}. Returning.")
-            return
-        self.sendString(message)
-        self.debug(f"Sent data to my client: {p.tobytes()}")
+            self.log(logging.ERROR, "Couldn't encrypt packet %s for sending. Error was %s. Returning.", p, e)
+            return None
+        metrics.CRYPTO_SECONDS.observe(time.perf_counter() - start, 'encrypt')
+        metrics.PACKETS_SENT.inc(p.action)
+        metrics.BYTES_SENT.inc(p.action, amount=len(message))
+        self.debug("Sent data to my client: %s", data)
+        return message
 
     def broadcast(self, p: packet.Packet, include_self=False):
         excluding = []
@@ -514,10 +815,20 @@ class MoonlapseProtocol(NetstringReceiver):
             excluding.append(self)
         self.server.broadcast_to_room(p, self.player_instance.room.pk, excluding=excluding)
 
-    def debug(self, message: str):
-        print(f"[{self.username if self.username else None}]"
-              f"[{self.state.__name__}]"
-              f"[{self.player_instance.room.name if self.player_instance else None}]: {message}")
+    def debug(self, message: str, *args):
+        self.log(logging.DEBUG, message, *args)
+
+    def log(self, level: int, message: str, *args):
+        """
+        Logs a message about this protocol, tagged with who and where its player is. Arguments are only formatted
+        into the message, and the tags only looked up, if the level is enabled.
+        """
+        if log.isEnabledFor(level):
+            log.log(level, message, *args, extra={
+                'username': self.username if self.username else None,
+                'state': self.state.__name__,
+                'room': self.player_instance.room.name if self.player_instance else None
+            })
 
     def coord_in_view(self, y: int, x: int) -> bool:
         yview = self.player_instance.y - 10, self.player_instance.y + 10
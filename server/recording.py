@@ -0,0 +1,279 @@
+"""
+Recording and replaying of server sessions.
+
+With `--record PATH` the server writes a trace of everything which decides what happens in the game: every
+connection made and lost, every packet received (after decryption), every random seed used, all with the tick
+and connection they happened on, plus a digest of the game state every second. `--replay PATH` feeds a trace
+back through MoonlapseServer and MoonlapseProtocol as fast as possible, with no sockets and no tick loop, and
+reports how long each tick took and whether the game ended up in the same state as when it was recorded.
+
+Replays run against the database the server is configured with, inside a transaction which is rolled back at the
+end, so nothing is changed. For the game state to match, the database needs to be as it was when recording started
+(e.g. replay against a copy of moonlapse.db taken before recording).
+
+A trace is gzipped and made up of records, each a header (kind, tick, connection id, data length) then the data.
+"""
+import cProfile
+import gzip
+import hashlib
+import random
+import statistics
+import struct
+import time
+from collections import deque, defaultdict
+from typing import *
+
+from networking.logger import get_logger
+
+log = get_logger('recording')
+
+MAGIC = b'MLTRACE\x01'
+HEADER = struct.Struct('<BIII')     # kind, tick, connection id, data length
+SEED = struct.Struct('<Q')          # followed by the name of the site which used the seed
+
+# Kinds of record
+CONNECT = 1     # data is the peer's host
+LOST = 2
+PACKET = 3      # data is the decrypted packet
+RANDOM = 4      # data is the seed and the site which used it
+STATE = 5       # data is the game state's digest
+READY = 6       # the server finished loading and started accepting logins
+
+DIGEST_INTERVAL = 20    # ticks between state digests
+
+
+def state_digest(server) -> bytes:
+    """
+    A digest of what replays should reproduce: the weather, where every instance is, and who is logged in.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(server.weather.encode())
+    for pk in sorted(server.instances):
+        instance = server.instances[pk]
+        h.update(f"{pk},{instance.room_id},{instance.y},{instance.x},{instance.amount};".encode())
+    for proto in sorted(server.connected_protocols, key=lambda p: p.connection_id):
+        h.update(f"{proto.connection_id},{proto.state.__name__},{proto.username};".encode())
+    return h.digest()
+
+
+def read_trace(path: str) -> Iterator[Tuple[int, int, int, bytes]]:
+    """
+    :return: each record in the trace as (kind, tick, connection id, data)
+    """
+    with gzip.open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} isn't a trace recorded by this version of the server")
+        while True:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return
+            kind, tick, conn, length = HEADER.unpack(header)
+            yield kind, tick, conn, f.read(length)
+
+
+class Recorder:
+    """
+    Writes a trace of the session as it happens. The server calls this whenever something happens which a
+    replay will need to reproduce.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = gzip.open(path, 'wb', compresslevel=6)
+        self._file.write(MAGIC)
+
+    def _write(self, kind: int, tick: int, conn: int, data: bytes = b''):
+        self._file.write(HEADER.pack(kind, tick, conn, len(data)))
+        self._file.write(data)
+
+    def connected(self, proto):
+        self._write(CONNECT, proto.server.total_ticks, proto.connection_id, proto.transport.getPeer().host.encode())
+
+    def lost(self, proto):
+        self._write(LOST, proto.server.total_ticks, proto.connection_id)
+
+    def received(self, proto, data: bytes):
+        self._write(PACKET, proto.server.total_ticks, proto.connection_id, data)
+
+    def rng(self, server, site: str, conn: int) -> random.Random:
+        seed = random.getrandbits(64)
+        self._write(RANDOM, server.total_ticks, conn, SEED.pack(seed) + site.encode())
+        return random.Random(seed)
+
+    def ready(self, server):
+        self._write(READY, server.total_ticks, 0)
+
+    def ticked(self, server):
+        if server.total_ticks % DIGEST_INTERVAL == 0:
+            self._write(STATE, server.total_ticks, 0, state_digest(server))
+
+    def close(self):
+        self._file.close()
+        log.info("Recorded session to %s", self.path)
+
+
+class TraceSeeds:
+    """
+    Stands in for the Recorder during a replay, handing out the seeds recorded for each site and connection in
+    the order they were used.
+    """
+
+    def __init__(self):
+        self.seeds: Dict[Tuple[str, int], Deque[int]] = defaultdict(deque)
+        self.missing = 0
+
+    def add(self, conn: int, data: bytes):
+        seed, = SEED.unpack_from(data)
+        self.seeds[data[SEED.size:].decode(), conn].append(seed)
+
+    def rng(self, server, site: str, conn: int) -> random.Random:
+        seeds = self.seeds.get((site, conn))
+        if not seeds:
+            # The replay has already gone differently to the recording
+            self.missing += 1
+            return random.Random(0)
+        return random.Random(seeds.popleft())
+
+    def connected(self, proto):
+        pass
+
+    def lost(self, proto):
+        pass
+
+    def received(self, proto, data: bytes):
+        pass
+
+    def ready(self, server):
+        pass
+
+    def ticked(self, server):
+        pass
+
+
+class ReplayTransport:
+    """
+    Counts what a protocol sends during a replay instead of sending it.
+    """
+
+    def __init__(self, host: str):
+        from twisted.internet.address import IPv4Address
+        self.peer = IPv4Address('TCP', host, 0)
+        self.written = 0
+        self.disconnecting = False
+
+    def write(self, data: bytes):
+        self.written += len(data)
+
+    def writeSequence(self, seq: Iterable[bytes]):
+        for data in seq:
+            self.write(data)
+
+    def loseConnection(self):
+        # The trace says when the connection was actually lost
+        self.disconnecting = True
+
+    def abortConnection(self):
+        self.disconnecting = True
+
+    def getPeer(self):
+        return self.peer
+
+    def getHost(self):
+        return self.peer
+
+    def registerProducer(self, producer, streaming: bool):
+        pass
+
+    def unregisterProducer(self):
+        pass
+
+
+def replay(path: str, profile: Optional[str] = None):
+    """
+    Replays a trace and prints how long ticks took, and the first tick, if any, on which the game state differed
+    from the recording.
+    :param profile: if given, where to save cProfile stats covering the replayed ticks
+    """
+    from django.db import transaction
+    from twisted.internet.protocol import connectionDone
+    from server.mlserver import MoonlapseServer
+
+    # Group the records by tick
+    ticks: Dict[int, List[Tuple[int, int, bytes]]] = defaultdict(list)
+    for kind, tick, conn, data in read_trace(path):
+        ticks[tick].append((kind, conn, data))
+    if not ticks:
+        print(f"{path} is empty")
+        return
+
+    profiler = cProfile.Profile() if profile else None
+    times: List[Tuple[float, int]] = []
+    checked, diverged = 0, []
+    protos = {}
+    seeds = TraceSeeds()
+
+    with transaction.atomic():
+        server = MoonlapseServer()
+        server.load()
+        server.recorder = seeds
+        # Start with an empty world until the point the recorded server was ready, if the trace says when that was
+        world = dict(server.instances)
+        if any(kind == READY for records in ticks.values() for kind, _, _ in records):
+            server.instances.clear()
+            server.ready = False
+
+        for tick in range(max(ticks) + 1):
+            for kind, conn, data in ticks.get(tick, ()):
+                if kind == CONNECT:
+                    transport = ReplayTransport(data.decode())
+                    proto = server.buildProtocol(transport.peer)
+                    proto.connection_id = conn
+                    proto.makeConnection(transport)
+                    protos[conn] = proto
+                elif kind == PACKET and conn in protos:
+                    protos[conn].plaintext_received(data)
+                elif kind == LOST and conn in protos:
+                    protos.pop(conn).connectionLost(connectionDone)
+                elif kind == RANDOM:
+                    seeds.add(conn, data)
+                elif kind == READY:
+                    server.instances.update(world)
+                    server.ready = True
+
+            if profiler:
+                profiler.enable()
+            start = time.perf_counter()
+            server.tick()
+            times.append((time.perf_counter() - start, tick))
+            if profiler:
+                profiler.disable()
+
+            for kind, conn, data in ticks.get(tick, ()):
+                if kind == STATE:
+                    checked += 1
+                    if state_digest(server) != data:
+                        diverged.append(tick)
+
+        transaction.set_rollback(True)
+
+    durations = sorted(t for t, _ in times)
+    overran = sum(t > 1 / server.tickrate for t in durations)
+    print(f"Replayed {len(times)} ticks ({len(times) / server.tickrate:.0f}s of play) "
+          f"in {sum(durations):.2f}s")
+    print("Tick time: " + ", ".join(
+        f"p{p} {durations[min(len(durations) - 1, int(len(durations) * p / 100))] * 1000:.2f}ms" for p in (50, 90, 99))
+        + f", max {durations[-1] * 1000:.2f}ms, mean {statistics.mean(durations) * 1000:.2f}ms")
+    print(f"{overran} ticks took longer than the {1000 / server.tickrate:.0f}ms between ticks")
+    print("Slowest ticks: " + ", ".join(f"#{tick} ({t * 1000:.2f}ms)" for t, tick in sorted(times, reverse=True)[:5]))
+
+    if diverged:
+        print(f"Game state differed from the recording on {len(diverged)} of {checked} checks, "
+              f"first after tick {diverged[0]}")
+    else:
+        print(f"Game state matched the recording on all {checked} checks")
+    if seeds.missing:
+        print(f"{seeds.missing} random numbers were drawn which weren't in the recording")
+
+    if profiler:
+        profiler.dump_stats(profile)
+        print(f"Saved profile to {profile}")
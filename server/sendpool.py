@@ -0,0 +1,87 @@
+"""
+Encrypts what each connection has to send at the end of a tick on a pool of workers, since one connection's
+encryption doesn't depend on another's. The reactor thread encodes the packets, waits for the pool, then writes the
+results to the transports itself, in order.
+
+RSA encryption of the AES key is pure Python and holds the GIL, so threads only overlap pycryptodome's AES;
+processes spread all of it across cores, at the cost of copying each batch to and from them.
+"""
+import multiprocessing
+import os
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import *
+
+import rsa
+
+from networking import cryptography
+from networking.logger import get_logger
+from server import metrics, outbound, protocol
+
+log = get_logger('sendpool')
+
+
+def encrypt_batch(batch: Tuple[List[bytes], int, int]) -> List[bytes]:
+    """
+    :param batch: one connection's encoded packets, compressed if it chose to be, and the modulus and exponent of
+                  its client's public key
+    :return: the packets encrypted, in the same order
+    """
+    data, n, e = batch
+    key = rsa.PublicKey(n, e)
+    return [cryptography.encrypt(d, key) for d in data]
+
+
+class SendPool:
+    def __init__(self, workers: int, processes: bool = True):
+        """
+        :param workers: how many threads or processes to encrypt on
+        :param processes: whether to use processes rather than threads
+        """
+        self.workers = workers
+        self.processes = processes
+        if processes:
+            # Forked now, before the reactor has started any threads, rather than when first used
+            context = multiprocessing.get_context('fork') if hasattr(os, 'fork') else None
+            self.executor: Executor = ProcessPoolExecutor(workers, mp_context=context)
+            self.executor.submit(int).result()
+        else:
+            self.executor = ThreadPoolExecutor(workers, thread_name_prefix='sendpool')
+        log.info("Encrypting outgoing packets on %s %s", workers, 'processes' if processes else 'threads')
+
+    def flush(self, protos: Iterable[protocol.MoonlapseProtocol]):
+        """
+        Sends everything queued for each protocol's client.
+        """
+        sending, batches = [], []
+        for proto in protos:
+            if not proto.outgoing or not proto.can_send():
+                continue
+            if not proto.client_pub_key:
+                proto.flush()   # can't be encrypted, which it'll complain about
+                continue
+            metrics.OUTGOING_DEPTH.observe(len(proto.outgoing))
+            packets, data = zip(*proto.outgoing.drain(outbound.BYTES_PER_TICK))
+            proto.check_backlog()
+            if proto.compressor:
+                # Here rather than in the pool, as each connection's packets are compressed as one stream, in order
+                data = [outbound.compress(proto.compressor, d) for d in data]
+            sending.append((proto, packets))
+            batches.append((list(data), proto.client_pub_key.n, proto.client_pub_key.e))
+
+        if not batches:
+            return
+        start = time.perf_counter()
+        # A few batches per task, so there are enough tasks to go round without paying for one per connection
+        chunksize = max(1, len(batches) // (self.workers * 4))
+        results = list(self.executor.map(encrypt_batch, batches, chunksize=chunksize))
+        metrics.CRYPTO_SECONDS.observe(time.perf_counter() - start, 'encrypt_pool')
+
+        for (proto, packets), messages in zip(sending, results):
+            proto.sendStrings(messages)
+            for p, message in zip(packets, messages):
+                metrics.PACKETS_SENT.inc(p.action)
+                metrics.BYTES_SENT.inc(p.action, amount=len(message))
+
+    def close(self):
+        self.executor.shutdown()
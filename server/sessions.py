@@ -0,0 +1,129 @@
+"""
+Resumable sessions, so a player whose connection drops can pick up where they left off without logging in again.
+
+Each protocol logged in is given a resume token, which is sent to its client in a ResumeTokenPacket. If the
+connection is lost, the protocol is held for GRACE_SECONDS rather than logged out: its player stays in the world,
+and what would have been sent to the client waits in its queue, coalesced like a client who's behind. A new
+connection presenting the token in a ResumePacket takes over the held protocol, and is sent only what's waiting,
+and a new token. The same goes for a connection which hasn't been noticed to have dropped yet, which is cut off.
+If no connection resumes the session in time, the player is logged out as usual.
+
+Tokens are handed out again on each resume and each time a player arrives on a worker, so one that's leaked can't
+be used for long. When the server is split into processes, a token starts with the index of the worker which
+holds the session, so the front-ends know where to send a resume.
+"""
+import logging
+import secrets
+from typing import *
+
+from networking import packet
+from networking.logger import get_logger
+from server import metrics
+
+log = get_logger('sessions')
+
+GRACE_SECONDS = 30      # that a session is held after its connection drops
+
+
+def worker_of(token: str) -> Optional[int]:
+    """
+    :return: the index of the worker which issued the token, or None if it wasn't issued by a worker
+    """
+    index, dot, _ = token.partition('.')
+    return int(index) if dot and index.isdigit() else None
+
+
+class SessionStore:
+    """
+    A server's resume tokens, and the protocols held for them.
+    """
+
+    def __init__(self, server, prefix: str = ''):
+        """
+        :param prefix: what every token starts with, e.g. the index of the worker which issues it
+        """
+        self.server = server
+        self.prefix = prefix
+        self.tokens: Dict[str, Any] = {}        # token : protocol
+        self.held: Dict[Any, Any] = {}          # protocol held : the deferred which expires it
+
+    def new_token(self, proto) -> str:
+        if self.server.recorder:
+            # So replays hand out the same tokens as the recording did
+            token = '%032x' % self.server.rng('resume_token', proto).getrandbits(128)
+        else:
+            token = secrets.token_hex(16)
+        return self.prefix + token
+
+    def issue(self, proto):
+        """
+        Gives the protocol a new token, replacing its old one, and queues it to be sent to the client.
+        """
+        self.forget(proto)
+        proto.resume_token = self.new_token(proto)
+        self.tokens[proto.resume_token] = proto
+        proto.outgoing.append(packet.ResumeTokenPacket(proto.resume_token))
+
+    def forget(self, proto):
+        """
+        Stops the protocol's token resuming it, e.g. because its player logged out.
+        """
+        if proto.resume_token:
+            self.tokens.pop(proto.resume_token, None)
+            proto.resume_token = None
+
+    def hold(self, proto) -> bool:
+        """
+        Keeps a protocol whose connection was lost for its client to resume, if it's logged in with a token.
+        :return: whether it's being held
+        """
+        if not proto.logged_in or proto.resume_token not in self.tokens:
+            return False
+        proto.detached = True
+        ticks = GRACE_SECONDS * self.server.tickrate
+        self.held[proto] = self.server.add_deferred(self.expire, ticks, False, proto)
+        metrics.SESSIONS_HELD.inc()
+        proto.log(logging.INFO, "Holding session for %ss", GRACE_SECONDS)
+        return True
+
+    def expire(self, proto):
+        """
+        Gives up on a held protocol's client coming back, and logs its player out.
+        """
+        self.held.pop(proto, None)
+        self.forget(proto)
+        metrics.SESSIONS_EXPIRED.inc()
+        proto.debug("Session expired")
+        proto.logout(packet.LogoutPacket(proto.username))
+        proto.outgoing.clear()
+        self.server.connected_protocols.discard(proto)
+
+    def held_for(self, player_id: int) -> Optional[Any]:
+        """
+        :return: the protocol held for the player, if there is one
+        """
+        for proto in self.held:
+            if proto.player_info and proto.player_info.pk == player_id:
+                return proto
+        return None
+
+    def release(self, proto):
+        """
+        Logs out a held protocol's player straight away, e.g. because they've logged in again from scratch.
+        """
+        self.server.remove_deferred(self.held[proto])
+        self.expire(proto)
+
+    def claim(self, token: str) -> Optional[Any]:
+        """
+        Takes the protocol with the token off the store's hands, for a new connection to take it over.
+        :return: the protocol, or None if the token isn't one this store knows
+        """
+        proto = self.tokens.pop(token, None)
+        if not proto:
+            return None
+        proto.resume_token = None
+        deferred = self.held.pop(proto, None)
+        if deferred:
+            self.server.remove_deferred(deferred)
+        return proto
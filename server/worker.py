@@ -0,0 +1,269 @@
+"""
+A worker of a server split into processes (python server --shards N): simulates the rooms whose ids are its index
+modulo N, for players whose connections the front-ends (server/gateway.py) relay to it. See server/ipc.py for what
+passes between them.
+"""
+import json
+from typing import *
+
+from twisted.internet import reactor
+from twisted.internet.protocol import connectionDone
+
+from networking import packet
+from networking.logger import get_logger
+from server import ipc, metrics, models, sessions
+from server.mlserver import MoonlapseServer
+from server.protocol import MoonlapseProtocol
+
+log = get_logger('worker')
+
+
+class WorkerServer(MoonlapseServer):
+    def __init__(self, index: int, shards: int):
+        self.index = index
+        self.shards = shards
+        super().__init__()
+
+        # the lobby's record of who's logged in anywhere. player.pk
+        self.online: Set[int] = set()
+        # and of whose sessions other workers are holding. player.pk : index of the worker
+        self.held_elsewhere: Dict[int, int] = {}
+        # logins waiting for another worker to log out a held session first. player.pk : finishes each login
+        self.releasing: Dict[int, List[Callable[[], None]]] = {}
+
+    def owns(self, room_id: int) -> bool:
+        return ipc.worker_for(room_id, self.shards) == self.index
+
+    def buildProtocol(self, addr):
+        log.info("A front-end connected to worker %s", self.index)
+        return GatewayLink(self)
+
+    def session_store(self) -> sessions.SessionStore:
+        # So the front-ends can tell which worker holds a session from its token
+        return sessions.SessionStore(self, f"{self.index}.")
+
+    def is_logged_in(self, pid: int) -> bool:
+        return pid in self.online or super().is_logged_in(pid)
+
+    def claim_instance(self, instance: models.InstancedEntity) -> models.InstancedEntity:
+        # Another worker may have moved the player since this one loaded the world, and saved it as they left
+        return self.place_instance(instance.pk, instance.room_id, instance.y, instance.x)
+
+    def place_instance(self, pk: int, room_id: int, y: int, x: int) -> models.InstancedEntity:
+        """
+        Puts this worker's copy of an instance where another worker left it, loading it from the database if this
+        worker has never seen it, e.g. it's a player who registered after this worker started.
+        """
+        instance = self.instances.get(pk)
+        if not instance:
+            instance = self.instances[pk] = models.InstancedEntity.objects.select_related('entity', 'room').get(pk=pk)
+        instance.room_id, instance.y, instance.x = room_id, y, x
+        return instance
+
+    def logged_out(self, proto: 'RelayedProtocol', player_id: int):
+        if self.index == ipc.LOBBY:
+            self.offline(player_id)
+        else:
+            proto.link.send(ipc.OFFLINE, proto.conn, {'player': player_id})
+
+    def offline(self, player_id: int):
+        """
+        The lobby's note that a player has logged out, wherever they were, finishing any logins waiting on it.
+        """
+        self.online.discard(player_id)
+        self.no_longer_held(player_id)
+
+    def no_longer_held(self, player_id: int):
+        """
+        The lobby's note that another worker isn't holding a player's session any more. Logins waiting for it to
+        let go carry on, and find the player logged out, or logged in again if the session was resumed.
+        """
+        self.held_elsewhere.pop(player_id, None)
+        for finish in self.releasing.pop(player_id, ()):
+            finish()
+
+    def release(self, player_id: int):
+        """
+        Logs out the player's held session, if this worker is still holding it, for them to log in again.
+        """
+        held = self.sessions.held_for(player_id)
+        if held:
+            self.sessions.release(held)
+
+    def bind(self, proto: 'RelayedProtocol', handoff: dict):
+        """
+        Takes over a player another worker handed off, putting them in their new room.
+        """
+        proto.username = handoff['username']
+        proto.player_info = models.Player.objects.select_related('entity').get(pk=handoff['player'])
+        proto.player_instance = self.place_instance(handoff['instance'], handoff['room'], handoff['y'], handoff['x'])
+        self.sessions.issue(proto)
+        proto.move_rooms(handoff['room'])
+
+
+class RelayedProtocol(MoonlapseProtocol):
+    """
+    A client's connection as a worker sees it: packets come from and go to the gateway, already decrypted and
+    decompressed, and not yet compressed or encrypted.
+    """
+
+    def __init__(self, server: WorkerServer, link: 'GatewayLink', conn: int):
+        super().__init__(server)
+        self.link = link
+        self.conn = conn     # the gateway's id for the connection
+        self.client_host = ''   # where the client connected from, if the gateway said
+        link.protocols[conn] = self
+
+    def connectionLost(self, reason=connectionDone):
+        del self.link.protocols[self.conn]
+        super().connectionLost(reason)
+        if self.detached and self.server.index != ipc.LOBBY:
+            # So the lobby lets the player log in again meanwhile, once this worker has let go
+            self.link.send(ipc.HELD, self.conn, {'player': self.player_info.pk, 'worker': self.server.index})
+
+    def disconnect(self, graceful: bool = False):
+        self.link.send(ipc.CLOSE, self.conn, {'graceful': graceful})
+
+    def handshaken(self) -> bool:
+        # The gateway has the client's key, and encrypts for it
+        return True
+
+    def use_compression(self, codec: Optional[str]):
+        # The gateway compresses and decompresses, having chosen the same codec from the client's offer
+        pass
+
+    def use_framing(self, chosen: Optional[str]):
+        # Likewise the gateway frames
+        pass
+
+    def send_packets(self, packets: Iterable[Tuple[packet.Packet, bytes]]):
+        for p, data in packets:
+            self.link.send(ipc.SEND, self.conn, data)
+            metrics.PACKETS_SENT.inc(p.action)
+            metrics.BYTES_SENT.inc(p.action, amount=len(data))
+            self.debug("Sent data to my client: %s", data)
+
+    def detach(self):
+        """
+        Lets go of the connection, which the gateway is handing to another worker. Everything queued for the client
+        is sent first, so it arrives before anything from the other worker.
+        """
+        self.flush(None)
+        self.server.sessions.forget(self)
+        if self.actionloop:
+            self.server.remove_deferred(self.actionloop)
+            self.actionloop = None
+        del self.link.protocols[self.conn]
+        self.server.connected_protocols.remove(self)
+
+    def host(self) -> str:
+        return self.client_host
+
+    def may_log_in(self, user: models.User, player: models.Player) -> bool:
+        # A session another worker holds doesn't stop the player logging in again either
+        return player.pk in self.server.held_elsewhere or super().may_log_in(user, player)
+
+    def complete_login(self, correct: bool, user: models.User, player: models.Player):
+        worker = self.server.held_elsewhere.get(player.pk)
+        if correct and worker is not None and self in self.server.connected_protocols:
+            # That worker logs the held session out, saving where the player was, before they can log in here
+            self.server.releasing.setdefault(player.pk, []).append(lambda: self.complete_login(correct, user, player))
+            self.link.send(ipc.RELEASE, self.conn, {'player': player.pk, 'worker': worker})
+            return
+        super().complete_login(correct, user, player)
+        if self.player_info:
+            self.server.online.add(self.player_info.pk)
+
+    def resume(self, p: packet.ResumePacket):
+        super().resume(p)
+        if self.server.index == ipc.LOBBY:
+            return
+        if self.logged_in:
+            # So the lobby knows the player's back, and turns away anyone logging in as them
+            self.link.send(ipc.RESUMED, self.conn, {'player': self.player_info.pk})
+        else:
+            # Sent here for a session which has gone, so back to the lobby to log in
+            self.detach()
+            self.link.send(ipc.UNBIND, self.conn)
+
+    def logout(self, p: packet.LogoutPacket):
+        player = self.player_info
+        super().logout(p)
+        if player and not self.player_info:
+            self.server.logged_out(self, player.pk)
+            if self.server.index != ipc.LOBBY and self.conn in self.link.protocols:
+                self.detach()
+                self.link.send(ipc.UNBIND, self.conn)
+
+    def move_rooms(self, dest_roomid: Optional[int]):
+        if self.server.owns(dest_roomid):
+            super().move_rooms(dest_roomid)
+            return
+
+        self.debug("Handing off to room %s", dest_roomid)
+        if self.logged_in:
+            self.broadcast(packet.GoodbyePacket(self.player_instance.pk))
+        self.player_instance.room_id = dest_roomid
+        self.player_instance.save()     # for the other worker, if it hasn't got this instance
+
+        self.detach()
+        self.link.send(ipc.HANDOFF, self.conn, {
+            'room': dest_roomid,
+            'player': self.player_info.pk,
+            'instance': self.player_instance.pk,
+            'y': self.player_instance.y,
+            'x': self.player_instance.x,
+            'username': self.username
+        })
+
+
+class GatewayLink(ipc.MessageReceiver):
+    def __init__(self, server: WorkerServer):
+        self.server = server
+        self.protocols: Dict[int, RelayedProtocol] = {}
+
+    def connectionLost(self, reason=connectionDone):
+        log.warning("Lost a front-end; disconnecting its %s clients", len(self.protocols))
+        for proto in list(self.protocols.values()):
+            proto.connectionLost(reason)
+
+    def message_received(self, kind: int, conn: int, body: bytes):
+        if kind in (ipc.CONNECT, ipc.BIND):
+            proto = RelayedProtocol(self.server, self, conn)
+            if kind == ipc.CONNECT:
+                proto.client_host = json.loads(body).get('host', '')
+            proto.connectionMade()
+            if kind == ipc.BIND:
+                self.server.bind(proto, json.loads(body))
+        elif kind == ipc.OFFLINE:
+            self.server.offline(json.loads(body)['player'])
+        elif kind == ipc.HELD:
+            held = json.loads(body)
+            self.server.held_elsewhere[held['player']] = held['worker']
+        elif kind == ipc.RESUMED:
+            self.server.no_longer_held(json.loads(body)['player'])
+        elif kind == ipc.RELEASE:
+            self.server.release(json.loads(body)['player'])
+        elif conn not in self.protocols:
+            # Sent before the gateway knew the connection had been handed off or unbound
+            log.debug("Dropped %s for connection %s, which isn't here", ipc.NAMES[kind], conn)
+        elif kind == ipc.DATA:
+            self.protocols[conn].plaintext_received(body)
+        elif kind == ipc.LOST:
+            self.protocols[conn].connectionLost()
+
+
+def run(index: int, shards: int, socketdir: str):
+    """
+    Runs worker number index of shards, listening for the front-ends on its UNIX socket in socketdir.
+    """
+    server = WorkerServer(index, shards)
+    path = ipc.socket_path(socketdir, index)
+    reactor.listenUNIX(path, server)
+    log.info("Worker %s of %s listening on %s", index, shards, path)
+
+    # Nothing can reach a worker without the front-ends
+    ipc.exit_with_parent()
+
+    reactor.callWhenRunning(server.start)
+    reactor.run()